@@ -0,0 +1,146 @@
+"""
+Measures how long the scheduler takes to parse dags/udac_example_dag.py.
+
+Every sample runs in a fresh interpreter, like a scheduler DAG file processor:
+  cold  - importing airflow (which integrates the udacity_plugin) plus the first
+          parse of the DAG file
+  warm  - re-parsing the DAG file once airflow and the plugin are loaded
+The modules the parse pulls in and the peak memory it allocates are reported too.
+
+Exits with status 1 when a threshold is exceeded, a forbidden module (pandas by
+default) gets imported, or a timing regresses past --tolerance of --baseline.
+
+    python benchmarks/dag_parse_benchmark.py --samples 5 --max-cold-ms 8000 --max-warm-ms 250
+    python benchmarks/dag_parse_benchmark.py --save-baseline benchmarks/dag_parse_baseline.json
+    python benchmarks/dag_parse_benchmark.py --baseline benchmarks/dag_parse_baseline.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAGS_FOLDER = os.path.join(ROOT, "dags")
+PLUGINS_FOLDER = os.path.join(ROOT, "plugins")
+DAG_FILE = os.path.join(DAGS_FOLDER, "udac_example_dag.py")
+
+PROBE = r"""
+import importlib.util
+import json
+import sys
+import time
+import tracemalloc
+
+sys.path[:0] = [{dags!r}, {plugins!r}]
+
+def parse(name):
+    spec = importlib.util.spec_from_file_location(name, {dag_file!r})
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+started = time.perf_counter()
+import airflow
+import airflow.operators
+airflow_import = time.perf_counter() - started
+
+modules_before = set(sys.modules)
+tracemalloc.start()
+started = time.perf_counter()
+parse("dag_parse_benchmark_0")
+first_parse = time.perf_counter() - started
+peak_bytes = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+loaded = sorted(set(sys.modules) - modules_before)
+
+warm = []
+for run in range({warm_runs}):
+    started = time.perf_counter()
+    parse("dag_parse_benchmark_{{}}".format(run + 1))
+    warm.append(time.perf_counter() - started)
+
+print(json.dumps({{
+    "airflow_import_s": airflow_import,
+    "first_parse_s": first_parse,
+    "warm_parse_s": warm,
+    "parse_peak_bytes": peak_bytes,
+    "modules_loaded_by_parse": loaded,
+    "all_modules": sorted(sys.modules),
+}}))
+"""
+
+
+def run_probe(warm_runs):
+    env = dict(os.environ,
+               AIRFLOW__CORE__DAGS_FOLDER=DAGS_FOLDER,
+               AIRFLOW__CORE__PLUGINS_FOLDER=PLUGINS_FOLDER,
+               AIRFLOW__CORE__LOAD_EXAMPLES="False")
+    code = PROBE.format(dags=DAGS_FOLDER, plugins=PLUGINS_FOLDER, dag_file=DAG_FILE, warm_runs=warm_runs)
+    output = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=ROOT)
+    # Airflow may print banners or warnings before the JSON line
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def measure(samples, warm_runs):
+    probes = [run_probe(warm_runs) for _ in range(samples)]
+    cold = [(p["airflow_import_s"] + p["first_parse_s"]) * 1000 for p in probes]
+    warm = [value * 1000 for p in probes for value in p["warm_parse_s"]]
+    return {
+        "cold_ms": statistics.median(cold),
+        "first_parse_ms": statistics.median(p["first_parse_s"] * 1000 for p in probes),
+        "airflow_import_ms": statistics.median(p["airflow_import_s"] * 1000 for p in probes),
+        "warm_ms": statistics.median(warm) if warm else 0.0,
+        "parse_peak_kib": max(p["parse_peak_bytes"] for p in probes) / 1024.0,
+        "modules_loaded_by_parse": len(probes[0]["modules_loaded_by_parse"]),
+        "modules_total": len(probes[0]["all_modules"]),
+    }, probes[0]["all_modules"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=5, help="fresh interpreters to sample")
+    parser.add_argument("--warm-runs", type=int, default=10, help="re-parses per interpreter")
+    parser.add_argument("--max-cold-ms", type=float, help="fail when the median cold parse is slower")
+    parser.add_argument("--max-warm-ms", type=float, help="fail when the median warm parse is slower")
+    parser.add_argument("--forbid", action="append", default=None,
+                        help="module that must not be imported by a parse (default: pandas)")
+    parser.add_argument("--baseline", help="JSON file written by --save-baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown against --baseline")
+    parser.add_argument("--save-baseline", help="write the measured timings to this JSON file")
+    args = parser.parse_args()
+
+    result, modules = measure(args.samples, args.warm_runs)
+    for name, value in result.items():
+        print(f"{name:>24}: {value:.1f}" if isinstance(value, float) else f"{name:>24}: {value}")
+
+    failures = []
+    for module in args.forbid or ["pandas"]:
+        if module in modules:
+            failures.append(f"{module} is imported while parsing the DAG")
+    if args.max_cold_ms is not None and result["cold_ms"] > args.max_cold_ms:
+        failures.append(f"cold parse {result['cold_ms']:.1f}ms exceeds {args.max_cold_ms}ms")
+    if args.max_warm_ms is not None and result["warm_ms"] > args.max_warm_ms:
+        failures.append(f"warm parse {result['warm_ms']:.1f}ms exceeds {args.max_warm_ms}ms")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ("cold_ms", "warm_ms"):
+            limit = baseline[key] * (1 + args.tolerance)
+            if result[key] > limit:
+                failures.append(f"{key} {result[key]:.1f} regressed past {limit:.1f} "
+                                f"(baseline {baseline[key]:.1f} + {args.tolerance:.0%})")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
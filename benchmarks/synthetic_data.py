@@ -0,0 +1,142 @@
+"""
+Generates synthetic Sparkify log_data and song_data JSON files at a configurable scale.
+
+The records carry the fields of staging_events and staging_songs, laid out like
+the udacity-dend bucket:
+  song_data/A/B/C/songs-00000.json        one JSON song object per line
+  log_data/2018/11/2018-11-events-00000.json  one JSON event per line
+
+A share of the NextSong events (--match-rate) plays a generated song, so the
+songplays join returns a predictable number of rows. Files are written as they
+are generated, so memory use does not depend on --events.
+
+    python benchmarks/synthetic_data.py --output /tmp/sparkify --events 1000000 --songs 50000
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+PAGES = ["NextSong"] * 8 + ["Home", "Logout", "Settings", "Help"]
+LEVELS = ["free", "paid"]
+AGENTS = [
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0",
+]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Atlanta-Sandy Springs-Roswell, GA",
+             "Chicago-Naperville-Elgin, IL-IN-WI", "New York-Newark-Jersey City, NY-NJ-PA"]
+
+
+def song_record(index, rng):
+    artist = index // 3
+    return {
+        "num_songs": 1,
+        "artist_id": "AR{:016d}".format(artist),
+        "artist_name": "Artist {}".format(artist),
+        "artist_latitude": round(rng.uniform(-60, 60), 5),
+        "artist_longitude": round(rng.uniform(-150, 150), 5),
+        "artist_location": rng.choice(LOCATIONS),
+        "song_id": "SO{:016d}".format(index),
+        "title": "Song {}".format(index),
+        "duration": round(rng.uniform(60, 600), 5),
+        "year": rng.randint(1960, 2018),
+    }
+
+
+def event_record(index, rng, month_start, month_seconds, songs, users, match_rate):
+    user = rng.randrange(users)
+    page = rng.choice(PAGES)
+    if page == "NextSong" and rng.random() < match_rate:
+        song = rng.randrange(songs)
+        title, artist = "Song {}".format(song), "Artist {}".format(song // 3)
+    elif page == "NextSong":
+        title, artist = "Unknown Song {}".format(index), "Unknown Artist {}".format(index % 997)
+    else:
+        title = artist = None
+    ts = month_start + timedelta(seconds=rng.uniform(0, month_seconds))
+    return {
+        "artist": artist,
+        "auth": "Logged In",
+        "firstName": "First{}".format(user),
+        "gender": "F" if user % 2 else "M",
+        "itemInSession": index % 50,
+        "lastName": "Last{}".format(user),
+        "length": round(rng.uniform(60, 600), 5) if title else None,
+        "level": LEVELS[user % 2],
+        "location": LOCATIONS[user % len(LOCATIONS)],
+        "method": "PUT" if page == "NextSong" else "GET",
+        "page": page,
+        "registration": 1540000000000.0 + user,
+        "sessionId": user * 10 + index % 10,
+        "song": title,
+        "status": 200,
+        "ts": int((ts - datetime(1970, 1, 1)).total_seconds() * 1000),
+        "userAgent": AGENTS[user % len(AGENTS)],
+        "userId": str(user),
+    }
+
+
+def write_lines(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    count = 0
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def generate(output, events, songs, users=1000, month=(2018, 11), match_rate=0.6,
+             records_per_file=100000, seed=42):
+    """
+    Write song_data and log_data under output.
+
+    :return: dict with the number of songs, events and files written
+    """
+    rng = random.Random(seed)
+    files = 0
+    for start in range(0, songs, records_per_file):
+        index = start // records_per_file
+        path = os.path.join(output, "song_data", "A", "B", chr(ord("A") + index % 26),
+                            "songs-{:05d}.json".format(index))
+        write_lines(path, (song_record(i, rng) for i in range(start, min(start + records_per_file, songs))))
+        files += 1
+
+    year, month_number = month
+    month_start = datetime(year, month_number, 1)
+    next_month = datetime(year + month_number // 12, month_number % 12 + 1, 1)
+    month_seconds = (next_month - month_start).total_seconds()
+    for start in range(0, events, records_per_file):
+        index = start // records_per_file
+        path = os.path.join(output, "log_data", str(year), str(month_number),
+                            "{}-{:02d}-events-{:05d}.json".format(year, month_number, index))
+        write_lines(path, (event_record(i, rng, month_start, month_seconds, songs, users, match_rate)
+                           for i in range(start, min(start + records_per_file, events))))
+        files += 1
+
+    return {"songs": songs, "events": events, "files": files}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--events", type=float, default=1e5, help="number of log events, e.g. 1e5 to 1e8")
+    parser.add_argument("--songs", type=float, default=1e4)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--month", default="2018-11", help="YYYY-MM the events fall into")
+    parser.add_argument("--match-rate", type=float, default=0.6,
+                        help="share of NextSong events that play a generated song")
+    parser.add_argument("--records-per-file", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    year, month_number = (int(part) for part in args.month.split("-"))
+    print(generate(args.output, int(args.events), int(args.songs), args.users, (year, month_number),
+                   args.match_rate, args.records_per_file, args.seed))
+
+
+if __name__ == "__main__":
+    main()
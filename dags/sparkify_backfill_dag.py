@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
+                                LoadDimensionOperator, DataQualityOperator, TableMaintenanceOperator,
+                                SchemaBootstrapOperator, RollupOperator, ExclusiveRunSensor)
+from helpers import SqlQueries
+
+# Loads a whole date range in one pass instead of one Project_5 chain per month.
+# Runs of this DAG and Project_5 wait for each other, they share the staging tables.
+# Trigger with the range as run conf, end excluded:
+#   airflow trigger_dag Project_5_Backfill -c '{"start": "2018-01-01", "end": "2019-01-01"}'
+BACKFILL_RANGE = ("{dag_run.conf[start]}", "{dag_run.conf[end]}")
+
+default_args = {
+    'owner': 'shivam_gupta',
+    'depends_on_past': False,
+    'email': ['shivamvmc@gmail.com'],
+    'email_on_failure': True,
+    'email_on_retry': False,
+    'retries': 3,
+    'retry_delay': timedelta(minutes=5)
+}
+
+backfill_dag = DAG('Project_5_Backfill',
+                description='Load a date range of Sparkify data into Redshift in one run',
+                start_date=datetime(2018, 11, 1, 0, 0, 0, 0),
+                schedule_interval=None,
+                default_args=default_args,
+                max_active_runs=1
+           )
+
+start_operator = DummyOperator(
+                    task_id='Begin_Execution',
+                    dag=backfill_dag
+)
+
+# Both DAGs TRUNCATE and load the same tables, one run at a time touches Redshift
+exclusive_run_task = ExclusiveRunSensor(
+    task_id="Wait_For_Exclusive_Run",
+    dag=backfill_dag,
+    dag_ids=["Project_5", "Project_5_Backfill"],
+    poke_interval=60,
+    mode="reschedule"
+)
+
+bootstrap_schema_task = SchemaBootstrapOperator(
+    task_id="Bootstrap_Schema",
+    dag=backfill_dag,
+    redshift_conn_id="redshift"
+)
+
+# Every month's log_data prefix in one set of manifests
+copy_events_to_s3_task = StageToRedshiftOperator(
+    task_id="Stage_Events",
+    dag=backfill_dag,
+    table_name="staging_events",
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    s3_bucket="udacity-dend",
+    s3_key="log_data/{execution_date.year}/{execution_date.month}/",
+    key_range=BACKFILL_RANGE,
+    s3_format="json",
+    json_path="s3://udacity-dend/log_json_path.json",
+    compupdate=False,
+    statupdate=False,
+    truncate_before_load=True,
+    use_manifest=True,
+    manifest_bucket="{{ var.value.sparkify_manifest_bucket }}"
+)
+
+copy_songs_to_s3_task = StageToRedshiftOperator(
+    task_id="Stage_Songs",
+    dag=backfill_dag,
+    table_name="staging_songs",
+    redshift_conn_id="redshift",
+    aws_credentials_id="aws_credentials",
+    s3_bucket="udacity-dend",
+    s3_key="song_data/",
+    s3_format="json",
+    compupdate=False,
+    statupdate=False,
+    use_manifest=True,
+    manifest_bucket="{{ var.value.sparkify_manifest_bucket }}",
+    incremental=True,
+    post_load_sql=SqlQueries.song_match_key_insert
+)
+
+# One month per transaction, loaded concurrently, with the per-month counts recorded
+load_songplays_in_s3_task = LoadFactOperator(
+    task_id="Load_Songplays_Fact_Table",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_name="songplays",
+    sql=SqlQueries.songplay_table_match_key_insert,
+    load_mode="replace_partition",
+    filter_key=BACKFILL_RANGE,
+    partition_by="month",
+    # One thread drives the months' transactions, a month stuck past 30 minutes is cancelled and retried
+    async_partitions=True,
+    statement_timeout=1800,
+    match_rate_sql=SqlQueries.song_match_rate,
+    count_by="month"
+)
+
+load_song_in_s3_task = LoadDimensionOperator(
+    task_id="Load_Song_Dim_Table",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_name="songs",
+    sql=SqlQueries.song_table_insert,
+    load_mode="upsert",
+    primary_key="songid",
+    skip_unchanged=True,
+    source_table="staging_songs"
+)
+
+load_user_in_s3_task = LoadDimensionOperator(
+    task_id="Load_User_Dim_Table",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_name="users",
+    sql=SqlQueries.user_table_upsert,
+    load_mode="upsert",
+    primary_key="userid",
+    order_by="ts DESC"
+)
+
+load_artist_in_s3_task = LoadDimensionOperator(
+    task_id="Load_Artist_Dim_Table",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_name="artists",
+    sql=SqlQueries.artist_table_insert,
+    load_mode="upsert",
+    primary_key="artistid",
+    skip_unchanged=True,
+    source_table="staging_songs"
+)
+
+load_time_in_s3_task = LoadDimensionOperator(
+    task_id="Load_Time_Dim_Table",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_name="time",
+    sql=SqlQueries.time_table_window_insert,
+    load_mode="incremental",
+    filter_key=BACKFILL_RANGE
+)
+
+# Dashboards read these instead of scanning songplays
+update_rollups_task = RollupOperator(
+    task_id="Update_Rollups",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    filter_key=BACKFILL_RANGE
+)
+
+dq_check_task = DataQualityOperator(
+    task_id="Run_Data_Quality_Checks",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    table_info_dict=[{"table_name": "users", "not_null": "userid", "unique": "userid"},
+                     {"table_name": "songs", "not_null": "songid", "unique": "songid"},
+                     {"table_name": "artists", "not_null": "artistid", "unique": "artistid"},
+                     {"table_name": "time", "not_null": "start_time"},
+                     # A range covers many months of songplays, a 10% sample profiles it
+                     {"table_name": "songplays", "not_null": "playid", "window_column": "start_time",
+                      "sample": 0.1, "profile": ["user_id", "song_id", "level"],
+                      "references": {"user_id": "users.userid", "song_id": "songs.songid",
+                                     "artist_id": "artists.artistid", "start_time": "time.start_time"}}],
+    filter_key=BACKFILL_RANGE,
+    # Every range length is its own baseline scope, few runs ever share one
+    on_deviation="warn"
+)
+
+maintenance_task = TableMaintenanceOperator(
+    task_id="Maintain_Tables",
+    dag=backfill_dag,
+    redshift_conn_id="redshift",
+    tables=["staging_events", "staging_songs", "songplays", "users", "songs", "artists", "time",
+            "songplays_daily_song", "songplays_daily_user", "songplays_monthly_artist"]
+)
+
+end_operator = DummyOperator(
+                    task_id='End_Execution',
+                    dag=backfill_dag
+)
+
+start_operator >> exclusive_run_task >> bootstrap_schema_task >> [copy_events_to_s3_task, copy_songs_to_s3_task] >> load_songplays_in_s3_task
+
+load_songplays_in_s3_task >> [load_song_in_s3_task, load_user_in_s3_task,
+                              load_artist_in_s3_task, load_time_in_s3_task, update_rollups_task] >> dq_check_task
+
+dq_check_task >> maintenance_task >> end_operator
@@ -1,11 +1,11 @@
 from datetime import datetime, timedelta
 import os
 from airflow import DAG
-from airflow.contrib.hooks.aws_hook import AwsHook
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator, PostgresOperator, PythonOperator)
+                                LoadDimensionOperator, DataQualityOperator, TableMaintenanceOperator,
+                                SchemaBootstrapOperator, RollupOperator, QueryCostGuardOperator,
+                                ConvertEventsOperator, ExclusiveRunSensor)
 from helpers import SqlQueries
 
 default_args = {
@@ -32,11 +32,29 @@ start_operator = DummyOperator(
                     dag=main_dag
 )
 
-create_events_in_s3_task = PostgresOperator(
-    task_id="Create_Events",
+# Both DAGs TRUNCATE and load the same tables, one run at a time touches Redshift
+exclusive_run_task = ExclusiveRunSensor(
+    task_id="Wait_For_Exclusive_Run",
     dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_staging_events_table
+    dag_ids=["Project_5", "Project_5_Backfill"],
+    poke_interval=60,
+    mode="reschedule"
+)
+
+# Every CREATE TABLE in one transaction, skipped when the DDL is unchanged since the last run
+bootstrap_schema_task = SchemaBootstrapOperator(
+    task_id="Bootstrap_Schema",
+    dag=main_dag,
+    redshift_conn_id="redshift"
+)
+
+# Only the NextSong events and the columns the loads read, as Parquet
+convert_events_task = ConvertEventsOperator(
+    task_id="Convert_Events",
+    dag=main_dag,
+    aws_credentials_id="aws_credentials",
+    input_path="s3://udacity-dend/log_data/{execution_date.year}/{execution_date.month}/",
+    output_path="s3://{{ var.value.sparkify_manifest_bucket }}/log_parquet/{execution_date.year}/{execution_date.month}/"
 )
 
 copy_events_to_s3_task = StageToRedshiftOperator(
@@ -45,17 +63,12 @@ copy_events_to_s3_task = StageToRedshiftOperator(
     table_name="staging_events",
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
-    s3_bucket="udacity-dend",
-    s3_key="log_data/{execution_date.year}/{execution_date.month}/",
-    s3_format="json",
-    json_path="s3://udacity-dend/log_json_path.json"
-)
-
-create_songs_in_s3_task = PostgresOperator(
-    task_id="Create_Songs",
-    dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_staging_songs_table
+    s3_bucket="{{ var.value.sparkify_manifest_bucket }}",
+    s3_key="log_parquet/{execution_date.year}/{execution_date.month}/",
+    s3_format="parquet",
+    compupdate=False,
+    statupdate=False,
+    truncate_before_load=True
 )
 
 copy_songs_to_s3_task = StageToRedshiftOperator(
@@ -66,14 +79,30 @@ copy_songs_to_s3_task = StageToRedshiftOperator(
     aws_credentials_id="aws_credentials",
     s3_bucket="udacity-dend",
     s3_key="song_data/",
-    s3_format="json"
+    s3_format="json",
+    compupdate=False,
+    statupdate=False,
+    use_manifest=True,
+    manifest_bucket="{{ var.value.sparkify_manifest_bucket }}",
+    incremental=True,
+    post_load_sql=SqlQueries.song_match_key_insert
 )
 
-create_songplays_in_s3_task = PostgresOperator(
-    task_id="Create_Songplays",
+# EXPLAIN the load queries against the freshly staged data, before running them
+check_query_plans_task = QueryCostGuardOperator(
+    task_id="Check_Query_Plans",
     dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_songplays_table
+    redshift_conn_id="redshift",
+    queries={
+        "songplay_table_match_key_insert": SqlQueries.songplay_table_match_key_insert,
+        "user_table_upsert": SqlQueries.user_table_upsert,
+        "song_table_insert": SqlQueries.song_table_insert,
+        "artist_table_insert": SqlQueries.artist_table_insert,
+        "time_table_window_insert": (SqlQueries.time_table_window_insert,
+                                     ("{execution_date}", "{next_execution_date}")),
+    },
+    # time is distributed on start_time and songplays on song_id, the anti-join redistributes one side
+    budgets={"time_table_window_insert": {"forbidden_steps": ("DS_DIST_BOTH",)}}
 )
 
 load_songplays_in_s3_task = LoadFactOperator(
@@ -82,37 +111,11 @@ load_songplays_in_s3_task = LoadFactOperator(
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
     table_name="songplays",
-    sql=SqlQueries.songplay_table_insert,
-    load_mode="append",
-    filter_key=("{execution_date}", "{next_execution_date}")
-)
-
-create_song_in_s3_task = PostgresOperator(
-    task_id="Create_Song_Dim_Table",
-    dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_songs_table
-)
-
-create_user_in_s3_task = PostgresOperator(
-    task_id="Create_User_Dim_Table",
-    dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_users_table
-)
-
-create_artist_in_s3_task = PostgresOperator(
-    task_id="Create_Artist_Dim_Table",
-    dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_artist_table
-)
-
-create_time_in_s3_task = PostgresOperator(
-    task_id="Create_Time_Dim_Table",
-    dag=main_dag,
-    postgres_conn_id="redshift",
-    sql=SqlQueries.create_time_table
+    sql=SqlQueries.songplay_table_match_key_insert,
+    load_mode="replace_partition",
+    filter_key=("{execution_date}", "{next_execution_date}"),
+    match_rate_sql=SqlQueries.song_match_rate,
+    count_by="month"
 )
 
 load_song_in_s3_task = LoadDimensionOperator(
@@ -122,7 +125,10 @@ load_song_in_s3_task = LoadDimensionOperator(
     aws_credentials_id="aws_credentials",
     table_name="songs",
     sql=SqlQueries.song_table_insert,
-    load_mode="clean"
+    load_mode="upsert",
+    primary_key="songid",
+    skip_unchanged=True,
+    source_table="staging_songs"
 )
 
 load_user_in_s3_task = LoadDimensionOperator(
@@ -131,8 +137,10 @@ load_user_in_s3_task = LoadDimensionOperator(
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
     table_name="users",
-    sql=SqlQueries.user_table_insert,
-    load_mode="clean"
+    sql=SqlQueries.user_table_upsert,
+    load_mode="upsert",
+    primary_key="userid",
+    order_by="ts DESC"
 )
 
 load_artist_in_s3_task = LoadDimensionOperator(
@@ -142,7 +150,10 @@ load_artist_in_s3_task = LoadDimensionOperator(
     aws_credentials_id="aws_credentials",
     table_name="artists",
     sql=SqlQueries.artist_table_insert,
-    load_mode="clean"
+    load_mode="upsert",
+    primary_key="artistid",
+    skip_unchanged=True,
+    source_table="staging_songs"
 )
 
 load_time_in_s3_task = LoadDimensionOperator(
@@ -151,8 +162,17 @@ load_time_in_s3_task = LoadDimensionOperator(
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
     table_name="time",
-    sql=SqlQueries.time_table_insert,
-    load_mode="clean"
+    sql=SqlQueries.time_table_window_insert,
+    load_mode="incremental",
+    filter_key=("{execution_date}", "{next_execution_date}")
+)
+
+# Dashboards read these instead of scanning songplays
+update_rollups_task = RollupOperator(
+    task_id="Update_Rollups",
+    dag=main_dag,
+    redshift_conn_id="redshift",
+    filter_key=("{execution_date}", "{next_execution_date}")
 )
 
 dq_check_task = DataQualityOperator(
@@ -160,12 +180,24 @@ dq_check_task = DataQualityOperator(
     dag=main_dag,
     redshift_conn_id="redshift",
     aws_credentials_id="aws_credentials",
-    table_info_dict=[{"table_name": "users", "not_null": "userid"},     \
-              {"table_name": "songs", "not_null": "songid"},            \
-              {"table_name": "artists", "not_null": "artistid"},        \
-              {"table_name": "time", "not_null": "start_time"},         \
-              {"table_name": "songplays", "not_null": "playid"}         \
-             ]
+    table_info_dict=[{"table_name": "users", "not_null": "userid", "unique": "userid"},         \
+              {"table_name": "songs", "not_null": "songid", "unique": "songid"},            \
+              {"table_name": "artists", "not_null": "artistid", "unique": "artistid"},      \
+              {"table_name": "time", "not_null": "start_time"},                             \
+              {"table_name": "songplays", "not_null": "playid", "window_column": "start_time", \
+               "profile": ["user_id", "song_id", "level"],                                  \
+               "references": {"user_id": "users.userid", "song_id": "songs.songid",         \
+                              "artist_id": "artists.artistid", "start_time": "time.start_time"}} \
+             ],
+    filter_key=("{execution_date}", "{next_execution_date}")
+)
+
+maintenance_task = TableMaintenanceOperator(
+    task_id="Maintain_Tables",
+    dag=main_dag,
+    redshift_conn_id="redshift",
+    tables=["staging_events", "staging_songs", "songplays", "users", "songs", "artists", "time",
+            "songplays_daily_song", "songplays_daily_user", "songplays_monthly_artist"]
 )
 
 end_operator = DummyOperator(
@@ -173,14 +205,14 @@ end_operator = DummyOperator(
                     dag=main_dag
 )
 
-start_operator >> create_events_in_s3_task >> copy_events_to_s3_task >> create_songplays_in_s3_task 
-start_operator >> create_songs_in_s3_task  >> copy_songs_to_s3_task >> create_songplays_in_s3_task 
-
-create_songplays_in_s3_task >> load_songplays_in_s3_task
+start_operator >> exclusive_run_task >> bootstrap_schema_task >> [copy_events_to_s3_task, copy_songs_to_s3_task] >> check_query_plans_task
+start_operator >> convert_events_task >> copy_events_to_s3_task
+check_query_plans_task >> load_songplays_in_s3_task
 
-load_songplays_in_s3_task >> create_song_in_s3_task >> load_song_in_s3_task >> dq_check_task
-load_songplays_in_s3_task >> create_user_in_s3_task >> load_user_in_s3_task >> dq_check_task
-load_songplays_in_s3_task >> create_artist_in_s3_task >> load_artist_in_s3_task >> dq_check_task
-load_songplays_in_s3_task >> create_time_in_s3_task >> load_time_in_s3_task >> dq_check_task
+load_songplays_in_s3_task >> load_song_in_s3_task >> dq_check_task
+load_songplays_in_s3_task >> load_user_in_s3_task >> dq_check_task
+load_songplays_in_s3_task >> load_artist_in_s3_task >> dq_check_task
+load_songplays_in_s3_task >> load_time_in_s3_task >> dq_check_task
+load_songplays_in_s3_task >> update_rollups_task >> dq_check_task
 
-dq_check_task >> end_operator
+dq_check_task >> maintenance_task >> end_operator
\ No newline at end of file
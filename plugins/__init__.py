@@ -12,7 +12,15 @@ class UdacityPlugin(AirflowPlugin):
         operators.StageToRedshiftOperator,
         operators.LoadFactOperator,
         operators.LoadDimensionOperator,
-        operators.DataQualityOperator
+        operators.DataQualityOperator,
+        operators.TableMaintenanceOperator,
+        operators.SchemaBootstrapOperator,
+        operators.QueryCostGuardOperator,
+        operators.AsyncSqlOperator,
+        operators.LocalTransformOperator,
+        operators.RollupOperator,
+        operators.ConvertEventsOperator,
+        operators.ExclusiveRunSensor
     ]
     helpers = [
         helpers.SqlQueries
@@ -1,5 +1,51 @@
+import importlib
+
 from helpers.sql_queries import SqlQueries
+from helpers.table_specs import TABLE_SPECS, Column, TableSpec
+
+# Everything but SqlQueries and the table specs pulls in pandas, psycopg2 or boto3, so it is only
+# imported on first access; DAG files import this package on every parse.
+_lazy_attributes = {
+    'BulkTransfer': 'helpers.transfer',
+    'TransferResult': 'helpers.transfer',
+    'S3Object': 'helpers.s3_manifest',
+    'list_s3_objects': 'helpers.s3_manifest',
+    'split_for_slices': 'helpers.s3_manifest',
+    'build_manifest': 'helpers.s3_manifest',
+    'calendar_rows': 'helpers.time_dimension',
+    'get_redshift_hook': 'helpers.connections',
+    'get_aws_credentials': 'helpers.connections',
+    'close_pools': 'helpers.connections',
+    'Instrumentation': 'helpers.instrumentation',
+    'InstrumentedHook': 'helpers.instrumentation',
+    'instrumented_hook': 'helpers.instrumentation',
+    'split_window': 'helpers.windows',
+    'PlanBudget': 'helpers.query_plan',
+    'parse_plan': 'helpers.query_plan',
+    'summarize_plan': 'helpers.query_plan',
+    'diff_plans': 'helpers.query_plan',
+    'run_transaction': 'helpers.async_sql',
+    'run_transactions': 'helpers.async_sql',
+    'time_frame': 'helpers.time_dimension',
+    'run_local_pipeline': 'helpers.local_engine',
+    'load_postgres': 'helpers.local_engine',
+    'ROLLUPS': 'helpers.rollups',
+    'Rollup': 'helpers.rollups',
+    'convert_events': 'helpers.event_conversion',
+}
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module 'helpers' has no attribute '{name}'")
+    value = getattr(importlib.import_module(_lazy_attributes[name]), name)
+    globals()[name] = value
+    return value
+
 
 __all__ = [
     'SqlQueries',
-]
\ No newline at end of file
+    'TABLE_SPECS',
+    'Column',
+    'TableSpec',
+] + list(_lazy_attributes)
\ No newline at end of file
@@ -0,0 +1,103 @@
+import asyncio
+
+import psycopg2
+from psycopg2 import extensions
+
+
+async def wait_ready(conn, loop, deadline=None):
+    """
+    Wait until the asynchronous connection finished its current operation,
+    without blocking the event loop. Raises asyncio.TimeoutError past deadline.
+    """
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        fileno = conn.fileno()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fileno, on_ready)
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fileno, on_ready)
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state {state}")
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            if state == extensions.POLL_READ:
+                loop.remove_reader(fileno)
+            else:
+                loop.remove_writer(fileno)
+
+
+async def run_transaction(dsn, statements, timeout=None, instrumentation=None):
+    """
+    Run statements, a list of SQL strings or (sql, parameters), in one transaction
+    over their own asynchronous connection and return the rowcount of each.
+
+    Past timeout seconds the running statement is cancelled on the server and
+    TimeoutError is raised; closing the connection rolls the transaction back.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    conn = psycopg2.connect(dsn, async_=True)
+    try:
+        await wait_ready(conn, loop, deadline)
+        cursor = conn.cursor()
+        # Asynchronous connections are always in autocommit, the transaction is explicit
+        cursor.execute("BEGIN")
+        await wait_ready(conn, loop, deadline)
+        rowcounts = []
+        for statement in statements:
+            sql, parameters = statement if isinstance(statement, tuple) else (statement, None)
+            started = loop.time()
+            cursor.execute(sql, parameters)
+            try:
+                await wait_ready(conn, loop, deadline)
+            except asyncio.TimeoutError:
+                conn.cancel()
+                try:
+                    await wait_ready(conn, loop)
+                except extensions.QueryCanceledError:
+                    pass
+                raise TimeoutError(f"Cancelled after {timeout}s: {sql.strip()[:200]}")
+            rowcounts.append(cursor.rowcount)
+            if instrumentation is not None:
+                instrumentation.record_statement(sql, loop.time() - started, cursor.rowcount, len(sql))
+        cursor.execute("COMMIT")
+        await wait_ready(conn, loop, deadline)
+        return rowcounts
+    finally:
+        conn.close()
+
+
+def run_transactions(dsn, transactions, timeout=None, max_concurrency=8, instrumentation=None):
+    """
+    Run each named list of statements in transactions as its own transaction,
+    concurrently on one event loop, at most max_concurrency at a time.
+
+    :return: dict of name to the list of rowcounts, or to the exception the transaction failed with
+    """
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_one(statements):
+            async with semaphore:
+                return await run_transaction(dsn, statements, timeout, instrumentation)
+
+        names = list(transactions)
+        results = await asyncio.gather(*(run_one(transactions[name]) for name in names),
+                                       return_exceptions=True)
+        return dict(zip(names, results))
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_all())
+    finally:
+        loop.close()
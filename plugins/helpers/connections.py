@@ -0,0 +1,165 @@
+import atexit
+import threading
+import time
+
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.contrib.hooks.aws_hook import AwsHook
+
+# Per worker process state, shared by every task the process runs
+_pools = {}
+_hooks = {}
+_credentials = {}
+_lock = threading.Lock()
+
+CREDENTIALS_TTL = 600
+
+# Connection extras PostgresHook.get_conn passes to psycopg2.connect
+DSN_EXTRAS = ("sslmode", "sslcert", "sslkey", "sslrootcert", "sslcrl", "application_name", "keepalives_idle")
+
+
+class ConnectionPool:
+    """
+    Keeps idle connections made by factory around for reuse.
+    Connections idle for longer than max_idle_seconds are closed instead of reused,
+    so connections dropped by the server are not handed out.
+    """
+
+    def __init__(self, factory, max_idle=4, max_idle_seconds=300):
+        self.factory          = factory
+        self.max_idle         = max_idle
+        self.max_idle_seconds = max_idle_seconds
+        self.idle             = []
+        self.lock             = threading.Lock()
+
+    def getconn(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, released_at = self.idle.pop()
+                if not conn.closed and now - released_at < self.max_idle_seconds:
+                    return conn
+                conn.close()
+        return self.factory()
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            if not close and not conn.closed and len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.monotonic()))
+                return
+        if not conn.closed:
+            conn.close()
+
+    def closeall(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            if not conn.closed:
+                conn.close()
+
+
+class PooledConnection:
+    """
+    Wraps a pooled psycopg2 connection so that close() hands it back to the pool.
+    Any open transaction is rolled back first, so the next user starts clean.
+    """
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        try:
+            if not conn.closed:
+                conn.rollback()
+                conn.autocommit = False
+        except Exception:
+            self._pool.putconn(conn, close=True)
+        else:
+            self._pool.putconn(conn)
+
+    @property
+    def closed(self):
+        return 1 if self._conn is None else self._conn.closed
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+
+class PooledPostgresHook(PostgresHook):
+    """PostgresHook whose connections come from the worker's pool for its conn id."""
+
+    def get_conn(self):
+        pool = get_pool(self.postgres_conn_id, lambda: PostgresHook.get_conn(self))
+        return PooledConnection(pool, pool.getconn())
+
+
+def get_pool(conn_id, factory):
+    with _lock:
+        if conn_id not in _pools:
+            _pools[conn_id] = ConnectionPool(factory)
+        return _pools[conn_id]
+
+
+def get_redshift_hook(redshift_conn_id):
+    """Return the worker's pooled hook for redshift_conn_id."""
+    with _lock:
+        if redshift_conn_id not in _hooks:
+            _hooks[redshift_conn_id] = PooledPostgresHook(postgres_conn_id=redshift_conn_id)
+        return _hooks[redshift_conn_id]
+
+
+def connection_dsn(redshift_conn_id):
+    """
+    libpq DSN of the connection, with the same extras PostgresHook.get_conn passes
+    on (sslmode, sslrootcert, ...), for connections opened outside the hook.
+    """
+    from psycopg2.extensions import make_dsn
+
+    conn = get_redshift_hook(redshift_conn_id).get_connection(redshift_conn_id)
+    if conn.extra_dejson.get("iam"):
+        raise ValueError(f"{redshift_conn_id} uses IAM authentication, which needs the hook's get_conn()")
+    arguments = {"host": conn.host, "user": conn.login, "password": conn.password,
+                 "dbname": conn.schema, "port": conn.port}
+    arguments.update((name, value) for name, value in conn.extra_dejson.items() if name in DSN_EXTRAS)
+    return make_dsn(**{name: value for name, value in arguments.items() if value is not None})
+
+
+def get_aws_credentials(aws_credentials_id, ttl=CREDENTIALS_TTL):
+    """
+    Return the credentials of aws_credentials_id, resolved through AwsHook at
+    most once every ttl seconds per worker process.
+    """
+    now = time.monotonic()
+    with _lock:
+        cached = _credentials.get(aws_credentials_id)
+        if cached and cached[1] > now:
+            return cached[0]
+    credentials = AwsHook(aws_credentials_id).get_credentials()
+    with _lock:
+        _credentials[aws_credentials_id] = (credentials, now + ttl)
+    return credentials
+
+
+def close_pools():
+    """Close every idle pooled connection of this worker process."""
+    with _lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.closeall()
+
+
+atexit.register(close_pools)
@@ -0,0 +1,128 @@
+"""
+Converts raw log_data JSON lines into the Parquet files StageToRedshiftOperator
+copies with s3_format="parquet".
+
+Only the events SqlQueries reads (page='NextSong') and the staging_events
+columns its queries use are kept; the other columns are written as NULL,
+since a Parquet COPY maps the file's columns onto every column of the table
+by position. Each log file is streamed in chunks by a pool of processes and
+written to output_dir/event_date=<YYYY-MM-DD>/, one compressed file per
+input file and date with one row group per chunk. NextSong events without a
+usable ts have no event_date and no start_time to load, they are counted in
+records_without_ts and left out.
+"""
+import glob
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from helpers.local_engine import EVENT_COLUMNS, read_chunks
+from helpers.table_specs import TABLE_SPECS
+
+KEPT_PAGES = ("NextSong",)
+
+# Everything songplay_table_match_key_insert, songplay_table_insert and user_table_upsert read
+KEPT_COLUMNS = ("artist", "firstName", "gender", "lastName", "level", "location", "page", "sessionId",
+                "song", "ts", "userAgent", "userId")
+
+ARROW_TYPES = {
+    "varchar": pa.string(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+}
+
+COMPRESSIONS = ("snappy", "gzip", "zstd")
+
+
+def staging_schema():
+    """Arrow schema of staging_events, in table column order."""
+    return pa.schema([(column.name, ARROW_TYPES[column.data_type.lower()])
+                      for column in TABLE_SPECS["staging_events"].columns])
+
+
+def to_arrow(series, arrow_type):
+    if pa.types.is_string(arrow_type):
+        # Numbers such as sessionId go into VARCHAR columns as their text
+        return pa.array([None if pd.isna(value) else str(value) for value in series], type=arrow_type)
+    return pa.Array.from_pandas(pd.to_numeric(series, errors="coerce"), type=arrow_type, safe=False)
+
+
+def convert_file(args):
+    """Convert one JSON lines file, returns (records read, records kept, records without ts, bytes written)."""
+    path, index, output_dir, chunk_size, compression = args
+    schema = staging_schema()
+    writers = {}
+    read = kept = without_ts = 0
+    try:
+        for chunk in read_chunks(path, EVENT_COLUMNS, chunk_size):
+            read += len(chunk)
+            events = chunk[chunk["page"].isin(KEPT_PAGES)]
+            ts = pd.to_numeric(events["ts"], errors="coerce")
+            without_ts += int(ts.isna().sum())
+            events, ts = events[ts.notna()], ts[ts.notna()]
+            if events.empty:
+                continue
+            kept += len(events)
+            event_dates = pd.to_datetime(ts // 1000, unit="s").dt.strftime("%Y-%m-%d")
+            for event_date, rows in events.groupby(event_dates.values):
+                table = pa.Table.from_arrays(
+                    [to_arrow(rows[field.name], field.type) if field.name in KEPT_COLUMNS
+                     else pa.nulls(len(rows), type=field.type)
+                     for field in schema],
+                    schema=schema)
+                if event_date not in writers:
+                    directory = os.path.join(output_dir, "event_date={}".format(event_date))
+                    os.makedirs(directory, exist_ok=True)
+                    writers[event_date] = pq.ParquetWriter(
+                        os.path.join(directory, "part-{}.parquet".format(index)), schema, compression=compression)
+                writers[event_date].write_table(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    written = sum(os.path.getsize(os.path.join(output_dir, "event_date={}".format(event_date),
+                                               "part-{}.parquet".format(index)))
+                  for event_date in writers)
+    return read, kept, without_ts, written
+
+
+def convert_events(paths, output_dir, workers=None, chunk_size=100000, compression="snappy", log=None):
+    """
+    Convert paths (local JSON lines log files) into output_dir, replacing what
+    a previous conversion left there.
+
+    :param workers: Processes, None for one per core
+    :param chunk_size: Records read and filtered at a time per process
+    :param compression: Parquet compression codec, snappy, gzip or zstd
+    :return: dict with the files, records and bytes read and written
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {COMPRESSIONS}")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(convert_file, [(path, index, output_dir, chunk_size, compression)
+                                                   for index, path in enumerate(paths)]))
+    stats = {
+        "input_files": len(paths),
+        "input_bytes": sum(os.path.getsize(path) for path in paths),
+        "records_read": sum(read for read, _, _, _ in results),
+        "records_kept": sum(kept for _, kept, _, _ in results),
+        "records_without_ts": sum(without_ts for _, _, without_ts, _ in results),
+        "output_files": len(glob.glob(os.path.join(output_dir, "event_date=*", "*.parquet"))),
+        "output_bytes": sum(written for _, _, _, written in results),
+    }
+    if log:
+        log.info(f"Kept {stats['records_kept']} of {stats['records_read']} events, "
+                 f"{stats['input_bytes']} JSON bytes became {stats['output_bytes']} Parquet bytes "
+                 f"in {stats['output_files']} files in {time.monotonic() - started:.2f}s")
+        if stats["records_without_ts"]:
+            log.warning(f"Left out {stats['records_without_ts']} NextSong events without a usable ts")
+    return stats
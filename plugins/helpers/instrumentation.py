@@ -0,0 +1,325 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from airflow.settings import Stats
+
+# COPY / UNLOAD credential clauses, the recorded statements end up in XCom
+CREDENTIALS_PATTERN = re.compile(r"\b(ACCESS_KEY_ID|SECRET_ACCESS_KEY|SESSION_TOKEN|CREDENTIALS)(\s+(?:AS\s+)?)'[^']*'",
+                                 re.IGNORECASE)
+
+# Table a DML statement or COPY changes, e.g. INSERT INTO songplays
+DML_TARGET_PATTERN = re.compile(r'^\s*(INSERT\s+INTO|COPY|DELETE\s+FROM|DELETE|UPDATE)\s+([\w."]+)', re.IGNORECASE)
+
+# Temporary and intermediate tables the operators build a load in, e.g. users_upsert_stage
+STAGE_TABLE_PATTERN = re.compile(r"_stage(_|$)")
+
+
+def redact(sql):
+    """sql with the values of its credential clauses replaced by ***."""
+    return CREDENTIALS_PATTERN.sub(r"\1\2'***'", sql)
+
+
+class StatementStats:
+    """Latency and volume of one executed statement."""
+
+    def __init__(self, sql, seconds, rows, bytes_sent, query_id=None):
+        self.sql        = sql
+        self.seconds    = seconds
+        self.rows       = rows
+        self.bytes_sent = bytes_sent
+        self.query_id   = query_id
+        self.plan       = None
+
+    def as_dict(self):
+        return {"sql": self.sql[:500], "seconds": round(self.seconds, 4), "rows": self.rows,
+                "bytes_sent": self.bytes_sent, "query_id": self.query_id, "plan": self.plan}
+
+
+class Instrumentation:
+    """
+    Collects per-statement latency, rows fetched, written (INSERT and COPY),
+    deleted and updated, bytes sent and phase timings (query, fetch, transform,
+    write, commit) of one task run. Rows moved through the operators' _stage
+    tables are not counted, only their effect on the target tables.
+
+    emit() sends the totals to StatsD under sparkify.<task_id>.* and pushes a
+    structured summary to XCom under the "metrics" key.
+    With capture_slowest > 0 the Redshift query id (pg_last_query_id()) of each
+    statement is recorded and the slowest statements get an EXPLAIN plan, so
+    they can be matched with STL_QUERY / SVL_QUERY_SUMMARY.
+    """
+
+    write_verbs = ("INSERT", "UPDATE", "DELETE", "COPY", "CREATE", "DROP", "TRUNCATE", "ALTER", "VACUUM", "ANALYZE")
+
+    def __init__(self, task_id, capture_slowest=0, log=None):
+        self.task_id         = task_id
+        self.capture_slowest = capture_slowest
+        self.log             = log
+        self.phases          = {}
+        self.statements      = []
+        self.rows_fetched    = 0
+        self.rows_written    = 0
+        self.rows_deleted    = 0
+        self.rows_updated    = 0
+        self.bytes_sent      = 0
+        self.started         = time.monotonic()
+        self.lock            = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - started)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def record_statement(self, sql, seconds, rows, bytes_sent, query_id=None):
+        sql = redact(sql)
+        is_write = sql.lstrip().upper().startswith(Instrumentation.write_verbs)
+        counter = self.row_counter(sql)
+        with self.lock:
+            self.statements.append(StatementStats(sql, seconds, rows, bytes_sent, query_id))
+            self.bytes_sent += bytes_sent
+            if counter and rows > 0:
+                setattr(self, counter, getattr(self, counter) + rows)
+        self.add_phase("write" if is_write else "query", seconds)
+
+    @staticmethod
+    def row_counter(sql):
+        """rows_written, rows_deleted, rows_updated or None, the counter sql's rowcount adds to."""
+        match = DML_TARGET_PATTERN.match(sql)
+        if not match or STAGE_TABLE_PATTERN.search(match.group(2).strip('"').lower()):
+            return None
+        verb = match.group(1).split()[0].upper()
+        return {"INSERT": "rows_written", "COPY": "rows_written",
+                "DELETE": "rows_deleted", "UPDATE": "rows_updated"}[verb]
+
+    def record_fetch(self, rows, seconds):
+        with self.lock:
+            self.rows_fetched += rows
+        self.add_phase("fetch", seconds)
+
+    def slowest(self):
+        return sorted(self.statements, key=lambda s: s.seconds, reverse=True)[:self.capture_slowest]
+
+    def explain_slowest(self, hook):
+        """Attach EXPLAIN output to the slowest statements, over a fresh connection."""
+        conn = hook.get_conn()
+        try:
+            cursor = conn.cursor()
+            for statement in self.slowest():
+                if not statement.sql.lstrip().upper().startswith(("SELECT", "INSERT", "WITH", "DELETE", "UPDATE")):
+                    continue
+                try:
+                    cursor.execute("EXPLAIN " + statement.sql)
+                    statement.plan = "\n".join(row[0] for row in cursor.fetchall())
+                except Exception as e:
+                    conn.rollback()
+                    statement.plan = f"EXPLAIN failed: {e}"
+        finally:
+            conn.close()
+
+    def summary(self):
+        return {
+            "task_id": self.task_id,
+            "seconds": round(time.monotonic() - self.started, 4),
+            "statements": len(self.statements),
+            "rows_fetched": self.rows_fetched,
+            "rows_written": self.rows_written,
+            "rows_deleted": self.rows_deleted,
+            "rows_updated": self.rows_updated,
+            "bytes_sent": self.bytes_sent,
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "slowest": [statement.as_dict() for statement in self.slowest()],
+        }
+
+    def emit(self, context, hook=None):
+        if self.capture_slowest and hook is not None:
+            self.explain_slowest(hook)
+        summary = self.summary()
+        prefix = "sparkify.{}".format(self.task_id)
+        for name, seconds in summary["phases"].items():
+            Stats.timing(f"{prefix}.{name}_ms", seconds * 1000)
+        Stats.timing(f"{prefix}.total_ms", summary["seconds"] * 1000)
+        Stats.incr(f"{prefix}.statements", summary["statements"])
+        Stats.incr(f"{prefix}.rows_fetched", summary["rows_fetched"])
+        Stats.incr(f"{prefix}.rows_written", summary["rows_written"])
+        Stats.incr(f"{prefix}.rows_deleted", summary["rows_deleted"])
+        Stats.incr(f"{prefix}.rows_updated", summary["rows_updated"])
+        Stats.incr(f"{prefix}.bytes_sent", summary["bytes_sent"])
+        if context and context.get("ti"):
+            context["ti"].xcom_push(key="metrics", value=summary)
+        if self.log:
+            self.log.info(f"Metrics: {summary['statements']} statements, {summary['rows_fetched']} rows fetched, "
+                          f"{summary['rows_written']} rows written, {summary['rows_deleted']} deleted, "
+                          f"{summary['rows_updated']} updated, {summary['bytes_sent']} bytes sent, "
+                          f"phases {summary['phases']}")
+        return summary
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times statements and fetches into an Instrumentation."""
+
+    def __init__(self, cursor, instrumentation):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+
+    def execute(self, sql, parameters=None):
+        started = time.monotonic()
+        self._cursor.execute(sql, parameters)
+        seconds = time.monotonic() - started
+        query = self._cursor.query if self._cursor.query is not None else sql
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        self._instrumentation.record_statement(query, seconds, self._cursor.rowcount, len(query),
+                                               self.last_query_id())
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.monotonic()
+        self._cursor.copy_expert(sql, file, size)
+        bytes_sent = file.tell() if hasattr(file, "tell") else 0
+        self._instrumentation.record_statement(sql, time.monotonic() - started, self._cursor.rowcount,
+                                               bytes_sent, self.last_query_id())
+
+    def last_query_id(self):
+        # Asked on a separate cursor so rowcount and results of this one stay intact;
+        # pg_last_query_id() only exists on Redshift
+        if not self._instrumentation.capture_slowest:
+            return None
+        with self._cursor.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_last_query_id()")
+            return cursor.fetchone()[0]
+
+    def fetch(self, method, *args):
+        started = time.monotonic()
+        result = method(*args)
+        rows = 0 if result is None else (len(result) if isinstance(result, list) else 1)
+        self._instrumentation.record_fetch(rows, time.monotonic() - started)
+        return result
+
+    def fetchone(self):
+        return self.fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self.fetch(self._cursor.fetchmany, *([] if size is None else [size]))
+
+    def fetchall(self):
+        return self.fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+
+class InstrumentedConnection:
+    """Connection proxy handing out InstrumentedCursors and timing commits."""
+
+    def __init__(self, conn, instrumentation):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_instrumentation", instrumentation)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._instrumentation)
+
+    def commit(self):
+        with self._instrumentation.phase("commit"):
+            self._conn.commit()
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+
+class InstrumentedHook:
+    """
+    Wraps the PostgresHook calls the operators use (get_conn, get_records,
+    get_first, run) so every statement goes through an Instrumentation.
+    """
+
+    def __init__(self, hook, instrumentation):
+        self.hook            = hook
+        self.instrumentation = instrumentation
+
+    def get_conn(self):
+        return InstrumentedConnection(self.hook.get_conn(), self.instrumentation)
+
+    def get_records(self, sql, parameters=None):
+        conn = self.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, parameters)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def get_first(self, sql, parameters=None):
+        conn = self.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, parameters)
+            return cursor.fetchone()
+        finally:
+            conn.close()
+
+    def emit(self, context):
+        # Called from the operators' finally blocks, a metrics failure must not replace the task's own error
+        try:
+            return self.instrumentation.emit(context, self.hook)
+        except Exception as e:
+            if self.instrumentation.log:
+                self.instrumentation.log.warning(f"Could not emit metrics: {e}")
+            return None
+
+    def run(self, sql, autocommit=False, parameters=None):
+        if isinstance(sql, str):
+            sql = [sql]
+        conn = self.get_conn()
+        try:
+            conn.autocommit = autocommit
+            cursor = conn.cursor()
+            for statement in sql:
+                cursor.execute(statement, parameters)
+            if not autocommit:
+                conn.commit()
+        finally:
+            conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self.hook, name)
+
+
+def instrumented_hook(redshift_conn_id, task_id, capture_slowest=0, log=None):
+    """Return the worker's pooled hook for redshift_conn_id wrapped in a fresh Instrumentation."""
+    from helpers.connections import get_redshift_hook
+
+    return InstrumentedHook(get_redshift_hook(redshift_conn_id),
+                            Instrumentation(task_id, capture_slowest, log))
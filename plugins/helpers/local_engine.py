@@ -0,0 +1,226 @@
+"""
+Runs the Sparkify transformations on local log_data / song_data JSON files,
+without a Redshift cluster, and writes the warehouse tables as Parquet.
+
+The files are read in chunks of chunk_size records by a pool of processes, so
+neither the input nor the output has to fit in memory:
+
+1. Songs: every song_data chunk yields its songs and artists rows and its part
+   of the (title, artist_name) -> (song_id, artist_id) lookup of the join.
+2. Events: every worker loads the lookup once (like a broadcast hash join, the
+   song catalogue has to fit in memory), then per log_data chunk keeps the
+   NextSong events, converts ts to start_time and joins on song/artist. The
+   songplays rows go straight to Parquet.
+3. The dimensions' DISTINCT: partial rows are written to hash buckets on their
+   key, so every bucket is deduplicated on its own. users keeps the latest
+   event's row of each user, like the upsert of user_table_upsert.
+
+The results follow SqlQueries: the same columns, an inner join on song/artist,
+start_time truncated to the second like ts/1000 and weekday 0 for Sunday.
+load_postgres() copies the Parquet output into local PostgreSQL tables.
+"""
+import glob
+import io
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from helpers.time_dimension import time_frame
+
+EVENT_COLUMNS = ["artist", "auth", "firstName", "gender", "itemInSession", "lastName", "length", "level",
+                 "location", "method", "page", "registration", "sessionId", "song", "status", "ts",
+                 "userAgent", "userId"]
+
+SONG_COLUMNS = ["num_songs", "artist_id", "artist_name", "artist_latitude", "artist_longitude",
+                "artist_location", "song_id", "title", "duration", "year"]
+
+TABLE_COLUMNS = {
+    "songplays": ["start_time", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent"],
+    "users": ["userid", "first_name", "last_name", "gender", "level"],
+    "songs": ["songid", "title", "artistid", "year", "duration"],
+    "artists": ["artistid", "name", "location", "lattitude", "longitude"],
+    "time": ["start_time", "hour", "day", "week", "month", "year", "weekday"],
+}
+
+# Column the partial rows of each dimension are bucketed on
+BUCKET_KEYS = {"users": "userid", "songs": "songid", "artists": "artistid", "time": "start_time"}
+
+_lookup = None
+
+
+def read_chunks(path, columns, chunk_size):
+    """Yield DataFrames of at most chunk_size JSON lines of path, with exactly columns."""
+    reader = pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False, convert_dates=False)
+    for chunk in reader:
+        yield chunk.reindex(columns=columns)
+
+
+def write_buckets(frame, table_name, work_dir, tag, buckets):
+    """Write frame to its hash buckets under work_dir/table_name/bucket=<n>/part-<tag>.parquet."""
+    if frame.empty:
+        return
+    hashes = pd.util.hash_pandas_object(frame[BUCKET_KEYS[table_name]], index=False) % buckets
+    for bucket, rows in frame.groupby(hashes.values):
+        directory = os.path.join(work_dir, table_name, "bucket={}".format(bucket))
+        os.makedirs(directory, exist_ok=True)
+        rows.to_parquet(os.path.join(directory, "part-{}.parquet".format(tag)), index=False)
+
+
+def transform_song_file(args):
+    path, index, work_dir, chunk_size, buckets = args
+    rows = 0
+    for number, chunk in enumerate(read_chunks(path, SONG_COLUMNS, chunk_size)):
+        tag = "{}-{}".format(index, number)
+        songs = chunk[["song_id", "title", "artist_id", "year", "duration"]].drop_duplicates()
+        songs.columns = TABLE_COLUMNS["songs"]
+        write_buckets(songs, "songs", work_dir, tag, buckets)
+        artists = chunk[["artist_id", "artist_name", "artist_location", "artist_latitude",
+                         "artist_longitude"]].drop_duplicates()
+        artists.columns = TABLE_COLUMNS["artists"]
+        write_buckets(artists, "artists", work_dir, tag, buckets)
+        # Duplicates stay, the SQL join matches every staging_songs row
+        lookup_dir = os.path.join(work_dir, "song_lookup")
+        os.makedirs(lookup_dir, exist_ok=True)
+        chunk[["title", "artist_name", "song_id", "artist_id"]].to_parquet(
+            os.path.join(lookup_dir, "part-{}.parquet".format(tag)), index=False)
+        rows += len(chunk)
+    return rows
+
+
+def load_lookup(lookup_dir):
+    """Process pool initializer: load the song lookup once per worker."""
+    global _lookup
+    paths = sorted(glob.glob(os.path.join(lookup_dir, "*.parquet")))
+    _lookup = (pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True) if paths
+               else pd.DataFrame(columns=["title", "artist_name", "song_id", "artist_id"]))
+    _lookup = _lookup.dropna(subset=["title", "artist_name"])
+
+
+def transform_event_file(args):
+    path, index, work_dir, output_dir, chunk_size, buckets = args
+    songplays_dir = os.path.join(output_dir, "songplays")
+    rows = 0
+    for number, chunk in enumerate(read_chunks(path, EVENT_COLUMNS, chunk_size)):
+        tag = "{}-{}".format(index, number)
+        events = chunk[chunk["page"] == "NextSong"]
+        if events.empty:
+            continue
+        # TIMESTAMP 'epoch' + ts/1000 * interval '1 second', ts/1000 is an integer division
+        events = events.assign(
+            start_time=pd.to_datetime(events["ts"].astype("int64") // 1000, unit="s"),
+            userId=pd.to_numeric(events["userId"], errors="coerce").astype("Int64"),
+            sessionId=pd.to_numeric(events["sessionId"], errors="coerce").astype("Int64"))
+
+        users = events[["userId", "firstName", "lastName", "gender", "level", "ts"]].dropna(subset=["userId"])
+        users = users.assign(ts=users["ts"].astype("int64"))
+        users.columns = TABLE_COLUMNS["users"] + ["ts"]
+        write_buckets(users, "users", work_dir, tag, buckets)
+
+        # pandas matches NaN keys to each other, SQL's = never matches NULL
+        songplays = events.dropna(subset=["song", "artist"]).merge(
+            _lookup, left_on=["song", "artist"], right_on=["title", "artist_name"], how="inner")
+        songplays = songplays[["start_time", "userId", "level", "song_id", "artist_id", "sessionId",
+                               "location", "userAgent"]]
+        songplays.columns = TABLE_COLUMNS["songplays"]
+        if songplays.empty:
+            continue
+        songplays.to_parquet(os.path.join(songplays_dir, "part-{}.parquet".format(tag)), index=False)
+        write_buckets(time_frame(songplays["start_time"].drop_duplicates()), "time", work_dir, tag, buckets)
+        rows += len(songplays)
+    return rows
+
+
+def distinct_bucket(args):
+    table_name, bucket_dir, output_dir = args
+    paths = sorted(glob.glob(os.path.join(bucket_dir, "*.parquet")))
+    frame = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+    if table_name == "users":
+        # Stable sort, of rows with the same ts the one read last wins
+        frame = frame.sort_values("ts", kind="mergesort").drop_duplicates("userid", keep="last").drop(columns="ts")
+    frame = frame.drop_duplicates()
+    frame.to_parquet(os.path.join(output_dir, table_name, "{}.parquet".format(os.path.basename(bucket_dir))),
+                     index=False)
+    return len(frame)
+
+
+def run_local_pipeline(log_files, song_files, output_dir, workers=None, chunk_size=100000, buckets=16,
+                       log=None):
+    """
+    Transform log_files and song_files (lists of JSON lines files) into
+    output_dir/<table>/*.parquet, one directory per warehouse table.
+
+    :param workers: Processes, None for one per core
+    :param chunk_size: Records read and transformed at a time per process
+    :param buckets: Hash buckets of the dimensions' DISTINCT, more buckets means
+                    less memory per bucket
+    :return: dict of table name to the number of rows written
+    """
+    work_dir = os.path.join(output_dir, "_work")
+    for name in list(TABLE_COLUMNS) + ["_work"]:
+        shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+    for name in TABLE_COLUMNS:
+        os.makedirs(os.path.join(output_dir, name))
+    os.makedirs(work_dir)
+
+    counts = {}
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(transform_song_file,
+                          [(path, index, work_dir, chunk_size, buckets) for index, path in enumerate(song_files)]))
+    if log:
+        log.info(f"Transformed {len(song_files)} song files in {time.monotonic() - started:.2f}s")
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_lookup,
+                             initargs=(os.path.join(work_dir, "song_lookup"),)) as executor:
+        counts["songplays"] = sum(executor.map(
+            transform_event_file,
+            [(path, index, work_dir, output_dir, chunk_size, buckets) for index, path in enumerate(log_files)]))
+    if log:
+        log.info(f"Transformed {len(log_files)} log files into {counts['songplays']} songplays "
+                 f"in {time.monotonic() - started:.2f}s")
+
+    started = time.monotonic()
+    jobs = [(table_name, bucket_dir, output_dir)
+            for table_name in BUCKET_KEYS
+            for bucket_dir in sorted(glob.glob(os.path.join(work_dir, table_name, "bucket=*")))]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for (table_name, _, _), rows in zip(jobs, executor.map(distinct_bucket, jobs)):
+            counts[table_name] = counts.get(table_name, 0) + rows
+    shutil.rmtree(work_dir)
+    if log:
+        log.info(f"Deduplicated the dimensions in {time.monotonic() - started:.2f}s: {counts}")
+    return counts
+
+
+def load_postgres(conn, output_dir, truncate=True, log=None):
+    """
+    COPY the Parquet output of run_local_pipeline into the tables of conn,
+    one file at a time, all in one transaction.
+    songplays.playid is left to the table's identity / serial default.
+    """
+    from helpers.transfer import encode_copy_value
+
+    cursor = conn.cursor()
+    counts = {}
+    for table_name, columns in TABLE_COLUMNS.items():
+        if truncate:
+            cursor.execute("TRUNCATE {}".format(table_name))
+        copy_sql = "COPY {} ({}) FROM STDIN".format(table_name, ", ".join(columns))
+        counts[table_name] = 0
+        for path in sorted(glob.glob(os.path.join(output_dir, table_name, "*.parquet"))):
+            frame = pd.read_parquet(path)
+            buffer = io.StringIO()
+            for row in frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None):
+                buffer.write("\t".join(encode_copy_value(value) for value in row))
+                buffer.write("\n")
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            counts[table_name] += len(frame)
+        if log:
+            log.info(f"Loaded {counts[table_name]} rows into {table_name}")
+    conn.commit()
+    return counts
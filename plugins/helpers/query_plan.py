@@ -0,0 +1,129 @@
+import difflib
+import re
+
+# Redshift join distribution steps, from cheapest to most expensive
+DISTRIBUTION_STEPS = ("DS_DIST_NONE", "DS_DIST_ALL_NONE", "DS_DIST_INNER", "DS_DIST_OUTER",
+                      "DS_DIST_ALL_INNER", "DS_BCAST_INNER", "DS_DIST_BOTH")
+
+NODE_PATTERN = re.compile(
+    r"^(?P<indent>\s*)(?:->\s+)?(?P<operation>.+?)\s+"
+    r"\(cost=(?P<startup>[\d.]+)\.\.(?P<total>[\d.]+) rows=(?P<rows>\d+) width=(?P<width>\d+)\)")
+
+
+class PlanNode:
+    """One operation of an EXPLAIN plan with its estimates and child operations."""
+
+    def __init__(self, operation, startup_cost, total_cost, rows, width, indent):
+        self.operation    = operation
+        self.startup_cost = startup_cost
+        self.total_cost   = total_cost
+        self.rows         = rows
+        self.width        = width
+        self.indent       = indent
+        self.details      = []
+        self.children     = []
+
+    @property
+    def distribution_step(self):
+        for step in DISTRIBUTION_STEPS:
+            if step in self.operation.split():
+                return step
+        return None
+
+    @property
+    def is_nested_loop(self):
+        return "Nested Loop" in self.operation
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def as_dict(self):
+        return {"operation": self.operation, "startup_cost": self.startup_cost, "total_cost": self.total_cost,
+                "rows": self.rows, "width": self.width, "details": self.details,
+                "children": [child.as_dict() for child in self.children]}
+
+
+def parse_plan(lines):
+    """
+    Parse the text output of EXPLAIN (one row per line, Redshift or PostgreSQL)
+    into a tree of PlanNodes and return its root. Lines without cost estimates
+    (Hash Cond, Filter, ...) become details of the operation above them.
+    """
+    root = None
+    stack = []
+    for line in lines:
+        match = NODE_PATTERN.match(line)
+        if not match:
+            if stack and line.strip():
+                stack[-1].details.append(line.strip())
+            continue
+        node = PlanNode(match.group("operation").strip(),
+                        float(match.group("startup")),
+                        float(match.group("total")),
+                        int(match.group("rows")),
+                        int(match.group("width")),
+                        len(match.group("indent")))
+        while stack and stack[-1].indent >= node.indent:
+            stack.pop()
+        if stack:
+            stack[-1].children.append(node)
+        elif root is None:
+            root = node
+        else:
+            # An InitPlan or similar at the top level, keep it under the root
+            root.children.append(node)
+        stack.append(node)
+    if root is None:
+        raise ValueError("No plan operations found in the EXPLAIN output")
+    return root
+
+
+def summarize_plan(root):
+    """Total estimated cost and rows plus the distribution steps and nested loops of the plan."""
+    steps = {}
+    nested_loops = 0
+    for node in root.walk():
+        if node.distribution_step:
+            steps[node.distribution_step] = steps.get(node.distribution_step, 0) + 1
+        nested_loops += node.is_nested_loop
+    return {"total_cost": root.total_cost, "rows": root.rows,
+            "distribution_steps": steps, "nested_loops": nested_loops}
+
+
+class PlanBudget:
+    """Limits a query plan has to stay within."""
+
+    def __init__(self, max_cost=None, max_rows=None, forbidden_steps=("DS_BCAST_INNER", "DS_DIST_BOTH"),
+                 allow_nested_loops=False):
+        """
+        :param max_cost: Highest allowed estimated total cost, None for no limit
+        :param max_rows: Highest allowed estimated result rows, None for no limit
+        :param forbidden_steps: Join distribution steps the plan must not contain
+        :param allow_nested_loops: Accept nested loop joins
+        """
+        self.max_cost           = max_cost
+        self.max_rows           = max_rows
+        self.forbidden_steps    = tuple(forbidden_steps)
+        self.allow_nested_loops = allow_nested_loops
+
+    def violations(self, root):
+        summary = summarize_plan(root)
+        violations = []
+        if self.max_cost is not None and summary["total_cost"] > self.max_cost:
+            violations.append(f"estimated cost {summary['total_cost']:.0f} exceeds {self.max_cost:.0f}")
+        if self.max_rows is not None and summary["rows"] > self.max_rows:
+            violations.append(f"estimated rows {summary['rows']} exceed {self.max_rows}")
+        for step in self.forbidden_steps:
+            if step in summary["distribution_steps"]:
+                violations.append(f"{summary['distribution_steps'][step]} join(s) with {step}")
+        if summary["nested_loops"] and not self.allow_nested_loops:
+            violations.append(f"{summary['nested_loops']} nested loop join(s)")
+        return violations
+
+
+def diff_plans(previous, current, name="plan"):
+    """Unified diff of two EXPLAIN texts, empty when they are the same."""
+    return "\n".join(difflib.unified_diff(previous.splitlines(), current.splitlines(),
+                                          f"{name} (previous)", f"{name} (current)", lineterm=""))
@@ -0,0 +1,179 @@
+"""
+Pre-aggregated rollups of the fact table for the dashboards.
+
+A Rollup groups songplays by a period (day or month) and some of its
+columns. RollupOperator keeps it current one filter_key window at a time:
+the window is aggregated into a temporary table and merged into the rollup,
+adding counts and taking the lower / higher of MIN and MAX measures, so no run
+reads more of songplays than its own window.
+
+A merge is not idempotent. Windows already merged before (re-runs, a backfill
+over loaded months) are recorded in rollup_window and instead rebuild every
+period they touch from songplays.
+"""
+from helpers.table_specs import TABLE_SPECS, Column, TableSpec
+from helpers.windows import next_boundary, parse_timestamp
+
+ROLLUP_GRAINS = ("day", "month")
+
+MERGE_FUNCTIONS = {
+    "sum": "{target} + {stage}",
+    "min": "LEAST({target}, {stage})",
+    "max": "GREATEST({target}, {stage})",
+}
+
+
+class Rollup:
+
+    aggregate_sql = """
+        SELECT DATE_TRUNC('{grain}', {time_column}) AS period_start, {dimensions}, {measures}
+        FROM {source}
+        WHERE {time_column} >= %s AND {time_column} < %s
+        GROUP BY {group_by}
+    """
+
+    stage_sql = "CREATE TEMP TABLE {stage} AS {aggregate}"
+
+    update_sql = """
+        UPDATE {target}
+        SET {assignments}
+        FROM {stage} stage
+        WHERE {matches}
+    """
+
+    insert_sql = """
+        INSERT INTO {target} ({columns})
+        SELECT {stage_columns}
+        FROM {stage} stage
+        LEFT JOIN {target} existing
+        ON {existing_matches}
+        WHERE existing.period_start IS NULL
+    """
+
+    delete_sql = "DELETE FROM {target} WHERE period_start >= %s AND period_start < %s"
+
+    rebuild_sql = "INSERT INTO {target} ({columns}) {aggregate}"
+
+    def __init__(self, name, grain, dimensions, measures, source="songplays", time_column="start_time",
+                 diststyle="AUTO", distkey=None):
+        """
+        :param name: Rollup table name
+        :param grain: day or month, the period rows are aggregated to
+        :param dimensions: Columns of source the rollup groups by
+        :param measures: list of (name, data type, aggregate expression, merge) where merge is
+                         sum, min or max, how a window's value combines with the stored one
+        :param source: Fact table aggregated
+        :param time_column: Timestamp column of source the period and the windows are taken from
+        :param diststyle: Distribution style of the rollup table
+        :param distkey: Distribution key of the rollup table, for diststyle KEY
+        """
+        if grain not in ROLLUP_GRAINS:
+            raise ValueError(f"Unknown grain {grain}, expected one of {ROLLUP_GRAINS}")
+        for measure_name, _, _, merge in measures:
+            if merge not in MERGE_FUNCTIONS:
+                raise ValueError(f"Unknown merge {merge} of {name}.{measure_name}, "
+                                 f"expected one of {tuple(MERGE_FUNCTIONS)}")
+        self.name        = name
+        self.grain       = grain
+        self.dimensions  = tuple(dimensions)
+        self.measures    = measures
+        self.source      = source
+        self.time_column = time_column
+        source_spec = TABLE_SPECS[source]
+        self.spec = TableSpec(name, [Column("period_start", "timestamp", not_null=True, encode="raw")] +
+                              [Column(dimension, source_spec.column(dimension).data_type,
+                                      not_null=source_spec.column(dimension).not_null,
+                                      encode=source_spec.column(dimension).encode)
+                               for dimension in self.dimensions] +
+                              [Column(measure_name, data_type, encode="az64")
+                               for measure_name, data_type, _, _ in measures],
+                              diststyle=diststyle, distkey=distkey, sortkey=("period_start",) + self.dimensions)
+
+    @property
+    def key_columns(self):
+        return ("period_start",) + self.dimensions
+
+    @property
+    def columns(self):
+        return self.spec.identifiers(column.name for column in self.spec.columns)
+
+    def aggregate(self):
+        """Aggregate of songplays' [%s, %s) window into rollup rows."""
+        source = TABLE_SPECS[self.source]
+        return Rollup.aggregate_sql.format(
+            grain=self.grain,
+            time_column=self.time_column,
+            dimensions=source.identifiers(self.dimensions),
+            measures=", ".join(f"{expression} AS {name}" for name, _, expression, _ in self.measures),
+            source=self.source,
+            group_by=", ".join(str(position) for position in range(1, len(self.key_columns) + 1)))
+
+    def matches(self, left, right):
+        # NULL groups (e.g. no level) still have to meet. Plain equalities, not ORs, keep it a hash join.
+        conditions = []
+        for name in self.key_columns:
+            column = self.spec.column(name)
+            if column.not_null:
+                conditions.append(f"{left}.{column.identifier} = {right}.{column.identifier}")
+            else:
+                sentinel = "''" if "char" in column.data_type.lower() else "-1"
+                conditions.append(f"COALESCE({left}.{column.identifier}, {sentinel}) = "
+                                  f"COALESCE({right}.{column.identifier}, {sentinel})")
+        return " AND ".join(conditions)
+
+    def stage_statement(self, stage):
+        """Aggregate the window into the temporary table stage, parameters (start, end)."""
+        return Rollup.stage_sql.format(stage=stage, aggregate=self.aggregate())
+
+    def merge_statements(self, stage):
+        """Merge the rows of stage into the rollup: update the periods it has, insert the others."""
+        target = self.spec.qualified_name
+        assignments = ", ".join(
+            "{0} = {1}".format(name, MERGE_FUNCTIONS[merge].format(target=f"{target}.{name}", stage=f"stage.{name}"))
+            for name, _, _, merge in self.measures)
+        return [
+            Rollup.update_sql.format(target=target, assignments=assignments, stage=stage,
+                                     matches=self.matches(target, "stage")),
+            Rollup.insert_sql.format(target=target, columns=self.columns, stage=stage,
+                                     stage_columns=", ".join(f"stage.{self.spec.column(column.name).identifier}"
+                                                             for column in self.spec.columns),
+                                     existing_matches=self.matches("existing", "stage")),
+        ]
+
+    def rebuild_statements(self):
+        """Recompute whole periods from the source, both take period_range() as parameters."""
+        target = self.spec.qualified_name
+        return [
+            Rollup.delete_sql.format(target=target),
+            Rollup.rebuild_sql.format(target=target, columns=self.columns, aggregate=self.aggregate()),
+        ]
+
+    def period_range(self, start, end):
+        """The [start, end) window widened to the whole periods it touches."""
+        start, end = parse_timestamp(start), parse_timestamp(end)
+        first = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.grain == "month":
+            first = first.replace(day=1)
+        last = first
+        while last < end:
+            last = next_boundary(last, self.grain)
+        return first, last
+
+
+# Each a few thousand rows per period instead of every play
+ROLLUPS = {rollup.name: rollup for rollup in [
+    Rollup("songplays_daily_song", "day", ["song_id", "artist_id", "level"], [
+        ("plays", "int8", "COUNT(*)", "sum"),
+        ("last_play", "timestamp", "MAX(start_time)", "max"),
+    ], diststyle="KEY", distkey="song_id"),
+
+    Rollup("songplays_daily_user", "day", ["user_id", "level"], [
+        ("plays", "int8", "COUNT(*)", "sum"),
+        ("first_play", "timestamp", "MIN(start_time)", "min"),
+        ("last_play", "timestamp", "MAX(start_time)", "max"),
+    ]),
+
+    Rollup("songplays_monthly_artist", "month", ["artist_id", "level"], [
+        ("plays", "int8", "COUNT(*)", "sum"),
+    ], diststyle="ALL"),
+]}
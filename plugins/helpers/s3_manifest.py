@@ -0,0 +1,82 @@
+import json
+import math
+
+
+class S3Object:
+    """Key, size and ETag of an object found under an S3 prefix."""
+
+    def __init__(self, key, size, etag):
+        self.key  = key
+        self.size = size
+        self.etag = etag
+
+    def __repr__(self):
+        return "S3Object(key={!r}, size={}, etag={!r})".format(self.key, self.size, self.etag)
+
+
+def list_s3_objects(s3_client, bucket, prefix):
+    """
+    List every object under prefix with a boto3 S3 client.
+    Any S3 compatible endpoint works, e.g. a client created with
+    endpoint_url pointing at a local moto or MinIO server.
+
+    :param s3_client: boto3 S3 client
+    :param bucket: Name of the S3 Bucket
+    :param prefix: Key prefix to list
+    :return: list of S3Object, folder placeholder keys are skipped
+    """
+    objects = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for entry in page.get("Contents", []):
+            if entry["Key"].endswith("/"):
+                continue
+            objects.append(S3Object(entry["Key"], entry["Size"], entry["ETag"].strip('"')))
+    return objects
+
+
+def split_for_slices(objects, num_slices, max_files_per_copy=None):
+    """
+    Split objects into groups that each become one COPY manifest.
+
+    Every group but the last holds the same multiple of num_slices files, so
+    every slice of the cluster gets work, the last one holds the rest. Files
+    are spread over the groups largest first to keep their byte totals even.
+
+    :param objects: list of S3Object
+    :param num_slices: Number of slices in the cluster
+    :param max_files_per_copy: Upper bound of files per manifest, None for a single manifest
+    :return: list of lists of S3Object
+    """
+    if not objects:
+        return []
+    num_slices = max(1, num_slices)
+    if not max_files_per_copy or max_files_per_copy >= len(objects):
+        return [list(objects)]
+
+    per_copy = max(num_slices, max_files_per_copy - max_files_per_copy % num_slices)
+    num_groups = int(math.ceil(len(objects) / float(per_copy)))
+    # The file counts are fixed up front, only which files go where follows the sizes
+    capacities = [per_copy] * (num_groups - 1) + [len(objects) - per_copy * (num_groups - 1)]
+    groups = [[] for _ in range(num_groups)]
+    sizes = [0] * num_groups
+    for s3_object in sorted(objects, key=lambda o: o.size, reverse=True):
+        candidates = [i for i in range(num_groups) if len(groups[i]) < capacities[i]]
+        target = min(candidates, key=lambda i: sizes[i])
+        groups[target].append(s3_object)
+        sizes[target] += s3_object.size
+    return groups
+
+
+def build_manifest(bucket, objects):
+    """Render a Redshift COPY manifest listing objects of bucket."""
+    return json.dumps({
+        "entries": [
+            {
+                "url": "s3://{}/{}".format(bucket, s3_object.key),
+                "mandatory": True,
+                "meta": {"content_length": s3_object.size}
+            }
+            for s3_object in objects
+        ]
+    })
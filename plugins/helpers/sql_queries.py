@@ -1,3 +1,7 @@
+from helpers.rollups import ROLLUPS
+from helpers.table_specs import TABLE_SPECS
+
+
 class SqlQueries:
     songplay_table_insert = ("""
         SELECT
@@ -17,12 +21,63 @@ class SqlQueries:
                 AND events.artist = songs.artist_name
     """)
 
+    # Normalized (case, surrounding and repeated whitespace) title + artist hashed into an int8
+    song_match_key_expression = ("FNV_HASH(REGEXP_REPLACE(LOWER(TRIM({title})), '[[:space:]]+', ' '), "
+                                 "FNV_HASH(REGEXP_REPLACE(LOWER(TRIM({artist})), '[[:space:]]+', ' ')))")
+
+    songplay_table_match_key_insert = ("""
+        SELECT
+                events.start_time AS start_time,
+                events.userid AS user_id,
+                events.level AS level,
+                keys.song_id AS song_id,
+                keys.artist_id AS artist_id,
+                events.sessionid AS session_id,
+                events.location AS location,
+                events.useragent AS user_agent
+                FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time,
+                             {} AS match_key, *
+            FROM staging_events
+            WHERE page='NextSong') events
+            JOIN public.song_match_key keys
+            ON events.match_key = keys.match_key
+    """).format(song_match_key_expression.format(title="song", artist="artist"))
+
+    song_match_key_insert = ("""
+        INSERT INTO public.song_match_key (match_key, song_id, artist_id)
+        SELECT DISTINCT src.match_key, src.song_id, src.artist_id
+        FROM (SELECT {} AS match_key, song_id, artist_id
+              FROM staging_songs) src
+        WHERE NOT EXISTS (SELECT 1 FROM public.song_match_key k
+                          WHERE k.match_key = src.match_key
+                            AND k.song_id = src.song_id
+                            AND k.artist_id = src.artist_id)
+    """).format(song_match_key_expression.format(title="title", artist="artist_name"))
+
+    song_match_rate = ("""
+        SELECT COUNT(*), COUNT(keys.match_key)
+        FROM (SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time,
+                     {} AS match_key
+              FROM staging_events
+              WHERE page='NextSong') events
+        LEFT JOIN (SELECT DISTINCT match_key FROM public.song_match_key) keys
+        ON events.match_key = keys.match_key
+        WHERE events.start_time >= %s AND events.start_time < %s
+    """).format(song_match_key_expression.format(title="song", artist="artist"))
+
     user_table_insert = ("""
         SELECT distinct userid, firstname, lastname, gender, level
         FROM staging_events
         WHERE page='NextSong'
     """)
 
+    # Every NextSong row of each user with its ts, LoadDimensionOperator upserts the latest (order_by="ts DESC")
+    user_table_upsert = ("""
+        SELECT userid, firstname, lastname, gender, level, ts
+        FROM staging_events
+        WHERE page='NextSong' AND userid IS NOT NULL
+    """)
+
     song_table_insert = ("""
         SELECT distinct song_id, title, artist_id, year, duration
         FROM staging_songs
@@ -38,102 +93,153 @@ class SqlQueries:
                extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
         FROM songplays
     """)
-    
-    create_users_table = ("""
-        CREATE TABLE IF NOT EXISTS public.users (
-            userid int4 NOT NULL,
-            first_name varchar(256),
-            last_name varchar(256),
-            gender varchar(256),
-            "level" varchar(256),
-            CONSTRAINT users_pkey PRIMARY KEY (userid)
-        );
+
+    time_table_window_insert = ("""
+        SELECT DISTINCT sp.start_time, extract(hour from sp.start_time), extract(day from sp.start_time),
+               extract(week from sp.start_time), extract(month from sp.start_time),
+               extract(year from sp.start_time), extract(dayofweek from sp.start_time)
+        FROM songplays sp
+        WHERE sp.start_time >= %s AND sp.start_time < %s
+          AND NOT EXISTS (SELECT 1 FROM public.time t WHERE t.start_time = sp.start_time)
     """)
     
-    create_songs_table = ("""
-        CREATE TABLE IF NOT EXISTS public.songs (
-            songid varchar(256) NOT NULL,
-            title varchar(256),
-            artistid varchar(256),
-            "year" int4,
-            duration numeric(18,0),
-            CONSTRAINT songs_pkey PRIMARY KEY (songid)
-        );
+    create_users_table = TABLE_SPECS["users"].ddl()
+
+    create_songs_table = TABLE_SPECS["songs"].ddl()
+
+    create_artist_table = TABLE_SPECS["artists"].ddl()
+
+    create_time_table = TABLE_SPECS["time"].ddl()
+
+    create_songplays_table = TABLE_SPECS["songplays"].ddl()
+
+    create_staging_events_table = TABLE_SPECS["staging_events"].ddl()
+
+    create_staging_songs_table = TABLE_SPECS["staging_songs"].ddl()
+
+    create_stage_load_ledger_table = TABLE_SPECS["stage_load_ledger"].ddl()
+
+    create_song_match_key_table = TABLE_SPECS["song_match_key"].ddl()
+
+    create_load_fingerprint_table = TABLE_SPECS["load_fingerprint"].ddl()
+
+    create_query_plan_table = TABLE_SPECS["query_plan"].ddl()
+
+    create_load_row_count_table = TABLE_SPECS["load_row_count"].ddl()
+
+    create_dq_profile_history_table = TABLE_SPECS["dq_profile_history"].ddl()
+
+    create_rollup_window_table = TABLE_SPECS["rollup_window"].ddl()
+
+    create_songplays_daily_song_table = ROLLUPS["songplays_daily_song"].spec.ddl()
+
+    create_songplays_daily_user_table = ROLLUPS["songplays_daily_user"].spec.ddl()
+
+    create_songplays_monthly_artist_table = ROLLUPS["songplays_monthly_artist"].spec.ddl()
+
+    schema_version_table = TABLE_SPECS["schema_version"].ddl()
+
+    stage_load_ledger_select = ("""
+        SELECT s3_path, etag, size_bytes
+        FROM public.stage_load_ledger
+        WHERE table_name = %s
+        ORDER BY loaded_at
     """)
-    
-    create_artist_table = ("""
-        CREATE TABLE IF NOT EXISTS public.artists (
-            artistid varchar(256) NOT NULL,
-            name varchar(256),
-            location varchar(256),
-            lattitude numeric(18,0),
-            longitude numeric(18,0)
-        );
+
+    stage_load_ledger_insert = ("""
+        INSERT INTO public.stage_load_ledger (table_name, s3_path, etag, size_bytes, loaded_at, run_id)
+        VALUES %s
     """)
-    
-    create_time_table = ("""
-        CREATE TABLE IF NOT EXISTS public.time (
-            start_time timestamp NOT NULL,
-            "hour" int4,
-            "day" int4,
-            week int4,
-            month int4,
-            "year" int4,
-            weekday int4
-        );
+
+    load_fingerprint_select = ("""
+        SELECT fingerprint, target_rows
+        FROM public.load_fingerprint
+        WHERE table_name = %s
     """)
-    
-    create_songplays_table = ("""
-        CREATE TABLE IF NOT EXISTS public.songplays (
-            playid BIGINT identity(0, 1), 
-            start_time timestamp NOT NULL,
-            user_id int4 NOT NULL,
-            "level" varchar(256),
-            song_id varchar(256),
-            artist_id varchar(256),
-            session_id int4,
-            location varchar(256),
-            user_agent varchar(256),
-            CONSTRAINT songplays_pkey PRIMARY KEY (playid)
-        );
+
+    load_fingerprint_delete = ("""
+        DELETE FROM public.load_fingerprint
+        WHERE table_name = %s
     """)
-    
-    create_staging_events_table = ("""
-         CREATE TABLE IF NOT EXISTS public.staging_events
-         ( 
-            artist          VARCHAR,
-            auth            VARCHAR,
-            firstName       VARCHAR,
-            gender          VARCHAR,
-            itemInSession   INTEGER,
-            lastName        VARCHAR,
-            length          REAL, 
-            level           VARCHAR,       
-            location        VARCHAR,            
-            method          VARCHAR,            
-            page            VARCHAR,          
-            registration    REAL,                 
-            sessionId       VARCHAR,                
-            song            VARCHAR,              
-            status          VARCHAR,               
-            ts              BIGINT,               
-            userAgent       VARCHAR,            
-            userId          VARCHAR    
-        );
+
+    load_fingerprint_insert = ("""
+        INSERT INTO public.load_fingerprint (table_name, fingerprint, target_rows, loaded_at, run_id)
+        VALUES (%s, %s, %s, %s, %s)
+    """)
+
+    schema_version_exists = ("""
+        SELECT COUNT(*)
+        FROM information_schema.tables
+        WHERE table_schema = 'public' AND table_name = 'schema_version'
+    """)
+
+    schema_version_select = ("""
+        SELECT applied_at
+        FROM public.schema_version
+        WHERE ddl_hash = %s
+    """)
+
+    schema_version_insert = ("""
+        INSERT INTO public.schema_version (ddl_hash, statements, applied_at, run_id)
+        VALUES (%s, %s, %s, %s)
+    """)
+
+    query_plan_select_latest = ("""
+        SELECT plan
+        FROM public.query_plan
+        WHERE query_name = %s
+        ORDER BY captured_at DESC
+        LIMIT 1
+    """)
+
+    query_plan_insert = ("""
+        INSERT INTO public.query_plan (query_name, captured_at, run_id, total_cost, plan_rows, plan)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """)
+
+    load_row_count_delete = ("""
+        DELETE FROM public.load_row_count
+        WHERE table_name = %s AND period_start >= DATE_TRUNC('{period}', %s::timestamp) AND period_start < %s
+    """)
+
+    load_row_count_insert = ("""
+        INSERT INTO public.load_row_count (table_name, period_start, row_count, run_id, counted_at)
+        SELECT %s, DATE_TRUNC('{period}', start_time), COUNT(*), %s, %s
+        FROM {table}
+        WHERE start_time >= DATE_TRUNC('{period}', %s::timestamp) AND start_time < %s
+        GROUP BY 2
+    """)
+
+    load_row_count_select = ("""
+        SELECT period_start, row_count
+        FROM public.load_row_count
+        WHERE table_name = %s AND period_start >= DATE_TRUNC('{period}', %s::timestamp) AND period_start < %s
+        ORDER BY period_start
+    """)
+
+    dq_profile_baseline = ("""
+        SELECT metric, AVG(value), COUNT(*)
+        FROM (SELECT metric, value,
+                     ROW_NUMBER() OVER (PARTITION BY metric ORDER BY measured_at DESC) AS recency
+              FROM public.dq_profile_history
+              WHERE table_name = %s AND scope = %s AND value IS NOT NULL) history
+        WHERE recency <= %s
+        GROUP BY metric
+    """)
+
+    dq_profile_history_insert = ("""
+        INSERT INTO public.dq_profile_history (table_name, scope, metric, value, text_value, window_start, run_id,
+                                               measured_at)
+        VALUES %s
+    """)
+
+    rollup_window_overlaps = ("""
+        SELECT COUNT(*)
+        FROM public.rollup_window
+        WHERE rollup_name = %s AND window_start < %s AND window_end > %s
+    """)
+
+    rollup_window_insert = ("""
+        INSERT INTO public.rollup_window (rollup_name, window_start, window_end, rebuilt, run_id, merged_at)
+        VALUES (%s, %s, %s, %s, %s, %s)
     """)
-    
-    create_staging_songs_table = ("""
-        CREATE TABLE IF NOT EXISTS public.staging_songs (
-            num_songs int4,
-            artist_id varchar(256),
-            artist_name varchar(256),
-            artist_latitude numeric(18,0),
-            artist_longitude numeric(18,0),
-            artist_location varchar(256),
-            song_id varchar(256),
-            title varchar(256),
-            duration numeric(18,0),
-            "year" int4
-        );
-    """)
-    
\ No newline at end of file
@@ -0,0 +1,320 @@
+"""
+Declarative physical design of the warehouse tables.
+
+Each TableSpec lists its columns with their compression encodings together with
+the distribution style and compound sort key. SqlQueries.create_* statements are
+rendered from these specs. The design:
+
+- staging_events and staging_songs are distributed on the columns of the
+  songplays join (song / title), so the join runs slice-local instead of
+  redistributing both tables every run.
+- songplays is distributed on song_id and sorted on start_time, so the window
+  predicates of the fact and time loads only read the blocks of the window.
+- users and artists are small and replicated to every node (DISTSTYLE ALL).
+- The leading sort key column is left RAW, other columns use AZ64 (numbers and
+  timestamps) or ZSTD (strings).
+
+propose_spec_changes() compares a spec with what Redshift measures on the live
+table (ANALYZE COMPRESSION and SVV_TABLE_INFO) and lists suggested changes.
+"""
+
+QUOTED_NAMES = {"level", "year", "hour", "day"}
+
+DIST_STYLES = ("AUTO", "EVEN", "KEY", "ALL")
+
+
+class Column:
+
+    def __init__(self, name, data_type, not_null=False, encode=None):
+        """
+        :param name: Column name
+        :param data_type: Redshift data type, e.g. varchar(256) or BIGINT identity(0, 1)
+        :param not_null: Add NOT NULL
+        :param encode: Compression encoding, None to leave it to Redshift
+        """
+        self.name      = name
+        self.data_type = data_type
+        self.not_null  = not_null
+        self.encode    = encode
+
+    @property
+    def identifier(self):
+        return '"{}"'.format(self.name) if self.name.lower() in QUOTED_NAMES else self.name
+
+    def ddl(self, physical=True):
+        parts = [self.identifier, self.data_type]
+        if self.not_null:
+            parts.append("NOT NULL")
+        if physical and self.encode:
+            parts.append("ENCODE {}".format(self.encode))
+        return " ".join(parts)
+
+
+class TableSpec:
+
+    def __init__(self, name, columns, diststyle="AUTO", distkey=None, sortkey=(), primary_key=None,
+                 schema="public"):
+        """
+        :param name: Table name
+        :param columns: list of Column
+        :param diststyle: AUTO, EVEN, KEY or ALL, KEY requires distkey
+        :param distkey: Distribution key column
+        :param sortkey: Columns of the compound sort key
+        :param primary_key: Primary key column(s), declared as <name>_pkey
+        :param schema: Schema of the table
+        """
+        if diststyle not in DIST_STYLES:
+            raise ValueError(f"Unknown diststyle {diststyle}, expected one of {DIST_STYLES}")
+        if (diststyle == "KEY") != (distkey is not None):
+            raise ValueError("distkey must be set exactly when diststyle is KEY")
+        self.name        = name
+        self.columns     = columns
+        self.diststyle   = diststyle
+        self.distkey     = distkey
+        self.sortkey     = tuple(sortkey)
+        self.primary_key = (primary_key,) if isinstance(primary_key, str) else tuple(primary_key or ())
+        self.schema      = schema
+
+    @property
+    def qualified_name(self):
+        return "{}.{}".format(self.schema, self.name)
+
+    def column(self, name):
+        for column in self.columns:
+            if column.name == name:
+                return column
+        raise KeyError(f"{self.name} has no column {name}")
+
+    def identifiers(self, names):
+        return ", ".join(self.column(name).identifier for name in names)
+
+    def ddl(self, physical=True):
+        """
+        Render CREATE TABLE IF NOT EXISTS. physical=False leaves out the
+        distribution, sort key and encodings, e.g. for a PostgreSQL stand-in.
+        """
+        lines = [column.ddl(physical) for column in self.columns]
+        if self.primary_key:
+            lines.append("CONSTRAINT {}_pkey PRIMARY KEY ({})".format(self.name, self.identifiers(self.primary_key)))
+        attributes = []
+        if physical:
+            attributes.append("DISTSTYLE {}".format(self.diststyle))
+            if self.distkey:
+                attributes.append("DISTKEY ({})".format(self.identifiers([self.distkey])))
+            if self.sortkey:
+                attributes.append("COMPOUND SORTKEY ({})".format(self.identifiers(self.sortkey)))
+        return "\n        CREATE TABLE IF NOT EXISTS {} (\n            {}\n        ){};\n    ".format(
+            self.qualified_name,
+            ",\n            ".join(lines),
+            "".join("\n        " + attribute for attribute in attributes))
+
+
+TABLE_SPECS = {spec.name: spec for spec in [
+    TableSpec("staging_events", [
+        Column("artist", "VARCHAR", encode="zstd"),
+        Column("auth", "VARCHAR", encode="zstd"),
+        Column("firstName", "VARCHAR", encode="zstd"),
+        Column("gender", "VARCHAR", encode="zstd"),
+        Column("itemInSession", "INTEGER", encode="az64"),
+        Column("lastName", "VARCHAR", encode="zstd"),
+        Column("length", "REAL", encode="zstd"),
+        Column("level", "VARCHAR", encode="zstd"),
+        Column("location", "VARCHAR", encode="zstd"),
+        Column("method", "VARCHAR", encode="zstd"),
+        Column("page", "VARCHAR", encode="zstd"),
+        Column("registration", "REAL", encode="zstd"),
+        Column("sessionId", "VARCHAR", encode="zstd"),
+        Column("song", "VARCHAR", encode="zstd"),
+        Column("status", "VARCHAR", encode="zstd"),
+        Column("ts", "BIGINT", encode="raw"),
+        Column("userAgent", "VARCHAR", encode="zstd"),
+        Column("userId", "VARCHAR", encode="zstd"),
+    ], diststyle="KEY", distkey="song", sortkey=("ts",)),
+
+    TableSpec("staging_songs", [
+        Column("num_songs", "int4", encode="az64"),
+        Column("artist_id", "varchar(256)", encode="zstd"),
+        Column("artist_name", "varchar(256)", encode="zstd"),
+        Column("artist_latitude", "numeric(18,0)", encode="az64"),
+        Column("artist_longitude", "numeric(18,0)", encode="az64"),
+        Column("artist_location", "varchar(256)", encode="zstd"),
+        Column("song_id", "varchar(256)", encode="zstd"),
+        Column("title", "varchar(256)", encode="raw"),
+        Column("duration", "numeric(18,0)", encode="az64"),
+        Column("year", "int4", encode="az64"),
+    ], diststyle="KEY", distkey="title", sortkey=("title", "artist_name")),
+
+    TableSpec("songplays", [
+        Column("playid", "BIGINT identity(0, 1)", encode="az64"),
+        Column("start_time", "timestamp", not_null=True, encode="raw"),
+        Column("user_id", "int4", not_null=True, encode="az64"),
+        Column("level", "varchar(256)", encode="zstd"),
+        Column("song_id", "varchar(256)", encode="zstd"),
+        Column("artist_id", "varchar(256)", encode="zstd"),
+        Column("session_id", "int4", encode="az64"),
+        Column("location", "varchar(256)", encode="zstd"),
+        Column("user_agent", "varchar(256)", encode="zstd"),
+    ], diststyle="KEY", distkey="song_id", sortkey=("start_time",), primary_key="playid"),
+
+    TableSpec("users", [
+        Column("userid", "int4", not_null=True, encode="raw"),
+        Column("first_name", "varchar(256)", encode="zstd"),
+        Column("last_name", "varchar(256)", encode="zstd"),
+        Column("gender", "varchar(256)", encode="zstd"),
+        Column("level", "varchar(256)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("userid",), primary_key="userid"),
+
+    TableSpec("songs", [
+        Column("songid", "varchar(256)", not_null=True, encode="raw"),
+        Column("title", "varchar(256)", encode="zstd"),
+        Column("artistid", "varchar(256)", encode="zstd"),
+        Column("year", "int4", encode="az64"),
+        Column("duration", "numeric(18,0)", encode="az64"),
+    ], diststyle="KEY", distkey="songid", sortkey=("songid",), primary_key="songid"),
+
+    TableSpec("artists", [
+        Column("artistid", "varchar(256)", not_null=True, encode="raw"),
+        Column("name", "varchar(256)", encode="zstd"),
+        Column("location", "varchar(256)", encode="zstd"),
+        Column("lattitude", "numeric(18,0)", encode="az64"),
+        Column("longitude", "numeric(18,0)", encode="az64"),
+    ], diststyle="ALL", sortkey=("artistid",)),
+
+    TableSpec("time", [
+        Column("start_time", "timestamp", not_null=True, encode="raw"),
+        Column("hour", "int4", encode="az64"),
+        Column("day", "int4", encode="az64"),
+        Column("week", "int4", encode="az64"),
+        Column("month", "int4", encode="az64"),
+        Column("year", "int4", encode="az64"),
+        Column("weekday", "int4", encode="az64"),
+    ], diststyle="KEY", distkey="start_time", sortkey=("start_time",)),
+
+    # Small and narrow, replicated so the songplays join never redistributes
+    TableSpec("song_match_key", [
+        Column("match_key", "int8", not_null=True, encode="raw"),
+        Column("song_id", "varchar(256)", encode="zstd"),
+        Column("artist_id", "varchar(256)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("match_key",)),
+
+    TableSpec("stage_load_ledger", [
+        Column("table_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("s3_path", "varchar(1024)", not_null=True, encode="zstd"),
+        Column("etag", "varchar(256)", encode="zstd"),
+        Column("size_bytes", "int8", encode="az64"),
+        Column("loaded_at", "timestamp", encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("table_name", "s3_path")),
+
+    TableSpec("load_fingerprint", [
+        Column("table_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("fingerprint", "varchar(64)", not_null=True, encode="zstd"),
+        Column("target_rows", "int8", encode="az64"),
+        Column("loaded_at", "timestamp", encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("table_name",)),
+
+    TableSpec("load_row_count", [
+        Column("table_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("period_start", "timestamp", not_null=True, encode="az64"),
+        Column("row_count", "int8", encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+        Column("counted_at", "timestamp", encode="az64"),
+    ], diststyle="ALL", sortkey=("table_name", "period_start")),
+
+    TableSpec("dq_profile_history", [
+        Column("table_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("scope", "varchar(256)", not_null=True, encode="zstd"),
+        Column("metric", "varchar(256)", not_null=True, encode="zstd"),
+        Column("value", "float8", encode="raw"),
+        Column("text_value", "varchar(256)", encode="zstd"),
+        Column("window_start", "timestamp", encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+        Column("measured_at", "timestamp", encode="az64"),
+    ], diststyle="ALL", sortkey=("table_name", "scope", "metric")),
+
+    TableSpec("rollup_window", [
+        Column("rollup_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("window_start", "timestamp", not_null=True, encode="az64"),
+        Column("window_end", "timestamp", not_null=True, encode="az64"),
+        Column("rebuilt", "boolean"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+        Column("merged_at", "timestamp", encode="az64"),
+    ], diststyle="ALL", sortkey=("rollup_name", "window_start")),
+
+    TableSpec("schema_version", [
+        Column("ddl_hash", "varchar(64)", not_null=True, encode="raw"),
+        Column("statements", "int4", encode="az64"),
+        Column("applied_at", "timestamp", encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("ddl_hash",)),
+
+    TableSpec("query_plan", [
+        Column("query_name", "varchar(256)", not_null=True, encode="raw"),
+        Column("captured_at", "timestamp", not_null=True, encode="az64"),
+        Column("run_id", "varchar(256)", encode="zstd"),
+        Column("total_cost", "float8", encode="raw"),
+        Column("plan_rows", "int8", encode="az64"),
+        Column("plan", "varchar(65535)", encode="zstd"),
+    ], diststyle="ALL", sortkey=("query_name", "captured_at")),
+]}
+
+
+analyze_compression_sql = "ANALYZE COMPRESSION {}"
+
+table_info_sql = """
+    SELECT diststyle, skew_rows, unsorted, stats_off, tbl_rows
+    FROM svv_table_info
+    WHERE "schema" = %s AND "table" = %s
+"""
+
+
+def propose_spec_changes(conn, spec, skew_threshold=4.0, min_reduction_pct=10.0):
+    """
+    Measure the live table of spec and list suggested spec changes.
+
+    :param conn: DB-API connection to the cluster (e.g. PostgresHook.get_conn())
+    :param spec: TableSpec to check
+    :param skew_threshold: skew_rows (largest / smallest slice) above which the
+                           distribution is reported as skewed
+    :param min_reduction_pct: Smallest estimated size reduction worth an encoding change
+    :return: list of human readable proposals, empty when the spec fits the data
+    """
+    proposals = []
+    cursor = conn.cursor()
+    cursor.execute(table_info_sql, (spec.schema, spec.name))
+    info = cursor.fetchone()
+    if info is None:
+        return [f"{spec.qualified_name} does not exist or is empty"]
+    diststyle, skew_rows, unsorted, stats_off, tbl_rows = info
+    if skew_rows is not None and skew_rows > skew_threshold:
+        if spec.diststyle == "KEY":
+            proposals.append(f"{spec.name}: rows are skewed {skew_rows:.1f}x across slices on DISTKEY "
+                             f"{spec.distkey}, use a higher cardinality key or DISTSTYLE EVEN")
+        else:
+            proposals.append(f"{spec.name}: rows are skewed {skew_rows:.1f}x across slices ({diststyle})")
+    if unsorted is not None and unsorted > 20:
+        proposals.append(f"{spec.name}: {unsorted:.0f}% unsorted, VACUUM SORT ONLY or revisit SORTKEY "
+                         f"({', '.join(spec.sortkey) or 'none'})")
+
+    # ANALYZE COMPRESSION cannot run inside a transaction block. The SELECT above opened one,
+    # and psycopg2 refuses to switch autocommit while it is open
+    conn.rollback()
+    autocommit, conn.autocommit = conn.autocommit, True
+    try:
+        cursor.execute(analyze_compression_sql.format(spec.qualified_name))
+        recommendations = cursor.fetchall()
+    finally:
+        conn.autocommit = autocommit
+    # Rows are (table, column, encoding, est_reduction_pct)
+    for _, column_name, encoding, reduction in recommendations:
+        try:
+            column = spec.column(column_name)
+        except KeyError:
+            column = next((c for c in spec.columns if c.name.lower() == column_name.lower()), None)
+        if column is None or column.name in spec.sortkey[:1]:
+            continue
+        if (column.encode or "").lower() != encoding.lower() and float(reduction) >= min_reduction_pct:
+            proposals.append(f"{spec.name}.{column.name}: ENCODE {column.encode or 'auto'} -> {encoding} "
+                             f"(estimated {float(reduction):.0f}% smaller)")
+    return proposals
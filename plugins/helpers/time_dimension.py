@@ -0,0 +1,50 @@
+import pandas as pd
+
+
+def calendar_rows(start, end, freq="H"):
+    """
+    Build time dimension rows for every freq step of [start, end) in one
+    vectorized pass, with the same columns and conventions as
+    SqlQueries.time_table_insert (weekday 0 is Sunday, like Redshift's dayofweek).
+
+    :param start: First timestamp of the range
+    :param end: End of the range, excluded
+    :param freq: pandas offset alias, e.g. H for hourly or T for every minute
+    :return: list of (start_time, hour, day, week, month, year, weekday) tuples
+    """
+    index = pd.date_range(start=pd.Timestamp(start), end=pd.Timestamp(end), freq=freq)
+    index = index[index < pd.Timestamp(end)]
+    if hasattr(index, "isocalendar"):
+        week = index.isocalendar().week.values
+    else:
+        week = index.week
+    return list(zip(index.to_pydatetime(),
+                    index.hour.tolist(),
+                    index.day.tolist(),
+                    [int(value) for value in week],
+                    index.month.tolist(),
+                    index.year.tolist(),
+                    ((index.dayofweek + 1) % 7).tolist()))
+
+
+def time_frame(start_times):
+    """
+    Derive the time dimension columns of a DatetimeIndex or datetime Series in
+    one vectorized pass (week is the ISO week, weekday 0 is Sunday).
+
+    :return: DataFrame with start_time, hour, day, week, month, year and weekday
+    """
+    index = pd.DatetimeIndex(start_times)
+    if hasattr(index, "isocalendar"):
+        week = index.isocalendar().week.values.astype("int64")
+    else:
+        week = index.week
+    return pd.DataFrame({
+        "start_time": index,
+        "hour": index.hour,
+        "day": index.day,
+        "week": week,
+        "month": index.month,
+        "year": index.year,
+        "weekday": (index.dayofweek + 1) % 7,
+    })
@@ -0,0 +1,140 @@
+import io
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+
+def encode_copy_value(value):
+    """Encode a value for COPY's text format, where NULL is \\N and tabs/newlines are escaped."""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\")
+                      .replace("\t", "\\t")
+                      .replace("\n", "\\n")
+                      .replace("\r", "\\r"))
+
+
+class TransferResult:
+    """Row count and timing of a finished transfer."""
+
+    def __init__(self, rows, batches, seconds):
+        self.rows    = rows
+        self.batches = batches
+        self.seconds = seconds
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds > 0 else float(self.rows)
+
+    def __repr__(self):
+        return "TransferResult(rows={}, batches={}, seconds={:.2f}, rows_per_sec={:.0f})".format(
+            self.rows, self.batches, self.seconds, self.rows_per_sec)
+
+
+class BulkTransfer:
+    """
+    Streams the result of a query from one connection into a table on another
+    connection without holding more than one batch in memory.
+
+    Rows are read with a named (server-side) cursor, batch_size rows at a time,
+    and written either with COPY ... FROM STDIN from an in-memory text buffer
+    (method="copy", PostgreSQL only) or with multi-row INSERTs through
+    execute_values (method="values", which Redshift also accepts).
+    The target side runs in a single transaction that is committed at the end.
+    """
+
+    methods = ("copy", "values")
+
+    copy_sql = "COPY {}{} FROM STDIN"
+
+    insert_sql = "INSERT INTO {}{} VALUES %s"
+
+    def __init__(self, source_hook, target_hook, batch_size=10000, method="values", log=None,
+                 instrumentation=None):
+        """
+        :param source_hook: Hook the rows are read from
+        :param target_hook: Hook the rows are written to
+        :param batch_size: Number of rows fetched and written per round trip
+        :param method: copy or values
+        :param log: Logger used for progress messages
+        :param instrumentation: Instrumentation the encoding time is reported to as the transform phase
+        """
+        if method not in BulkTransfer.methods:
+            raise ValueError(f"Unknown transfer method {method}, expected one of {BulkTransfer.methods}")
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        self.source_hook     = source_hook
+        self.target_hook     = target_hook
+        self.batch_size      = batch_size
+        self.method          = method
+        self.log             = log
+        self.instrumentation = instrumentation
+
+    def run(self, sql, table_name, target_fields=None, parameters=None, pre_sql=None):
+        """
+        Copy the rows returned by sql into table_name.
+
+        :param sql: SELECT statement producing the rows
+        :param table_name: Target table
+        :param target_fields: Target columns, rows are inserted positionally when empty
+        :param parameters: Parameters bound into sql
+        :param pre_sql: Statements run on the target connection, in the same
+                        transaction, before the first batch is written
+        :return: TransferResult
+        """
+        started = time.monotonic()
+        rows = batches = 0
+        source_conn = self.source_hook.get_conn()
+        target_conn = self.target_hook.get_conn()
+        try:
+            target_cursor = target_conn.cursor()
+            for statement in pre_sql or []:
+                target_cursor.execute(statement)
+
+            source_cursor = source_conn.cursor(name="bulk_transfer_{}".format(uuid.uuid4().hex))
+            source_cursor.itersize = self.batch_size
+            source_cursor.execute(sql, parameters)
+
+            while True:
+                batch = source_cursor.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                self.write_batch(target_cursor, table_name, target_fields, batch)
+                rows += len(batch)
+                batches += 1
+                if self.log:
+                    self.log.info(f"Transferred {rows} records to {table_name}")
+
+            source_cursor.close()
+            target_conn.commit()
+        except Exception:
+            target_conn.rollback()
+            raise
+        finally:
+            source_conn.close()
+            target_conn.close()
+
+        result = TransferResult(rows, batches, time.monotonic() - started)
+        if self.log:
+            self.log.info(f"Transferred {result.rows} records to {table_name} "
+                          f"in {result.seconds:.2f}s ({result.rows_per_sec:.0f} rows/sec)")
+        return result
+
+    def write_batch(self, cursor, table_name, fields, batch):
+        columns = " ({})".format(", ".join(fields)) if fields else ""
+        if self.method == "copy":
+            started = time.monotonic()
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write("\t".join(encode_copy_value(value) for value in row))
+                buffer.write("\n")
+            buffer.seek(0)
+            if self.instrumentation:
+                self.instrumentation.add_phase("transform", time.monotonic() - started)
+            cursor.copy_expert(BulkTransfer.copy_sql.format(table_name, columns), buffer)
+        else:
+            execute_values(cursor,
+                           BulkTransfer.insert_sql.format(table_name, columns),
+                           batch,
+                           page_size=len(batch))
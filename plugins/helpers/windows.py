@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+PARTITION_STEPS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+PARTITION_BY = ("hour", "day", "month")
+
+
+def parse_timestamp(value):
+    """Parse a rendered filter_key bound such as '2018-11-01 00:00:00+00:00'."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).strip().replace("T", " "))
+
+
+def next_boundary(value, partition_by):
+    """Start of the sub-window after the one starting at value, months follow the calendar."""
+    if partition_by == "month":
+        return value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1, day=1,
+                             hour=0, minute=0, second=0, microsecond=0)
+    return value + PARTITION_STEPS[partition_by]
+
+
+def split_window(start, end, partition_by):
+    """
+    Split the [start, end) window into consecutive sub-windows of one hour,
+    one day or one calendar month. The last sub-window is cut short at end.
+
+    :param start: Window start, datetime or ISO formatted string
+    :param end: Window end (excluded), datetime or ISO formatted string
+    :param partition_by: hour, day or month
+    :return: list of (start, end) datetime tuples
+    """
+    if partition_by not in PARTITION_BY:
+        raise ValueError(f"Unknown partition_by {partition_by}, expected one of {PARTITION_BY}")
+    start, end = parse_timestamp(start), parse_timestamp(end)
+    windows = []
+    while start < end:
+        boundary = next_boundary(start, partition_by)
+        windows.append((start, min(boundary, end)))
+        start = boundary
+    return windows
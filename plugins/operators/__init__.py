@@ -2,10 +2,26 @@ from operators.stage_redshift import StageToRedshiftOperator
 from operators.load_fact import LoadFactOperator
 from operators.load_dimension import LoadDimensionOperator
 from operators.data_quality import DataQualityOperator
+from operators.table_maintenance import TableMaintenanceOperator
+from operators.schema_bootstrap import SchemaBootstrapOperator
+from operators.query_cost_guard import QueryCostGuardOperator
+from operators.async_sql import AsyncSqlOperator
+from operators.local_transform import LocalTransformOperator
+from operators.rollup import RollupOperator
+from operators.convert_events import ConvertEventsOperator
+from operators.exclusive_run import ExclusiveRunSensor
 
 __all__ = [
     'StageToRedshiftOperator',
     'LoadFactOperator',
     'LoadDimensionOperator',
-    'DataQualityOperator'
+    'DataQualityOperator',
+    'TableMaintenanceOperator',
+    'SchemaBootstrapOperator',
+    'QueryCostGuardOperator',
+    'AsyncSqlOperator',
+    'LocalTransformOperator',
+    'RollupOperator',
+    'ConvertEventsOperator',
+    'ExclusiveRunSensor'
 ]
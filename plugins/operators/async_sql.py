@@ -0,0 +1,73 @@
+import time
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class AsyncSqlOperator(BaseOperator):
+
+    ui_color = '#B7A9E8'
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 transactions=None,
+                 statement_timeout=None,
+                 max_concurrency=8,
+                 *args, **kwargs):
+        """
+        :param redshift_conn_id: RedShift Connection ID
+        :param transactions: dict of name to a list of statements run as one transaction.
+                             A statement is SQL or (SQL, parameters), the parameters are
+                             formatted with the task context, e.g. ("{execution_date}",)
+        :param statement_timeout: Seconds a transaction may take before its running
+                                  statement is cancelled and the task fails, None for no limit
+        :param max_concurrency: Transactions running at the same time
+        """
+
+        super(AsyncSqlOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id  = redshift_conn_id
+        self.transactions      = transactions or {}
+        self.statement_timeout = statement_timeout
+        self.max_concurrency   = max_concurrency
+
+    def render_statements(self, statements, context):
+        rendered = []
+        for statement in statements:
+            if isinstance(statement, tuple):
+                sql, parameters = statement
+                statement = (sql, tuple(parameter.format(**context) for parameter in parameters))
+            rendered.append(statement)
+        return rendered
+
+    def execute(self, context):
+        """
+        Drive every transaction from this one task over asynchronous connections,
+        so the worker slot waits on all of them at once instead of one at a time.
+        """
+        from helpers.connections import connection_dsn
+        from helpers.instrumentation import Instrumentation
+        from helpers.async_sql import run_transactions
+
+        instrumentation = Instrumentation(self.task_id, log=self.log)
+        dsn = connection_dsn(self.redshift_conn_id)
+        transactions = {name: self.render_statements(statements, context)
+                        for name, statements in self.transactions.items()}
+
+        started = time.monotonic()
+        self.log.info(f"Running {len(transactions)} transactions, {self.max_concurrency} at a time")
+        try:
+            results = run_transactions(dsn, transactions, self.statement_timeout, self.max_concurrency,
+                                       instrumentation)
+        finally:
+            instrumentation.emit(context)
+
+        failures = []
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                failures.append(f"{name}: {result}")
+            else:
+                self.log.info(f"{name} committed, rows {result}")
+        if failures:
+            raise ValueError("{} of {} transactions failed.\n{}".format(
+                len(failures), len(results), "\n".join(failures)))
+        self.log.info(f"{len(results)} transactions committed in {time.monotonic() - started:.2f}s")
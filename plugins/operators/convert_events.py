@@ -0,0 +1,115 @@
+import glob
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class ConvertEventsOperator(BaseOperator):
+
+    ui_color = '#7FC8A9'
+
+    template_fields = ("input_path", "output_path")
+
+    @apply_defaults
+    def __init__(self,
+                 aws_credentials_id="",
+                 input_path="",
+                 output_path="",
+                 pattern="**/*.json",
+                 workers=None,
+                 chunk_size=100000,
+                 compression="snappy",
+                 transfer_threads=8,
+                 *args, **kwargs):
+        """
+        :param aws_credentials_id: AWS Credentials ID, for s3:// paths. Any S3 compatible endpoint
+                                   configured on the connection works, e.g. a local MinIO or moto
+        :param input_path: Local directory or s3://bucket/prefix of the raw log_data JSON, formatted
+                           with the task context like s3_key, e.g. s3://udacity-dend/log_data/{execution_date.year}/
+        :param output_path: Local directory or s3://bucket/prefix the Parquet files are written to,
+                            replacing the previous ones. StageToRedshiftOperator copies it with s3_format parquet
+        :param pattern: Glob of the log files under a local input_path
+        :param workers: Processes converting files in parallel, None for one per core
+        :param chunk_size: Records read at a time per process
+        :param compression: Parquet compression, snappy, gzip or zstd
+        :param transfer_threads: Concurrent S3 downloads and uploads
+        """
+
+        super(ConvertEventsOperator, self).__init__(*args, **kwargs)
+        self.aws_credentials_id = aws_credentials_id
+        self.input_path         = input_path
+        self.output_path        = output_path
+        self.pattern            = pattern
+        self.workers            = workers
+        self.chunk_size         = chunk_size
+        self.compression        = compression
+        self.transfer_threads   = transfer_threads
+
+    def execute(self, context):
+        # pandas and pyarrow are only imported when the task runs
+        from helpers.event_conversion import convert_events
+
+        input_path = self.input_path.format(**context)
+        output_path = self.output_path.format(**context)
+        with tempfile.TemporaryDirectory(prefix="convert_events_") as work_dir:
+            if input_path.startswith("s3://"):
+                paths = self.download(input_path, os.path.join(work_dir, "input"))
+            else:
+                paths = sorted(glob.glob(os.path.join(input_path, self.pattern), recursive=True))
+            if not paths:
+                raise ValueError(f"Found no log files under {input_path}")
+
+            local_output = os.path.join(work_dir, "output") if output_path.startswith("s3://") else output_path
+            self.log.info(f"Converting {len(paths)} log files from {input_path} into {output_path}")
+            stats = convert_events(paths, local_output, self.workers, self.chunk_size, self.compression, self.log)
+            if output_path.startswith("s3://"):
+                self.upload(local_output, output_path)
+        return stats
+
+    def s3_client(self):
+        from airflow.hooks.S3_hook import S3Hook
+
+        return S3Hook(aws_conn_id=self.aws_credentials_id).get_conn()
+
+    @staticmethod
+    def split_s3_path(s3_path):
+        bucket, _, prefix = s3_path[len("s3://"):].partition("/")
+        return bucket, prefix
+
+    def download(self, s3_path, local_dir):
+        from helpers.s3_manifest import list_s3_objects
+
+        s3_client = self.s3_client()
+        bucket, prefix = self.split_s3_path(s3_path)
+        objects = list_s3_objects(s3_client, bucket, prefix)
+        os.makedirs(local_dir)
+        # Indexed names, keys under different prefixes may share a file name
+        paths = [os.path.join(local_dir, "{}-{}".format(index, os.path.basename(s3_object.key)))
+                 for index, s3_object in enumerate(objects)]
+        with ThreadPoolExecutor(max_workers=max(1, self.transfer_threads)) as executor:
+            list(executor.map(lambda job: s3_client.download_file(bucket, job[0].key, job[1]), zip(objects, paths)))
+        self.log.info(f"Downloaded {len(objects)} files ({sum(s3_object.size for s3_object in objects)} bytes) "
+                      f"from {s3_path}")
+        return paths
+
+    def upload(self, local_dir, s3_path):
+        """Replace the objects under s3_path with the files of local_dir."""
+        from helpers.s3_manifest import list_s3_objects
+
+        s3_client = self.s3_client()
+        bucket, prefix = self.split_s3_path(s3_path)
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        stale = list_s3_objects(s3_client, bucket, prefix)
+        # delete_objects takes at most 1000 keys per request
+        for start in range(0, len(stale), 1000):
+            s3_client.delete_objects(Bucket=bucket, Delete={
+                "Objects": [{"Key": s3_object.key} for s3_object in stale[start:start + 1000]]})
+
+        files = sorted(glob.glob(os.path.join(local_dir, "event_date=*", "*.parquet")))
+        with ThreadPoolExecutor(max_workers=max(1, self.transfer_threads)) as executor:
+            list(executor.map(lambda path: s3_client.upload_file(
+                path, bucket, prefix + os.path.relpath(path, local_dir).replace(os.sep, "/")), files))
+        self.log.info(f"Uploaded {len(files)} files to {s3_path}, replacing {len(stale)}")
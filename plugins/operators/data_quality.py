@@ -1,54 +1,281 @@
-from airflow.hooks.postgres_hook import PostgresHook
-from airflow.contrib.hooks.aws_hook import AwsHook
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
-from psycopg2.extras import execute_values
-import pandas as pd
+from helpers.sql_queries import SqlQueries
+from helpers.windows import parse_timestamp
 
 class DataQualityOperator(BaseOperator):
 
     ui_color = '#89DA59'
 
+    template_fields = ("filter_key",)
+
+    on_deviation_modes = ("fail", "warn")
+
+    null_count_sql = "SUM(CASE WHEN {} IS NULL THEN 1 ELSE 0 END)"
+
+    profile_column_sql = ("APPROXIMATE COUNT(DISTINCT s.{column}), MIN(s.{column}), MAX(s.{column}), "
+                          "SUM(CASE WHEN s.{column} IS NULL THEN 1 ELSE 0 END)")
+
+    orphan_count_sql = "SUM(CASE WHEN s.{column} IS NOT NULL AND r{index}.{key} IS NULL THEN 1 ELSE 0 END)"
+
+    orphan_join_sql = ("LEFT JOIN (SELECT DISTINCT {key} FROM {table}{predicate}) r{index} "
+                       "ON s.{column} = r{index}.{key}")
+
+    profile_sql = """
+        SELECT COUNT(*){aggregates}
+        FROM (SELECT * FROM {table} WHERE {predicate}) s
+        {joins}
+    """
+
+    duplicate_count_sql = "SELECT COUNT(*) - COUNT(DISTINCT {key}) FROM {table}"
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  aws_credentials_id="",
                  table_info_dict=[""],
+                 max_workers=4,
+                 capture_slowest=0,
+                 filter_key=("", ""),
+                 max_deviation=0.5,
+                 baseline_runs=8,
+                 min_baseline_runs=3,
+                 on_deviation="fail",
                  *args, **kwargs):
         """
         :param redshift_conn_id: RedShift Connection ID
         :param aws_credentials_id: AWS Credentials ID
-        :param table_info_dict: dict with table name and column that should never be NULL in the table
+        :param table_info_dict: dict with table name and column (or list of columns)
+                                that should never be NULL in the table. Optional keys:
+                                unique: key column that must not have duplicates (exact, for dimensions)
+                                profile: columns profiled with approximate distinct counts, min/max
+                                         and null ratios into dq_profile_history
+                                references: dict of column to "table.key" it must exist in,
+                                            measured as orphan rate. A reference of the window_column
+                                            only reads the window of the referenced table
+                                max_orphan_rate: Highest accepted orphan rate, default 0
+                                window_column: Restrict profiling to the filter_key window of this column
+                                sample: Fraction of the rows profiled, e.g. 0.05, default all
+        :param max_workers: Number of tables checked concurrently, each over its own pooled connection
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        :param filter_key: Window profiled on each table's window_column
+        :param max_deviation: Highest accepted relative difference of a profiled metric
+                              from its rolling baseline, e.g. 0.5 for +/-50%. The baseline only holds
+                              measurements of the same DAG, window length and sample fraction
+        :param baseline_runs: Number of previous measurements the baseline averages
+        :param min_baseline_runs: Measurements needed before deviations are checked
+        :param on_deviation: fail or warn when a metric deviates from its baseline
         """
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id   = redshift_conn_id
         self.aws_credentials_id = aws_credentials_id
         self.table_info_dict    = table_info_dict
+        self.max_workers        = max_workers
+        self.capture_slowest    = capture_slowest
+        self.filter_key         = filter_key
+        self.max_deviation      = max_deviation
+        self.baseline_runs      = baseline_runs
+        self.min_baseline_runs  = min_baseline_runs
+        self.on_deviation       = on_deviation
+        if self.on_deviation not in DataQualityOperator.on_deviation_modes:
+            raise ValueError(f"Unknown on_deviation {self.on_deviation}, "
+                             f"expected one of {DataQualityOperator.on_deviation_modes}")
 
     def execute(self, context):
-        # AWS Hook
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        # RedShift Hook
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        
-        # Test each table
-        for table_dict in self.table_info_dict:
-            table_name = table_dict["table_name"]
-            column_that_should_not_be_null = table_dict["not_null"]
-            # Check number of records (pass if > 0, else fail)
-            records = redshift.get_records(f"SELECT COUNT(*) FROM {table_name}")
-            if len(records) < 1 or len(records[0]) < 1:
-                raise ValueError(f"Data quality check failed. {table_name} returned no results")
-            elif records[0][0] < 1:
-                raise ValueError(f"Data quality check failed. {table_name} contained 0 rows")
-            else:
-                # Now check is NOT NULL columns contain NULL
-                null_records = redshift.get_records(f"SELECT COUNT(*) FROM {table_name} WHERE {column_that_should_not_be_null} IS NULL")
-                if null_records[0][0] > 0:
-                    col = column_that_should_not_be_null
-                    raise ValueError(f"Data quality check failed. {table_name} contained {null_records[0][0]} null records for {col}")
-                else:
-                    self.log.info(f"Data quality on table {table_name} check passed with {records[0][0]} records")
-                    
\ No newline at end of file
+        from helpers.instrumentation import instrumented_hook
+
+        # Every call takes its own pooled connection, so the hook is shared by the threads
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+
+        # Test the tables concurrently, one scan per table
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                results = list(executor.map(partial(self.check_table, redshift, context=context),
+                                            self.table_info_dict))
+        finally:
+            redshift.emit(context)
+
+        failures = [failure for table_failures, _ in results for failure in table_failures]
+        deviations = [deviation for _, table_deviations in results for deviation in table_deviations]
+        if deviations and self.on_deviation == "fail":
+            failures += deviations
+        for deviation in deviations:
+            self.log.warning(deviation)
+        if failures:
+            raise ValueError("Data quality check failed.\n{}".format("\n".join(failures)))
+        self.log.info(f"Data quality checks passed on {len(self.table_info_dict)} tables")
+
+    def check_sql(self, table_name, not_null_columns):
+        """Compile the row count and every NOT NULL check of a table into one aggregation."""
+        aggregates = ["COUNT(*)"] + [DataQualityOperator.null_count_sql.format(column)
+                                     for column in not_null_columns]
+        return "SELECT {} FROM {}".format(", ".join(aggregates), table_name)
+
+    def check_table(self, redshift, table_dict, context=None):
+        """Run the checks of one table and return its failure and deviation messages."""
+        failures = self.check_counts(redshift, table_dict)
+        if failures:
+            return failures, []
+        table_name = table_dict["table_name"]
+        try:
+            if table_dict.get("unique"):
+                failures += self.check_unique(redshift, table_dict)
+            if table_dict.get("profile") or table_dict.get("references"):
+                profile_failures, deviations = self.profile_table(redshift, table_dict, context)
+                return failures + profile_failures, deviations
+        except Exception as e:
+            failures.append(f"{table_name} could not be profiled: {e}")
+        return failures, []
+
+    def check_counts(self, redshift, table_dict):
+        """Row count and NOT NULL checks of one table, returns the list of failure messages."""
+        table_name = table_dict["table_name"]
+        not_null_columns = table_dict.get("not_null") or []
+        if isinstance(not_null_columns, str):
+            not_null_columns = [not_null_columns]
+
+        try:
+            records = redshift.get_records(self.check_sql(table_name, not_null_columns))
+        except Exception as e:
+            return [f"{table_name} could not be checked: {e}"]
+
+        # Check number of records (pass if > 0, else fail)
+        if len(records) < 1 or len(records[0]) < 1:
+            return [f"{table_name} returned no results"]
+        if records[0][0] < 1:
+            return [f"{table_name} contained 0 rows"]
+
+        # Now check is NOT NULL columns contain NULL
+        failures = [f"{table_name} contained {null_count} null records for {column}"
+                    for column, null_count in zip(not_null_columns, records[0][1:])
+                    if null_count]
+        if not failures:
+            self.log.info(f"Data quality on table {table_name} check passed with {records[0][0]} records")
+        return failures
+
+    def check_unique(self, redshift, table_dict):
+        key = table_dict["unique"]
+        duplicates = redshift.get_first(DataQualityOperator.duplicate_count_sql.format(
+            key=key, table=table_dict["table_name"]))[0]
+        if duplicates:
+            return [f"{table_dict['table_name']} contained {duplicates} duplicate {key} values"]
+        return []
+
+    def window(self, context):
+        return (self.filter_key[0].format(**context),
+                self.filter_key[1].format(**context))
+
+    def profile_sql_for(self, table_dict, window):
+        """One pass over the (windowed, sampled) table for every profiled column and reference."""
+        columns = table_dict.get("profile") or []
+        references = table_dict.get("references") or {}
+        window_column = table_dict.get("window_column")
+        aggregates = [DataQualityOperator.profile_column_sql.format(column=column) for column in columns]
+        joins, join_parameters = [], []
+        for index, (column, reference) in enumerate(references.items()):
+            table, key = reference.rsplit(".", 1)
+            # The window's rows can only match the window of a referenced time column
+            predicate = ""
+            if window_column and column == window_column:
+                predicate = " WHERE {0} >= %s AND {0} < %s".format(key)
+                join_parameters += list(window)
+            aggregates.append(DataQualityOperator.orphan_count_sql.format(column=column, index=index, key=key))
+            joins.append(DataQualityOperator.orphan_join_sql.format(column=column, index=index, key=key,
+                                                                    table=table, predicate=predicate))
+
+        predicates, parameters = ["1 = 1"], []
+        if window_column:
+            predicates.append("{0} >= %s AND {0} < %s".format(window_column))
+            parameters += list(window)
+        if table_dict.get("sample"):
+            predicates.append("RANDOM() < {:f}".format(float(table_dict["sample"])))
+        sql = DataQualityOperator.profile_sql.format(
+            aggregates="".join(", " + aggregate for aggregate in aggregates),
+            table=table_dict["table_name"],
+            predicate=" AND ".join(predicates),
+            joins="\n        ".join(joins))
+        return sql, tuple(parameters + join_parameters)
+
+    def profile_scope(self, context, table_dict, window):
+        """
+        What makes measurements comparable: the DAG, the window length and the
+        sample fraction. A backfill's whole-range metrics never enter the
+        baseline of the monthly runs.
+        """
+        length = "all"
+        if table_dict.get("window_column"):
+            days = (parse_timestamp(window[1]) - parse_timestamp(window[0])).total_seconds() / 86400
+            # Calendar months differ in length but are one scope
+            length = "month" if 28 <= days <= 31 else "{:g}d".format(days)
+        return "{}/{}/sample={:g}".format(context["dag"].dag_id, length, float(table_dict.get("sample") or 1.0))
+
+    def profile_table(self, redshift, table_dict, context):
+        """
+        Profile a sample of the table, store the metrics in dq_profile_history and
+        compare them with their rolling baseline.
+        Returns (failure messages, deviation messages).
+        """
+        from psycopg2.extras import execute_values
+
+        table_name = table_dict["table_name"]
+        columns = table_dict.get("profile") or []
+        references = table_dict.get("references") or {}
+        sample = float(table_dict.get("sample") or 1.0)
+        window = self.window(context)
+        scope = self.profile_scope(context, table_dict, window)
+        sql, parameters = self.profile_sql_for(table_dict, window)
+        record = redshift.get_first(sql, parameters=parameters or None)
+
+        sampled = record[0]
+        # Counts are scaled back up to the whole window
+        metrics = {"rows": (sampled / sample, None)}
+        for offset, column in enumerate(columns):
+            approx_distinct, minimum, maximum, nulls = record[1 + 4 * offset:5 + 4 * offset]
+            metrics[f"{column}.approx_distinct"] = (float(approx_distinct), None)
+            metrics[f"{column}.null_ratio"] = (nulls / sampled if sampled else 0.0, None)
+            metrics[f"{column}.min"] = (None, None if minimum is None else str(minimum)[:256])
+            metrics[f"{column}.max"] = (None, None if maximum is None else str(maximum)[:256])
+        failures = []
+        max_orphan_rate = float(table_dict.get("max_orphan_rate", 0.0))
+        for offset, column in enumerate(references):
+            orphans = record[1 + 4 * len(columns) + offset]
+            orphan_rate = orphans / sampled if sampled else 0.0
+            metrics[f"{column}.orphan_rate"] = (orphan_rate, None)
+            if orphan_rate > max_orphan_rate:
+                failures.append(f"{table_name}.{column}: {orphan_rate:.2%} of sampled rows have no match "
+                                f"in {references[column]}")
+        self.log.info(f"Profile of {table_name} ({sampled} sampled rows): {metrics}")
+
+        baseline = {metric: (average, runs) for metric, average, runs
+                    in redshift.get_records(SqlQueries.dq_profile_baseline,
+                                            parameters=(table_name, scope, self.baseline_runs))}
+        deviations = []
+        for metric, (value, _) in metrics.items():
+            # Orphans have their own absolute limit
+            if value is None or metric not in baseline or metric.endswith(".orphan_rate"):
+                continue
+            average, runs = baseline[metric]
+            if runs < self.min_baseline_runs or not average:
+                continue
+            deviation = (value - average) / abs(average)
+            if abs(deviation) > self.max_deviation:
+                deviations.append(f"{table_name} {metric} is {value:.4g}, {deviation:+.0%} from its "
+                                  f"baseline {average:.4g} over {runs} runs")
+
+        window_start = window[0] if table_dict.get("window_column") else None
+        measured_at = datetime.utcnow()
+        conn = redshift.get_conn()
+        try:
+            execute_values(conn.cursor(), SqlQueries.dq_profile_history_insert,
+                           [(table_name, scope, metric, value, text_value, window_start, context["run_id"],
+                             measured_at)
+                            for metric, (value, text_value) in metrics.items()])
+            conn.commit()
+        finally:
+            conn.close()
+        return failures, deviations
@@ -0,0 +1,40 @@
+from airflow.sensors.base_sensor_operator import BaseSensorOperator
+from airflow.utils.decorators import apply_defaults
+
+class ExclusiveRunSensor(BaseSensorOperator):
+
+    ui_color = '#E8D9A9'
+
+    @apply_defaults
+    def __init__(self,
+                 dag_ids=(),
+                 *args, **kwargs):
+        """
+        Waits until no earlier run of dag_ids is still running, so DAGs sharing
+        the staging tables (TRUNCATEd on every load) never write to Redshift at
+        the same time. Runs are served in order of their start, ties broken by
+        DAG id and execution date, so two runs started together cannot wait on
+        each other.
+
+        :param dag_ids: DAGs whose runs exclude each other, including this task's own DAG
+        """
+
+        super(ExclusiveRunSensor, self).__init__(*args, **kwargs)
+        self.dag_ids = list(dag_ids)
+
+    @staticmethod
+    def run_order(dag_run):
+        return (dag_run.start_date, dag_run.dag_id, dag_run.execution_date)
+
+    def poke(self, context):
+        from airflow.models import DagRun
+        from airflow.utils.state import State
+
+        own = context["dag_run"]
+        earlier = [dag_run for dag_id in self.dag_ids
+                   for dag_run in DagRun.find(dag_id=dag_id, state=State.RUNNING)
+                   if (dag_run.dag_id, dag_run.run_id) != (own.dag_id, own.run_id)
+                   and self.run_order(dag_run) < self.run_order(own)]
+        for dag_run in earlier:
+            self.log.info(f"Waiting for {dag_run.dag_id} {dag_run.run_id}, running since {dag_run.start_date}")
+        return not earlier
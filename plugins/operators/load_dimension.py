@@ -1,14 +1,70 @@
-from airflow.hooks.postgres_hook import PostgresHook
-from airflow.contrib.hooks.aws_hook import AwsHook
+import hashlib
+from datetime import datetime
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
-from psycopg2.extras import execute_values
-import pandas as pd
+from helpers.sql_queries import SqlQueries
 
 class LoadDimensionOperator(BaseOperator):
 
     ui_color = '#80BD9E'
 
+    template_fields = ("filter_key",)
+
+    load_modes = ("clean", "append", "upsert", "incremental")
+
+    table_columns_sql = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    """
+
+    source_columns_sql = "SELECT * FROM ({sql}) src LIMIT 0"
+
+    # One row per key, sql's dimension queries return several (a user's free and paid level)
+    upsert_stage_sql = """
+        CREATE TEMP TABLE {stage} (LIKE {table});
+        INSERT INTO {stage}
+        SELECT {source_columns}
+        FROM (
+            SELECT src.*, ROW_NUMBER() OVER (PARTITION BY {source_keys} ORDER BY {order_by}) AS upsert_rank
+            FROM ({sql}) src
+        ) ranked
+        WHERE upsert_rank = 1;
+    """
+
+    upsert_drop_unchanged_sql = """
+        DELETE FROM {stage}
+        USING {table}
+        WHERE {key_match} AND {row_match}
+    """
+
+    upsert_delete_sql = """
+        DELETE FROM {table}
+        USING {stage}
+        WHERE {key_match}
+    """
+
+    upsert_insert_sql = """
+        INSERT INTO {table}
+        SELECT * FROM {stage}
+    """
+
+    calendar_stage_sql = "CREATE TEMP TABLE {stage} (LIKE {table})"
+
+    calendar_insert_sql = """
+        INSERT INTO {table}
+        SELECT c.* FROM {stage} c
+        WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.start_time = c.start_time)
+    """
+
+    source_fingerprint_sql = """
+        SELECT (SELECT COUNT(*) FROM {source}), COUNT(*), MAX(loaded_at), SUM(size_bytes)
+        FROM public.stage_load_ledger
+        WHERE table_name = %s
+    """
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -16,13 +72,38 @@ class LoadDimensionOperator(BaseOperator):
                  table_name="",
                  sql="",
                  load_mode="clean",
+                 primary_key=None,
+                 filter_key=("", ""),
+                 calendar_freq=None,
+                 batch_size=10000,
+                 transfer_method="values",
+                 capture_slowest=0,
+                 skip_unchanged=False,
+                 source_table=None,
+                 order_by=None,
                  *args, **kwargs):
         """
         :param redshift_conn_id: RedShift Connection ID
         :param aws_credentials_id: AWS Credentials ID
         :param table_name: Table Name
         :param sql: SQL Query for loading a dimension table
-        :param load_mode: Should append to existing data, or on clean table
+        :param load_mode: clean (reload the whole table), append, upsert (merge on primary_key)
+                          or incremental (insert the rows of the filter_key window inside the warehouse,
+                          sql takes the window start and end as two %s parameters)
+        :param primary_key: Column or list of columns identifying a row, required for upsert
+        :param filter_key: Window of the incremental load
+        :param calendar_freq: Also pre-generate time dimension rows for every calendar_freq step
+                              of the window (pandas offset alias, e.g. H), incremental only
+        :param batch_size: Rows fetched and written per batch
+        :param transfer_method: values (multi-row INSERT) or copy (COPY FROM STDIN, PostgreSQL only)
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        :param skip_unchanged: Skip the load when source_table, its stage_load_ledger version and sql
+                               are unchanged since the last load and the table still has the rows
+                               that load left, tracked in load_fingerprint. Not for incremental mode
+        :param source_table: Table sql reads from, required for skip_unchanged
+        :param order_by: ORDER BY over sql's columns picking the row kept when sql returns several
+                         for a primary_key in upsert mode, e.g. ts DESC for the latest. sql may return
+                         extra columns after the table's for it. All of sql's columns by default
         """
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id   = redshift_conn_id
@@ -30,27 +111,205 @@ class LoadDimensionOperator(BaseOperator):
         self.table_name         = table_name
         self.sql                = sql
         self.load_mode          = load_mode
-        
+        self.primary_key        = [primary_key] if isinstance(primary_key, str) else list(primary_key or [])
+        self.filter_key         = filter_key
+        self.calendar_freq      = calendar_freq
+        self.batch_size         = batch_size
+        self.transfer_method    = transfer_method
+        self.capture_slowest    = capture_slowest
+        self.skip_unchanged     = skip_unchanged
+        self.source_table       = source_table
+        self.order_by           = order_by
+        if self.load_mode not in LoadDimensionOperator.load_modes:
+            raise ValueError(f"Unknown load_mode {self.load_mode}, expected one of {LoadDimensionOperator.load_modes}")
+        if self.load_mode == "upsert" and not self.primary_key:
+            raise ValueError("load_mode upsert requires primary_key")
+        if self.skip_unchanged and (not self.source_table or self.load_mode == "incremental"):
+            raise ValueError("skip_unchanged requires source_table and a non incremental load_mode")
+
     def execute(self, context):
-        # AWS Hook
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        # RedShift Hook
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        # Get number of records in the table
-        records = redshift.get_records(f"SELECT COUNT(*) FROM {self.table_name}")
-        data_rows = redshift.get_records(self.sql)
-        
+        # Hooks and drivers are imported here rather than at module level,
+        # the scheduler imports this module on every DAG file parse
+        from helpers.instrumentation import instrumented_hook
+
+        # RedShift Hook, connections are pooled per worker and every statement is measured
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+        try:
+            if self.skip_unchanged:
+                fingerprint = self.source_fingerprint(redshift)
+                if self.is_unchanged(redshift, fingerprint):
+                    self.log.info(f"{self.source_table} is unchanged since the last load of "
+                                  f"{self.table_name}, skipping")
+                    return
+            if self.load_mode == "upsert":
+                self.upsert(redshift)
+            elif self.load_mode == "incremental":
+                self.incremental_load(redshift, context)
+            else:
+                self.transfer_load(redshift)
+            if self.skip_unchanged:
+                self.record_fingerprint(redshift, fingerprint, context)
+        finally:
+            redshift.emit(context)
+
+    def transfer_load(self, redshift):
+        """
+        Stream the query result through the worker into the table, after
+        deleting the current rows in clean mode.
+        Returns the number of inserted records.
+        """
+        from helpers.transfer import BulkTransfer
+
+        pre_sql = []
         if self.load_mode == "clean":
-            # Clear data
+            # Clear data, in the same transaction as the reload
             self.log.info(f"Clearing data from {self.table_name} table")
-            redshift.run("DELETE FROM {}".format(self.table_name))
-            self.log.info(f"Deleted {records[0][0]} records from {self.table_name}")
-        
+            pre_sql.append("DELETE FROM {}".format(self.table_name))
+
         # Populate table
         self.log.info("Populating data to {} table".format(self.table_name))
-        redshift.insert_rows(table=self.table_name, 
-                                rows=data_rows,
-                                commit_every=1000, 
-                                replace=False)
-        self.log.info("Inserted {} records to {}".format(len(data_rows), self.table_name))
+        transfer = BulkTransfer(redshift, redshift,
+                                batch_size=self.batch_size,
+                                method=self.transfer_method,
+                                log=self.log,
+                                instrumentation=redshift.instrumentation)
+        result = transfer.run(self.sql, self.table_name, pre_sql=pre_sql)
+        self.log.info("Inserted {} records to {} ({:.0f} rows/sec)".format(
+            result.rows, self.table_name, result.rows_per_sec))
+        return result.rows
+
+    def upsert(self, redshift):
+        """
+        Merge the query result into the table on primary_key.
+        The new rows are loaded into a session temp table, one per key as
+        order_by ranks them first, rows identical to the current ones are
+        dropped, then the remaining keys are deleted from the table and
+        re-inserted, all in one transaction.
+        Returns the number of inserted or updated records.
+        """
+        schema, _, table = self.table_name.rpartition(".")
+        schema = schema or "public"
+        # Qualified so that names like "time" are unambiguous as column qualifiers
+        target = "{}.{}".format(schema, table)
+        stage = "{}_upsert_stage".format(table)
+
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(LoadDimensionOperator.table_columns_sql, (schema, table))
+            columns = [row[0] for row in cursor.fetchall()]
+            if not columns:
+                raise ValueError(f"Table {self.table_name} does not exist")
+            # sql's columns line up with the table's by position, any after them only serve order_by
+            cursor.execute(LoadDimensionOperator.source_columns_sql.format(sql=self.sql))
+            source_columns = ['"{}"'.format(description[0]) for description in cursor.description]
+            if len(source_columns) < len(columns):
+                raise ValueError(f"sql returns {len(source_columns)} columns, {self.table_name} has {len(columns)}")
+            source_by_column = dict(zip(columns, source_columns))
+            key_match = " AND ".join(
+                f'{target}."{key}" = {stage}."{key}"' for key in self.primary_key)
+            row_match = " AND ".join(
+                f'({target}."{column}" = {stage}."{column}" '
+                f'OR ({target}."{column}" IS NULL AND {stage}."{column}" IS NULL))'
+                for column in columns)
+            statements = {"table": target, "stage": stage, "sql": self.sql,
+                          "source_columns": ", ".join(source_columns[:len(columns)]),
+                          "source_keys": ", ".join(source_by_column[key] for key in self.primary_key),
+                          "order_by": self.order_by or ", ".join(source_columns),
+                          "key_match": key_match, "row_match": row_match}
+
+            self.log.info(f"Staging new rows for {self.table_name} in {stage}")
+            cursor.execute(LoadDimensionOperator.upsert_stage_sql.format(**statements))
+            cursor.execute(LoadDimensionOperator.upsert_drop_unchanged_sql.format(**statements))
+            self.log.info(f"Skipped {cursor.rowcount} unchanged records")
+            cursor.execute(LoadDimensionOperator.upsert_delete_sql.format(**statements))
+            self.log.info(f"Replacing {cursor.rowcount} existing records in {self.table_name}")
+            cursor.execute(LoadDimensionOperator.upsert_insert_sql.format(**statements))
+            merged = cursor.rowcount
+            cursor.execute(f"DROP TABLE {stage}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self.log.info("Upserted {} records to {}".format(merged, self.table_name))
+        return merged
+
+    def incremental_load(self, redshift, context):
+        """
+        Insert the rows sql derives for the filter_key window with one
+        INSERT ... SELECT, so the work is proportional to the window and not
+        to the table the dimension is derived from.
+        Returns the number of inserted records.
+        """
+        from psycopg2.extras import execute_values
+        from helpers.time_dimension import calendar_rows
+
+        window = (self.filter_key[0].format(**context),
+                  self.filter_key[1].format(**context))
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            self.log.info(f"Loading window [{window[0]}, {window[1]}) into {self.table_name}")
+            cursor.execute("INSERT INTO {} {}".format(self.table_name, self.sql), window)
+            inserted = cursor.rowcount
+
+            if self.calendar_freq:
+                rows = calendar_rows(window[0], window[1], self.calendar_freq)
+                stage = "{}_calendar_stage".format(self.table_name.rpartition(".")[2])
+                statements = {"table": self.table_name, "stage": stage}
+                cursor.execute(LoadDimensionOperator.calendar_stage_sql.format(**statements))
+                execute_values(cursor,
+                               "INSERT INTO {} VALUES %s".format(stage),
+                               rows,
+                               page_size=self.batch_size)
+                cursor.execute(LoadDimensionOperator.calendar_insert_sql.format(**statements))
+                self.log.info(f"Pre-generated {cursor.rowcount} of {len(rows)} calendar records")
+                inserted += cursor.rowcount
+                cursor.execute(f"DROP TABLE {stage}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self.log.info("Inserted {} records to {}".format(inserted, self.table_name))
+        return inserted
+
+    def source_fingerprint(self, redshift):
+        """
+        Hash the source's row count, its stage_load_ledger version (files, latest
+        load, bytes) and sql. The row count comes from block metadata on
+        Redshift, so the fingerprint costs no scan of the source.
+        """
+        values = redshift.get_first(LoadDimensionOperator.source_fingerprint_sql.format(source=self.source_table),
+                                    parameters=(self.source_table,))
+        return hashlib.md5("|".join([self.sql, str(self.order_by)] + [str(value) for value in values])
+                           .encode("utf-8")).hexdigest()
+
+    def target_rows(self, redshift):
+        return redshift.get_first("SELECT COUNT(*) FROM {}".format(self.table_name))[0]
+
+    def is_unchanged(self, redshift, fingerprint):
+        stored = redshift.get_first(SqlQueries.load_fingerprint_select, parameters=(self.table_name,))
+        # The row count guards against the table having been emptied or edited since
+        return stored is not None and stored[0] == fingerprint and stored[1] == self.target_rows(redshift)
+
+    def record_fingerprint(self, redshift, fingerprint, context):
+        """
+        Store the fingerprint taken before the load. Should the source change
+        during the load, the next run sees a different fingerprint and reloads.
+        """
+        target_rows = self.target_rows(redshift)
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SqlQueries.load_fingerprint_delete, (self.table_name,))
+            cursor.execute(SqlQueries.load_fingerprint_insert,
+                           (self.table_name, fingerprint, target_rows, datetime.utcnow(), context["run_id"]))
+            conn.commit()
+        finally:
+            conn.close()
@@ -1,16 +1,62 @@
-from airflow.hooks.postgres_hook import PostgresHook
-from airflow.contrib.hooks.aws_hook import AwsHook
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
-from psycopg2.extras import execute_values
-import pandas as pd
+from helpers.sql_queries import SqlQueries
+from helpers.table_specs import TABLE_SPECS
 
 class LoadFactOperator(BaseOperator):
 
     ui_color = '#F98866'
-    
+
     template_fields = ("filter_key",)
 
+    pushdown_insert_sql = """
+        INSERT INTO {} ({})
+        SELECT {}
+        FROM ({}) src
+        {}
+    """
+
+    window_select_sql = """
+        SELECT *
+        FROM ({}) src
+        {}
+    """
+
+    window_predicate_sql = "WHERE src.start_time >= %s AND src.start_time < %s"
+
+    load_modes = ("append", "clean", "replace_partition")
+
+    append_strategies = ("insert", "alter_table_append")
+
+    partition_stage_sql = """
+        CREATE {temp}TABLE {stage} AS
+        SELECT {columns}
+        FROM ({sql}) src
+        WHERE src.start_time >= %s AND src.start_time < %s
+    """
+
+    partition_delete_sql = "DELETE FROM {} WHERE start_time >= %s AND start_time < %s"
+
+    partition_insert_sql = "INSERT INTO {} ({}) SELECT {} FROM {}"
+
+    # ALTER TABLE APPEND needs matching column types, nullability and encodings, so the
+    # stage is a copy of the table's definition filled with casts
+    append_stage_sql = "CREATE TABLE {stage} (LIKE {table})"
+
+    append_stage_insert_sql = """
+        INSERT INTO {stage} ({columns})
+        SELECT {casts}
+        FROM ({sql}) src
+        WHERE src.start_time >= %s AND src.start_time < %s
+    """
+
+    alter_table_append_sql = "ALTER TABLE {} APPEND FROM {} FILLTARGET"
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -19,14 +65,51 @@ class LoadFactOperator(BaseOperator):
                  sql="",
                  load_mode="append",
                  filter_key=("", ""),
+                 pushdown=True,
+                 batch_size=10000,
+                 transfer_method="values",
+                 capture_slowest=0,
+                 partition_by=None,
+                 max_workers=4,
+                 partition_retries=2,
+                 append_strategy="insert",
+                 match_rate_sql=None,
+                 count_by=None,
+                 async_partitions=False,
+                 statement_timeout=None,
                  *args, **kwargs):
         """
         :param redshift_conn_id: RedShift Connection ID
         :param aws_credentials_id: AWS Credentials ID
         :param table_name: Table Name
         :param sql: SQL Query for loading the fact table
-        :param load_mode: Should append to existing data, or on clean table
+        :param load_mode: append (insert the filter_key window), clean (reload the whole table) or
+                          replace_partition (replace exactly the filter_key window, safe to re-run)
         :param filter_key: Filter Key for partitioning
+        :param pushdown: Run the load as a single INSERT ... SELECT inside the warehouse,
+                         set to False to stream the rows through the worker
+        :param batch_size: Rows per batch when streaming through the worker
+        :param transfer_method: values (multi-row INSERT) or copy (COPY FROM STDIN, PostgreSQL only)
+        :param partition_by: None, hour, day or month. Split the filter_key window into sub-windows that are
+                             loaded concurrently and committed independently (pushdown append only)
+        :param max_workers: Number of sub-windows loaded at the same time, each over its own connection
+        :param partition_retries: Retries of a failed sub-window before the task fails
+        :param append_strategy: How replace_partition moves the staged rows into the table:
+                                insert (INSERT ... SELECT, delete and insert commit together) or
+                                alter_table_append (ALTER TABLE APPEND, which moves blocks instead of
+                                rewriting rows but cannot run inside a transaction, so the window is
+                                briefly empty between the delete and the append; if the append
+                                fails the staged rows are inserted instead)
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        :param match_rate_sql: Query returning (source rows, matched rows) of the filter_key window,
+                               logged and sent to StatsD and XCom after the load, e.g.
+                               SqlQueries.song_match_rate
+        :param count_by: None, day or month. Record the table's row count per period of the
+                         filter_key window in load_row_count after the load
+        :param async_partitions: Drive the partition_by sub-windows over asynchronous connections
+                                 from one thread instead of a thread per sub-window, max_workers at a time
+        :param statement_timeout: With async_partitions, seconds a sub-window may take before its running
+                                  statement is cancelled on the server and the sub-window retried
         """
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id   = redshift_conn_id
@@ -35,36 +118,345 @@ class LoadFactOperator(BaseOperator):
         self.sql                = sql
         self.load_mode          = load_mode
         self.filter_key         = filter_key
-        
+        self.pushdown           = pushdown
+        self.batch_size         = batch_size
+        self.transfer_method    = transfer_method
+        self.capture_slowest    = capture_slowest
+        self.partition_by       = partition_by
+        self.max_workers        = max_workers
+        self.partition_retries  = partition_retries
+        self.append_strategy    = append_strategy
+        self.match_rate_sql     = match_rate_sql
+        self.count_by           = count_by
+        self.async_partitions   = async_partitions
+        self.statement_timeout  = statement_timeout
+        if self.load_mode not in LoadFactOperator.load_modes:
+            raise ValueError(f"Unknown load_mode {self.load_mode}, expected one of {LoadFactOperator.load_modes}")
+        if self.append_strategy not in LoadFactOperator.append_strategies:
+            raise ValueError(f"Unknown append_strategy {self.append_strategy}, "
+                             f"expected one of {LoadFactOperator.append_strategies}")
+        if self.load_mode == "replace_partition" and not self.pushdown:
+            raise ValueError("load_mode replace_partition requires pushdown")
+        if self.count_by not in (None, "day", "month"):
+            raise ValueError(f"Unknown count_by {self.count_by}, expected None, day or month")
+        if self.append_strategy == "alter_table_append" and self.partition_by:
+            raise ValueError("append_strategy alter_table_append cannot be combined with partition_by")
+        if self.async_partitions and not self.partition_by:
+            raise ValueError("async_partitions requires partition_by")
+
     def execute(self, context):
-        # AWS Hook
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        # RedShift Hook
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        # Get number of records in the table
-        records = redshift.get_records(f"SELECT COUNT(*) FROM {self.table_name}")
-        # Fields and data
-        df = redshift.get_pandas_df(self.sql)
-        fields = list(df.columns.values)
-        data_rows = redshift.get_records(self.sql)
-        
+        # Not imported at module level, DAG file parsing does not need the driver
+        from helpers.instrumentation import instrumented_hook
+
+        # RedShift Hook, connections are pooled per worker and every statement is measured
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+        try:
+            if self.pushdown:
+                self.pushdown_load(redshift, context)
+            else:
+                self.client_load(redshift, context)
+            if self.match_rate_sql:
+                self.report_match_rate(redshift, context)
+            if self.count_by:
+                self.record_row_counts(redshift, context)
+        finally:
+            redshift.emit(context)
+
+    def report_match_rate(self, redshift, context):
+        from airflow.settings import Stats
+
+        total, matched = redshift.get_first(self.match_rate_sql, parameters=self.window(context))
+        rate = matched / total if total else 0.0
+        self.log.info(f"Matched {matched} of {total} source rows ({rate:.1%})")
+        Stats.gauge("sparkify.{}.match_rate".format(self.task_id), rate)
+        context["ti"].xcom_push(key="match_rate", value={"rows": total, "matched": matched, "rate": rate})
+        return rate
+
+    def record_row_counts(self, redshift, context):
+        """Replace the load_row_count rows of the window's periods with the table's current counts."""
+        window = self.window(context)
+        statements = {"period": self.count_by, "table": self.table_name}
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SqlQueries.load_row_count_delete.format(**statements), (self.table_name,) + window)
+            cursor.execute(SqlQueries.load_row_count_insert.format(**statements),
+                           (self.table_name, context["run_id"], datetime.utcnow()) + window)
+            cursor.execute(SqlQueries.load_row_count_select.format(**statements), (self.table_name,) + window)
+            counts = cursor.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        for period_start, row_count in counts:
+            self.log.info(f"{self.table_name} {period_start:%Y-%m-%d}: {row_count} records")
+        context["ti"].xcom_push(key="row_counts", value={str(period_start): row_count
+                                                         for period_start, row_count in counts})
+        return counts
+
+    def window(self, context):
+        return (self.filter_key[0].format(**context),
+                self.filter_key[1].format(**context))
+
+    def query_fields(self, cursor):
+        # Column names come from the query itself, the target columns share them
+        cursor.execute(f"SELECT * FROM ({self.sql}) src LIMIT 0")
+        return [column[0] for column in cursor.description]
+
+    def insert_sql(self, fields, predicate):
+        return LoadFactOperator.pushdown_insert_sql.format(
+            self.table_name,
+            ", ".join(fields),
+            ", ".join("src.{}".format(field) for field in fields),
+            self.sql,
+            predicate
+        )
+
+    def pushdown_load(self, redshift, context):
+        """
+        Load the fact table with one INSERT ... SELECT executed by the warehouse.
+        In append mode the filter_key window is bound into the statement, so only
+        the inserted row count travels back to the worker.
+        Returns the number of inserted records.
+        """
+        if self.partition_by and self.load_mode != "clean":
+            return self.partitioned_load(redshift, context)
+        if self.load_mode == "replace_partition" and self.append_strategy == "alter_table_append":
+            return self.alter_table_append_load(redshift, context)
+
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            fields = self.query_fields(cursor)
+
+            self.log.info("Populating data to {} table".format(self.table_name))
+            if self.load_mode == "clean":
+                self.log.info(f"Clearing data from {self.table_name} table")
+                cursor.execute(f"DELETE FROM {self.table_name}")
+                self.log.info(f"Deleted {cursor.rowcount} records from {self.table_name}")
+                cursor.execute(self.insert_sql(fields, ""))
+                inserted = cursor.rowcount
+            else:
+                window = self.window(context)
+                self.log.info(f"Loading window [{window[0]}, {window[1]}) into {self.table_name}")
+                inserted = self.load_window(cursor, fields, window)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self.log.info("Inserted {} records to {}".format(inserted, self.table_name))
+        return inserted
+
+    def stage_name(self):
+        return "{}_partition_stage".format(self.table_name.rpartition(".")[2])
+
+    def window_statements(self, fields, window):
+        """
+        The (sql, parameters) statements loading one window, and the index of the
+        statement whose rowcount is the number of inserted records.
+        In replace_partition mode the window's rows are built in a temp table
+        first, then the window is deleted from the table and the staged rows
+        appended, so the table only changes once the expensive join is done.
+        """
+        if self.load_mode != "replace_partition":
+            return [(self.insert_sql(fields, LoadFactOperator.window_predicate_sql), window)], 0
+
+        stage = self.stage_name()
+        columns = ", ".join(fields)
+        return [
+            (LoadFactOperator.partition_stage_sql.format(
+                temp="TEMP ", stage=stage, columns=", ".join("src.{}".format(field) for field in fields),
+                sql=self.sql), window),
+            (LoadFactOperator.partition_delete_sql.format(self.table_name), window),
+            (LoadFactOperator.partition_insert_sql.format(self.table_name, columns, columns, stage), None),
+            (f"DROP TABLE {stage}", None),
+        ], 2
+
+    def load_window(self, cursor, fields, window):
+        """Load one window on cursor, without committing. Returns the number of inserted records."""
+        statements, inserted_index = self.window_statements(fields, window)
+        rowcounts = []
+        for sql, parameters in statements:
+            cursor.execute(sql, parameters)
+            rowcounts.append(cursor.rowcount)
+        if self.load_mode == "replace_partition":
+            self.log.info(f"Replaced {rowcounts[1]} records of [{window[0]}, {window[1]}) in {self.table_name}")
+        return rowcounts[inserted_index]
+
+    def append_casts(self, fields):
+        """src.<field> cast to the target column's type, where the table has a spec."""
+        spec = TABLE_SPECS.get(self.table_name.rpartition(".")[2])
+        casts = []
+        for field in fields:
+            try:
+                casts.append("CAST(src.{} AS {})".format(field, spec.column(field).data_type))
+            except (AttributeError, KeyError):
+                casts.append("src.{}".format(field))
+        return ", ".join(casts)
+
+    def alter_table_append_load(self, redshift, context):
+        """
+        replace_partition through ALTER TABLE APPEND. The source must be a
+        permanent table and the statement cannot run in a transaction block,
+        so this takes three commits: stage, delete the window, append.
+        The stage table is always dropped again.
+        Returns the number of appended records.
+        """
+        window = self.window(context)
+        stage = "{}_{}".format(self.stage_name(), context["ts_nodash"])
+        conn = redshift.get_conn()
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            fields = self.query_fields(cursor)
+            columns = ", ".join(fields)
+            cursor.execute(f"DROP TABLE IF EXISTS {stage}")
+            cursor.execute(LoadFactOperator.append_stage_sql.format(stage=stage, table=self.table_name))
+            try:
+                cursor.execute(LoadFactOperator.append_stage_insert_sql.format(
+                    stage=stage, columns=columns, casts=self.append_casts(fields), sql=self.sql), window)
+                staged = cursor.rowcount
+                cursor.execute(LoadFactOperator.partition_delete_sql.format(self.table_name), window)
+                self.log.info(f"Replacing {cursor.rowcount} records of [{window[0]}, {window[1]}) "
+                              f"in {self.table_name}")
+                try:
+                    cursor.execute(LoadFactOperator.alter_table_append_sql.format(self.table_name, stage))
+                except Exception as e:
+                    # The delete is committed already, the window must not stay empty
+                    self.log.warning(f"ALTER TABLE APPEND failed ({e}), inserting the staged records instead")
+                    cursor.execute(LoadFactOperator.partition_insert_sql.format(
+                        self.table_name, columns, columns, stage))
+            finally:
+                cursor.execute(f"DROP TABLE IF EXISTS {stage}")
+        finally:
+            conn.close()
+
+        self.log.info("Appended {} records to {}".format(staged, self.table_name))
+        return staged
+
+    def partitioned_load(self, redshift, context):
+        """
+        Split the filter_key window by partition_by and load the sub-windows
+        concurrently, each with its own INSERT ... SELECT and commit.
+        Failed sub-windows are retried on their own; the task fails once every
+        sub-window has been attempted, listing the ones that did not load.
+        Returns the number of inserted records.
+        """
+        from helpers.windows import split_window
+
+        partitions = split_window(*self.window(context), self.partition_by)
+        conn = redshift.get_conn()
+        try:
+            fields = self.query_fields(conn.cursor())
+        finally:
+            conn.close()
+
+        self.log.info(f"Loading {len(partitions)} {self.partition_by} partitions into {self.table_name} "
+                      f"with {self.max_workers} {'connections' if self.async_partitions else 'workers'}")
+        if self.async_partitions:
+            inserted, failures = self.async_partitioned_load(redshift, fields, partitions)
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                results = list(executor.map(partial(self.load_partition, redshift, fields), partitions))
+            inserted = sum(rows for rows, _ in results)
+            failures = [f"[{partition[0]}, {partition[1]}): {error}"
+                        for partition, (_, error) in zip(partitions, results) if error]
+        self.log.info("Inserted {} records to {}".format(inserted, self.table_name))
+        if failures:
+            raise ValueError("{} of {} partitions failed to load into {}:\n{}".format(
+                len(failures), len(partitions), self.table_name, "\n".join(failures)))
+        return inserted
+
+    def async_partitioned_load(self, redshift, fields, partitions):
+        """
+        Run every sub-window's transaction over its own asynchronous connection,
+        all driven by this one thread, and retry the failed ones together.
+        Returns (inserted records, failure messages).
+        """
+        from helpers.async_sql import run_transactions
+        from helpers.connections import connection_dsn
+
+        dsn = connection_dsn(self.redshift_conn_id)
+        plans = {f"[{start}, {end})": self.window_statements(fields, (start, end)) for start, end in partitions}
+        pending = list(plans)
+        inserted, errors = 0, {}
+        for attempt in range(self.partition_retries + 1):
+            results = run_transactions(dsn, {name: plans[name][0] for name in pending}, self.statement_timeout,
+                                       self.max_workers, redshift.instrumentation)
+            pending = []
+            for name, result in results.items():
+                if isinstance(result, Exception):
+                    self.log.warning(f"Partition {name} failed "
+                                     f"(attempt {attempt + 1} of {self.partition_retries + 1}): {result}")
+                    errors[name] = result
+                    pending.append(name)
+                else:
+                    rows = result[plans[name][1]]
+                    self.log.info(f"Inserted {rows} records for {name}")
+                    inserted += rows
+                    errors.pop(name, None)
+            if not pending:
+                break
+            if attempt < self.partition_retries:
+                time.sleep(2 ** attempt)
+        return inserted, [f"{name}: {error}" for name, error in errors.items()]
+
+    def load_partition(self, redshift, fields, partition):
+        """Load one sub-window in its own transaction. Returns (rows, error)."""
+        for attempt in range(self.partition_retries + 1):
+            conn = redshift.get_conn()
+            try:
+                rows = self.load_window(conn.cursor(), fields, partition)
+                conn.commit()
+                self.log.info(f"Inserted {rows} records for [{partition[0]}, {partition[1]})")
+                return rows, None
+            except Exception as e:
+                conn.rollback()
+                self.log.warning(f"Partition [{partition[0]}, {partition[1]}) failed "
+                                 f"(attempt {attempt + 1} of {self.partition_retries + 1}): {e}")
+                error = e
+            finally:
+                conn.close()
+            if attempt < self.partition_retries:
+                time.sleep(2 ** attempt)
+        return 0, error
+
+    def client_load(self, redshift, context):
+        """
+        Stream the rows through the worker in batch_size chunks.
+        The window predicate is still applied by the warehouse, so only the rows
+        that end up in the table are fetched.
+        Returns the number of inserted records.
+        """
+        from helpers.transfer import BulkTransfer
+
+        conn = redshift.get_conn()
+        try:
+            fields = self.query_fields(conn.cursor())
+        finally:
+            conn.close()
+
         if self.load_mode == "clean":
-            # Clear data
             self.log.info(f"Clearing data from {self.table_name} table")
-            redshift.run("DELETE FROM {}".format(self.table_name))
-            self.log.info(f"Deleted {records[0][0]} records from {self.table_name}")
+            pre_sql = [f"DELETE FROM {self.table_name}"]
+            predicate, parameters = "", None
         else:
-            job_execution_ts = self.filter_key[0].format(**context)
-            next_job_execution_ts = self.filter_key[1].format(**context)
-            filtered_df = df[(df['start_time'] >= job_execution_ts) & (df['start_time'] < next_job_execution_ts)]
-            data_rows = [tuple(x) for x in filtered_df.values]
-        
-        # Populate table
+            pre_sql = []
+            predicate, parameters = LoadFactOperator.window_predicate_sql, self.window(context)
+
         self.log.info("Populating data to {} table".format(self.table_name))
-        redshift.insert_rows(table=self.table_name, 
-                                rows=data_rows, 
-                                target_fields=fields, 
-                                commit_every=1000, 
-                                replace=False)
-        self.log.info("Inserted {} records to {}".format(len(data_rows), self.table_name))
+        transfer = BulkTransfer(redshift, redshift,
+                                batch_size=self.batch_size,
+                                method=self.transfer_method,
+                                log=self.log,
+                                instrumentation=redshift.instrumentation)
+        result = transfer.run(LoadFactOperator.window_select_sql.format(self.sql, predicate),
+                              self.table_name,
+                              target_fields=fields,
+                              parameters=parameters,
+                              pre_sql=pre_sql)
+        self.log.info("Inserted {} records to {} ({:.0f} rows/sec)".format(
+            result.rows, self.table_name, result.rows_per_sec))
+        return result.rows
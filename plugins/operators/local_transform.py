@@ -0,0 +1,70 @@
+import glob
+import os
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class LocalTransformOperator(BaseOperator):
+
+    ui_color = '#C2E8A9'
+
+    @apply_defaults
+    def __init__(self,
+                 input_dir="",
+                 output_dir="",
+                 log_pattern="log_data/**/*.json",
+                 song_pattern="song_data/**/*.json",
+                 postgres_conn_id=None,
+                 truncate=True,
+                 workers=None,
+                 chunk_size=100000,
+                 buckets=16,
+                 *args, **kwargs):
+        """
+        :param input_dir: Local directory with the log_data and song_data JSON files
+        :param output_dir: Directory the tables are written to as Parquet, one sub-directory per table
+        :param log_pattern: Glob of the log files under input_dir, formatted with the task
+                            context like s3_key, e.g. log_data/{execution_date.year}/**/*.json
+        :param song_pattern: Glob of the song files under input_dir
+        :param postgres_conn_id: Also load the Parquet output into this PostgreSQL connection, None to skip
+        :param truncate: Empty the PostgreSQL tables before loading
+        :param workers: Processes transforming files in parallel, None for one per core
+        :param chunk_size: Records transformed at a time per process
+        :param buckets: Hash buckets the dimensions are deduplicated in
+        """
+
+        super(LocalTransformOperator, self).__init__(*args, **kwargs)
+        self.input_dir        = input_dir
+        self.output_dir       = output_dir
+        self.log_pattern      = log_pattern
+        self.song_pattern     = song_pattern
+        self.postgres_conn_id = postgres_conn_id
+        self.truncate         = truncate
+        self.workers          = workers
+        self.chunk_size       = chunk_size
+        self.buckets          = buckets
+
+    def execute(self, context):
+        # pandas is only imported when the task runs
+        from helpers.local_engine import run_local_pipeline, load_postgres
+
+        log_files = sorted(glob.glob(os.path.join(self.input_dir, self.log_pattern.format(**context)),
+                                     recursive=True))
+        song_files = sorted(glob.glob(os.path.join(self.input_dir, self.song_pattern), recursive=True))
+        if not log_files or not song_files:
+            raise ValueError(f"Found {len(log_files)} log files and {len(song_files)} song files "
+                             f"under {self.input_dir}")
+        output_dir = self.output_dir.format(**context)
+        self.log.info(f"Transforming {len(log_files)} log files and {len(song_files)} song files into {output_dir}")
+        counts = run_local_pipeline(log_files, song_files, output_dir, self.workers, self.chunk_size,
+                                    self.buckets, self.log)
+
+        if self.postgres_conn_id:
+            from helpers.connections import get_redshift_hook
+
+            conn = get_redshift_hook(self.postgres_conn_id).get_conn()
+            try:
+                load_postgres(conn, output_dir, self.truncate, self.log)
+            finally:
+                conn.close()
+        return counts
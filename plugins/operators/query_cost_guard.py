@@ -0,0 +1,113 @@
+from datetime import datetime
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers.sql_queries import SqlQueries
+from helpers.query_plan import PlanBudget, parse_plan, summarize_plan, diff_plans
+
+class QueryCostGuardOperator(BaseOperator):
+
+    ui_color = '#E8A9A9'
+
+    on_violation_modes = ("fail", "warn")
+
+    # Redshift limits a VARCHAR to 65535 bytes
+    max_plan_bytes = 65535
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 queries=None,
+                 max_cost=None,
+                 max_rows=None,
+                 forbidden_steps=("DS_BCAST_INNER", "DS_DIST_BOTH"),
+                 allow_nested_loops=False,
+                 budgets=None,
+                 on_violation="fail",
+                 save_plans=True,
+                 *args, **kwargs):
+        """
+        :param redshift_conn_id: RedShift Connection ID
+        :param queries: dict of query name to SQL, or to (SQL, parameters) where the
+                        parameters are formatted with the task context, e.g. ("{execution_date}",)
+        :param max_cost: Highest allowed estimated total cost of a plan, None for no limit
+        :param max_rows: Highest allowed estimated rows of a plan, None for no limit
+        :param forbidden_steps: Join distribution steps no plan may contain
+        :param allow_nested_loops: Accept nested loop joins
+        :param budgets: dict of query name to a dict of the budget arguments above,
+                        overriding them for that query
+        :param on_violation: fail (raise) or warn (log) when a plan exceeds its budget
+        :param save_plans: Store every plan in query_plan and log the diff to the previous one
+        """
+
+        super(QueryCostGuardOperator, self).__init__(*args, **kwargs)
+        if on_violation not in QueryCostGuardOperator.on_violation_modes:
+            raise ValueError(f"Unknown on_violation {on_violation}, "
+                             f"expected one of {QueryCostGuardOperator.on_violation_modes}")
+        self.redshift_conn_id   = redshift_conn_id
+        self.queries            = queries or {}
+        self.max_cost           = max_cost
+        self.max_rows           = max_rows
+        self.forbidden_steps    = forbidden_steps
+        self.allow_nested_loops = allow_nested_loops
+        self.budgets            = budgets or {}
+        self.on_violation       = on_violation
+        self.save_plans         = save_plans
+
+    def budget(self, name):
+        arguments = dict(max_cost=self.max_cost, max_rows=self.max_rows,
+                         forbidden_steps=self.forbidden_steps, allow_nested_loops=self.allow_nested_loops)
+        arguments.update(self.budgets.get(name, {}))
+        return PlanBudget(**arguments)
+
+    def execute(self, context):
+        from helpers.instrumentation import instrumented_hook
+
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, log=self.log)
+        violations = []
+        summaries = {}
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            for name, query in self.queries.items():
+                sql, parameters = query if isinstance(query, tuple) else (query, None)
+                if parameters is not None:
+                    parameters = tuple(parameter.format(**context) for parameter in parameters)
+                cursor.execute("EXPLAIN " + sql, parameters)
+                lines = [row[0] for row in cursor.fetchall()]
+                plan = parse_plan(lines)
+                summaries[name] = summarize_plan(plan)
+                self.log.info(f"{name}: {summaries[name]}")
+
+                if self.save_plans:
+                    self.save_plan(cursor, name, plan, "\n".join(lines), context)
+
+                query_violations = self.budget(name).violations(plan)
+                if query_violations:
+                    self.log.warning("{} exceeds its budget:\n{}".format(name, "\n".join(lines)))
+                violations += [f"{name}: {violation}" for violation in query_violations]
+            conn.commit()
+        finally:
+            conn.close()
+            redshift.emit(context)
+
+        context["ti"].xcom_push(key="plans", value=summaries)
+        if violations and self.on_violation == "fail":
+            raise ValueError("Query plans exceed their budget.\n{}".format("\n".join(violations)))
+        for violation in violations:
+            self.log.warning(violation)
+        if not violations:
+            self.log.info(f"{len(self.queries)} query plans are within budget")
+
+    def save_plan(self, cursor, name, plan, text, context):
+        """Log the diff to the previous plan of the query and store this one."""
+        cursor.execute(SqlQueries.query_plan_select_latest, (name,))
+        previous = cursor.fetchone()
+        if previous is None:
+            self.log.info(f"First recorded plan of {name}")
+        else:
+            diff = diff_plans(previous[0], text, name)
+            self.log.info(f"Plan of {name} changed:\n{diff}" if diff else f"Plan of {name} is unchanged")
+        cursor.execute(SqlQueries.query_plan_insert,
+                       (name, datetime.utcnow(), context["run_id"], plan.total_cost, plan.rows,
+                        text.encode("utf-8")[:QueryCostGuardOperator.max_plan_bytes].decode("utf-8", "ignore")))
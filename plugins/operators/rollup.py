@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers.rollups import ROLLUPS
+from helpers.sql_queries import SqlQueries
+
+class RollupOperator(BaseOperator):
+
+    ui_color = '#D8B4E8'
+
+    template_fields = ("filter_key",)
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 rollups=None,
+                 filter_key=("", ""),
+                 rebuild=False,
+                 max_workers=4,
+                 capture_slowest=0,
+                 *args, **kwargs):
+        """
+        :param redshift_conn_id: RedShift Connection ID
+        :param rollups: Names of the ROLLUPS to update, all of them by default
+        :param filter_key: Window of the fact table merged into the rollups
+        :param rebuild: Recompute the periods the window touches instead of merging, e.g. for
+                        periods loaded before the rollups existed
+        :param max_workers: Number of rollups updated concurrently, each in its own transaction
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        """
+
+        super(RollupOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.rollups          = list(ROLLUPS) if rollups is None else rollups
+        self.filter_key       = filter_key
+        self.rebuild          = rebuild
+        self.max_workers      = max_workers
+        self.capture_slowest  = capture_slowest
+        unknown = [name for name in self.rollups if name not in ROLLUPS]
+        if unknown:
+            raise ValueError(f"Unknown rollups {unknown}, expected some of {list(ROLLUPS)}")
+
+    def execute(self, context):
+        from helpers.instrumentation import instrumented_hook
+
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+        window = (self.filter_key[0].format(**context),
+                  self.filter_key[1].format(**context))
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                rows = dict(zip(self.rollups, executor.map(partial(self.update_rollup, redshift, window, context),
+                                                           self.rollups)))
+        finally:
+            redshift.emit(context)
+        context["ti"].xcom_push(key="rollup_rows", value=rows)
+        return rows
+
+    def update_rollup(self, redshift, window, context, name):
+        """Merge (or rebuild) one rollup in one transaction, returns the rows merged or rebuilt."""
+        rollup = ROLLUPS[name]
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            # Read in the transaction that extends the ledger, a concurrent run fails instead of merging twice
+            cursor.execute(SqlQueries.rollup_window_overlaps, (name, window[1], window[0]))
+            rebuild = self.rebuild or cursor.fetchone()[0] > 0
+            if rebuild:
+                periods = rollup.period_range(*window)
+                self.log.info(f"Rebuilding {name} for {periods[0]} - {periods[1]}")
+                delete, insert = rollup.rebuild_statements()
+                cursor.execute(delete, periods)
+                cursor.execute(insert, periods)
+                rows = cursor.rowcount
+            else:
+                stage = f"{name}_stage"
+                cursor.execute(rollup.stage_statement(stage), window)
+                rows = cursor.rowcount
+                for statement in rollup.merge_statements(stage):
+                    cursor.execute(statement)
+                cursor.execute(f"DROP TABLE {stage}")
+            cursor.execute(SqlQueries.rollup_window_insert,
+                           (name, window[0], window[1], rebuild, context["run_id"], datetime.utcnow()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.log.info(f"{'Rebuilt' if rebuild else 'Merged'} {rows} rows of {name}")
+        return rows
@@ -0,0 +1,72 @@
+import hashlib
+import time
+from datetime import datetime
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from helpers.sql_queries import SqlQueries
+
+class SchemaBootstrapOperator(BaseOperator):
+
+    ui_color = '#F2D7A6'
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 statements=None,
+                 capture_slowest=0,
+                 *args, **kwargs):
+        """
+        :param redshift_conn_id: RedShift Connection ID
+        :param statements: DDL statements to apply, all SqlQueries.create_* by default
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        """
+
+        super(SchemaBootstrapOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        if statements is None:
+            statements = [getattr(SqlQueries, name) for name in sorted(vars(SqlQueries))
+                          if name.startswith("create_")]
+        self.statements       = statements
+        self.capture_slowest  = capture_slowest
+
+    def ddl_hash(self):
+        digest = hashlib.sha256()
+        for statement in self.statements:
+            # Only whitespace differences would not change the schema
+            digest.update(" ".join(statement.split()).encode("utf-8"))
+            digest.update(b";")
+        return digest.hexdigest()
+
+    def execute(self, context):
+        from helpers.instrumentation import instrumented_hook
+
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+        ddl_hash = self.ddl_hash()
+        try:
+            if redshift.get_first(SqlQueries.schema_version_exists)[0]:
+                applied = redshift.get_first(SqlQueries.schema_version_select, parameters=(ddl_hash,))
+                if applied:
+                    self.log.info(f"Schema {ddl_hash[:12]} was applied at {applied[0]}, nothing to do")
+                    return
+
+            # All of it commits together, or none of it does
+            started = time.monotonic()
+            conn = redshift.get_conn()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(SqlQueries.schema_version_table)
+                for statement in self.statements:
+                    cursor.execute(statement)
+                cursor.execute(SqlQueries.schema_version_insert,
+                               (ddl_hash, len(self.statements), datetime.utcnow(), context["run_id"]))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            self.log.info(f"Applied {len(self.statements)} DDL statements as schema {ddl_hash[:12]} "
+                          f"in {time.monotonic() - started:.2f}s")
+        finally:
+            redshift.emit(context)
@@ -1,14 +1,22 @@
-from airflow.contrib.hooks.aws_hook import AwsHook
-from airflow.hooks.postgres_hook import PostgresHook
+import time
+from datetime import datetime
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from helpers.sql_queries import SqlQueries
+from helpers.s3_manifest import list_s3_objects, split_for_slices, build_manifest
+from helpers.windows import split_window
 
 class StageToRedshiftOperator(BaseOperator):
-    
+
     ui_color = '#358140'
-    
-    template_fields = ("s3_key",)
-    
+
+    template_fields = ("s3_bucket", "s3_key", "manifest_bucket")
+
+    s3_formats = ("json", "csv", "parquet")
+
+    compressions = ("gzip", "zstd", "bzip2")
+
     copy_csv_sql = """
         COPY {}
         FROM '{}'
@@ -16,16 +24,34 @@ class StageToRedshiftOperator(BaseOperator):
         SECRET_ACCESS_KEY '{}'
         IGNOREHEADER {}
         DELIMITER '{}'
+        {}
     """
-    
+
     copy_json_sql = """
         COPY {}
         FROM '{}'
         ACCESS_KEY_ID '{}'
         SECRET_ACCESS_KEY '{}'
         FORMAT AS JSON '{}'
+        {}
+    """
+
+    # Columns are mapped by position, the files carry every column of the table
+    copy_parquet_sql = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        FORMAT AS PARQUET
+        {}
     """
 
+    slice_count_sql = "SELECT COUNT(*) FROM stv_slices"
+
+    truncate_sql = "TRUNCATE {}"
+
+    ledger_clear_sql = "DELETE FROM public.stage_load_ledger WHERE table_name = %s"
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -37,6 +63,20 @@ class StageToRedshiftOperator(BaseOperator):
                  delimiter=",",
                  ignore_headers=1,
                  json_path="auto",
+                 compression=None,
+                 compupdate=None,
+                 statupdate=None,
+                 max_error=None,
+                 truncate_columns=False,
+                 use_manifest=False,
+                 manifest_bucket="",
+                 manifest_prefix="manifests/",
+                 max_files_per_copy=None,
+                 incremental=False,
+                 truncate_before_load=False,
+                 post_load_sql=None,
+                 key_range=None,
+                 capture_slowest=0,
                  *args, **kwargs):
         """
         :param redshift_conn_id: RedShift Connection ID
@@ -44,10 +84,36 @@ class StageToRedshiftOperator(BaseOperator):
         :param table_name: Table Name
         :param s3_bucket: Name of the S3 Bucket
         :param s3_key: Key for partitioning
-        :param s3_format: json or csv
+        :param s3_format: json, csv or parquet (e.g. written by ConvertEventsOperator)
         :param delimiter: Delimiter for CSV format
         :param ignore_headers: Flag to ignore headers for CSV files
         :param json_path: auto or you can pass a json path
+        :param compression: None, gzip, zstd or bzip2. Not for parquet, the files compress themselves
+        :param compupdate: True/False for COMPUPDATE ON/OFF, None to leave the default
+        :param statupdate: True/False for STATUPDATE ON/OFF, None to leave the default
+        :param max_error: MAXERROR, None to leave the default
+        :param truncate_columns: Add TRUNCATECOLUMNS
+        :param use_manifest: List the s3_key prefix and COPY through generated manifests
+        :param manifest_bucket: Writable bucket the manifests are uploaded to
+        :param manifest_prefix: Key prefix of the uploaded manifests
+        :param max_files_per_copy: Files per manifest, rounded down to a multiple of
+                                   the cluster's slice count, None for a single COPY
+        :param incremental: Only COPY objects that are new since their last successful load,
+                            tracked in stage_load_ledger. An object whose ETag or size changed
+                            since fails the run, its earlier rows would stay staged next to the
+                            new ones. Requires use_manifest
+        :param truncate_before_load: TRUNCATE the table before copying, so it only holds this
+                                     run's files instead of growing every run. Also clears the
+                                     table's stage_load_ledger rows, so incremental loads copy
+                                     everything again
+        :param post_load_sql: Statements run after the COPY in the same transaction, e.g. to
+                              maintain a table derived from the staged rows. They also run when
+                              there are no new files, so they have to be idempotent
+        :param key_range: (start, end) formatted with the task context, e.g. for a backfill.
+                          s3_key is rendered once per calendar month of [start, end) with
+                          execution_date set to the month's start, and the files of all those
+                          prefixes are copied through one set of manifests. Requires use_manifest
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
         """
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -57,40 +123,240 @@ class StageToRedshiftOperator(BaseOperator):
         self.s3_bucket          = s3_bucket
         self.s3_key             = s3_key
         self.s3_format          = s3_format
+        if self.s3_format not in StageToRedshiftOperator.s3_formats:
+            raise ValueError(f"Unknown s3_format {self.s3_format}, expected one of {StageToRedshiftOperator.s3_formats}")
         if self.s3_format == "csv":
             self.delimiter = delimiter
             self.ignore_headers = ignore_headers
         if self.s3_format == "json":
             self.json_path = json_path
-            
-    
+        if compression and compression.lower() not in StageToRedshiftOperator.compressions:
+            raise ValueError(f"Unknown compression {compression}, expected one of {StageToRedshiftOperator.compressions}")
+        if self.s3_format == "parquet" and (compression or max_error is not None or truncate_columns):
+            raise ValueError("s3_format parquet does not take compression, max_error or truncate_columns")
+        if use_manifest and not manifest_bucket:
+            raise ValueError("use_manifest requires manifest_bucket")
+        if incremental and not use_manifest:
+            raise ValueError("incremental requires use_manifest")
+        if key_range and not use_manifest:
+            raise ValueError("key_range requires use_manifest")
+        self.compression        = compression
+        self.compupdate         = compupdate
+        self.statupdate         = statupdate
+        self.max_error          = max_error
+        self.truncate_columns   = truncate_columns
+        self.use_manifest       = use_manifest
+        self.manifest_bucket    = manifest_bucket
+        self.manifest_prefix    = manifest_prefix
+        self.max_files_per_copy = max_files_per_copy
+        self.incremental        = incremental
+        self.truncate_before_load = truncate_before_load
+        self.post_load_sql      = [post_load_sql] if isinstance(post_load_sql, str) else list(post_load_sql or [])
+        self.key_range          = key_range
+        self.capture_slowest    = capture_slowest
+
     def execute(self, context):
-        # AWS Hook
-        aws_hook = AwsHook(self.aws_credentials_id)
-        credentials = aws_hook.get_credentials()
-        # RedShift Hook
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        
+        # boto3 and psycopg2 are only loaded when the task runs, not on DAG parse
+        from helpers.connections import get_aws_credentials
+        from helpers.instrumentation import instrumented_hook
+
+        # RedShift Hook, connections are pooled per worker and every statement is measured
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+
         self.log.info("Copying data from S3 to Redshift")
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
-        
+        rendered_keys = self.rendered_keys(context)
+
+        try:
+            if self.truncate_before_load:
+                self.truncate(redshift)
+            if self.use_manifest:
+                self.copy_with_manifests(redshift, rendered_keys, context)
+            else:
+                s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_keys[0])
+                started = time.monotonic()
+                redshift.run([self.copy_sql(get_aws_credentials(self.aws_credentials_id), s3_path)]
+                             + self.post_load_sql)
+                self.log.info(f"Copied {s3_path} into {self.table_name} in {time.monotonic() - started:.2f}s")
+        finally:
+            redshift.emit(context)
+
+    def rendered_keys(self, context):
+        """The s3_key prefixes to copy: one per month of key_range, or s3_key alone."""
+        if not self.key_range:
+            return [self.s3_key.format(**context)]
+        start, end = (bound.format(**context) for bound in self.key_range)
+        keys = []
+        for month_start, _ in split_window(start, end, "month"):
+            key = self.s3_key.format(**dict(context, execution_date=month_start))
+            if key not in keys:
+                keys.append(key)
+        self.log.info(f"Copying {len(keys)} prefixes of [{start}, {end})")
+        return keys
+
+    def truncate(self, redshift):
+        """
+        Empty the table and its ledger rows. TRUNCATE commits implicitly on Redshift,
+        so the ledger delete goes first and is committed with it; a failed COPY
+        afterwards leaves both empty and the retry loads everything.
+        """
+        started = time.monotonic()
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(StageToRedshiftOperator.ledger_clear_sql, (self.table_name,))
+            cursor.execute(StageToRedshiftOperator.truncate_sql.format(self.table_name))
+            conn.commit()
+        finally:
+            conn.close()
+        self.log.info(f"Truncated {self.table_name} in {time.monotonic() - started:.2f}s")
+
+    def copy_options(self, manifest=False):
+        options = []
+        if manifest:
+            options.append("MANIFEST")
+        if self.compression:
+            options.append(self.compression.upper())
+        if self.compupdate is not None:
+            options.append("COMPUPDATE {}".format("ON" if self.compupdate else "OFF"))
+        if self.statupdate is not None:
+            options.append("STATUPDATE {}".format("ON" if self.statupdate else "OFF"))
+        if self.max_error is not None:
+            options.append("MAXERROR {}".format(int(self.max_error)))
+        if self.truncate_columns:
+            options.append("TRUNCATECOLUMNS")
+        return "\n        ".join(options)
+
+    def copy_sql(self, credentials, s3_path, manifest=False):
         if self.s3_format == "csv":
-            formatted_sql = StageToRedshiftOperator.copy_csv_sql.format(
+            return StageToRedshiftOperator.copy_csv_sql.format(
                 self.table_name,
                 s3_path,
                 credentials.access_key,
                 credentials.secret_key,
                 self.ignore_headers,
-                self.delimiter
+                self.delimiter,
+                self.copy_options(manifest)
             )
-        else:
-            formatted_sql = StageToRedshiftOperator.copy_json_sql.format(
+        if self.s3_format == "parquet":
+            return StageToRedshiftOperator.copy_parquet_sql.format(
                 self.table_name,
                 s3_path,
                 credentials.access_key,
                 credentials.secret_key,
-                self.json_path
+                self.copy_options(manifest)
             )
-            
-        redshift.run(formatted_sql)
+        return StageToRedshiftOperator.copy_json_sql.format(
+            self.table_name,
+            s3_path,
+            credentials.access_key,
+            credentials.secret_key,
+            self.json_path,
+            self.copy_options(manifest)
+        )
+
+    def copy_with_manifests(self, redshift, rendered_keys, context):
+        """
+        List the rendered prefixes, split the files into manifests sized to the
+        cluster's slice count and run one COPY per manifest, all in one transaction.
+        In incremental mode the ledger is updated in that same transaction.
+        """
+        from airflow.hooks.S3_hook import S3Hook
+        from helpers.connections import get_aws_credentials
+
+        s3_client = S3Hook(aws_conn_id=self.aws_credentials_id).get_conn()
+        objects = {}
+        for rendered_key in rendered_keys:
+            # Keyed on the object key, so overlapping prefixes list a file once
+            objects.update((s3_object.key, s3_object)
+                           for s3_object in list_s3_objects(s3_client, self.s3_bucket, rendered_key))
+        objects = list(objects.values())
+        if self.incremental:
+            objects = self.unloaded_objects(redshift, objects)
+        if not objects:
+            self.log.info(f"No new files found under s3://{self.s3_bucket}/{', '.join(rendered_keys)}")
+            if self.post_load_sql:
+                redshift.run(self.post_load_sql)
+            return
+
+        num_slices = redshift.get_first(StageToRedshiftOperator.slice_count_sql)[0]
+        total_bytes = sum(s3_object.size for s3_object in objects)
+        self.log.info(f"Found {len(objects)} files ({total_bytes} bytes) for {num_slices} slices")
+        if len(objects) % num_slices:
+            self.log.info(f"{len(objects)} files is not a multiple of {num_slices} slices, "
+                          f"some slices will sit idle during the last round of the COPY")
+
+        groups = split_for_slices(objects, num_slices, self.max_files_per_copy)
+        # Credentials are only resolved once there is something to copy
+        credentials = get_aws_credentials(self.aws_credentials_id)
+        statements = []
+        for index, group in enumerate(groups):
+            for s3_object in group:
+                self.log.info(f"  s3://{self.s3_bucket}/{s3_object.key}: {s3_object.size} bytes")
+            manifest_key = "{}{}/{}/{}.manifest".format(
+                self.manifest_prefix, self.table_name, context["ts_nodash"], index)
+            s3_client.put_object(Bucket=self.manifest_bucket,
+                                 Key=manifest_key,
+                                 Body=build_manifest(self.s3_bucket, group).encode("utf-8"))
+            self.log.info(f"Manifest {index + 1}/{len(groups)}: {len(group)} files, "
+                          f"{sum(s3_object.size for s3_object in group)} bytes")
+            statements.append(self.copy_sql(credentials,
+                                            "s3://{}/{}".format(self.manifest_bucket, manifest_key),
+                                            manifest=True))
+
+        started = time.monotonic()
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            for statement in self.post_load_sql:
+                cursor.execute(statement)
+                self.log.info(f"Post load statement affected {cursor.rowcount} rows")
+            if self.incremental:
+                self.record_loads(cursor, objects, context)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.log.info(f"Copied {len(objects)} files ({total_bytes} bytes) into {self.table_name} "
+                      f"in {time.monotonic() - started:.2f}s")
+
+    def s3_path(self, s3_object):
+        return "s3://{}/{}".format(self.s3_bucket, s3_object.key)
+
+    def unloaded_objects(self, redshift, objects):
+        """
+        Drop the objects whose ETag and size match their last recorded load.
+        A staged row does not record the file it came from, so the rows of an
+        object that changed since its load cannot be replaced; copying it again
+        would duplicate them and the run fails instead.
+        """
+        loaded = {}
+        # Ordered by load time, so the latest load of a path wins
+        for s3_path, etag, size in redshift.get_records(SqlQueries.stage_load_ledger_select,
+                                                        parameters=(self.table_name,)):
+            loaded[s3_path] = (etag, size)
+        pending = [s3_object for s3_object in objects
+                   if loaded.get(self.s3_path(s3_object)) != (s3_object.etag, s3_object.size)]
+        changed = [self.s3_path(s3_object) for s3_object in pending if self.s3_path(s3_object) in loaded]
+        if changed:
+            raise ValueError(f"{len(changed)} files changed since they were loaded into {self.table_name}, "
+                             f"e.g. {changed[:5]}. Reload it with truncate_before_load")
+        self.log.info(f"{len(objects) - len(pending)} of {len(objects)} files already loaded "
+                      f"into {self.table_name}, {len(pending)} to copy")
+        return pending
+
+    def record_loads(self, cursor, objects, context):
+        from psycopg2.extras import execute_values
+
+        loaded_at = datetime.utcnow()
+        execute_values(cursor,
+                       SqlQueries.stage_load_ledger_insert,
+                       [(self.table_name,
+                         self.s3_path(s3_object),
+                         s3_object.etag,
+                         s3_object.size,
+                         loaded_at,
+                         context["run_id"]) for s3_object in objects])
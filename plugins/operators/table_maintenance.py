@@ -0,0 +1,95 @@
+import time
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+class TableMaintenanceOperator(BaseOperator):
+
+    ui_color = '#A9C6E8'
+
+    table_info_sql = """
+        SELECT "table", unsorted, stats_off, tbl_rows, estimated_visible_rows
+        FROM svv_table_info
+        WHERE "schema" = %s AND "table" IN %s
+    """
+
+    vacuum_full_sql = "VACUUM FULL {} TO {} PERCENT"
+
+    vacuum_delete_sql = "VACUUM DELETE ONLY {} TO {} PERCENT"
+
+    analyze_sql = "ANALYZE {}"
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 tables=(),
+                 schema="public",
+                 unsorted_threshold=10.0,
+                 deleted_threshold=10.0,
+                 stats_off_threshold=10.0,
+                 vacuum_to_percent=99,
+                 capture_slowest=0,
+                 *args, **kwargs):
+        """
+        :param redshift_conn_id: RedShift Connection ID
+        :param tables: Names of the tables to maintain
+        :param schema: Schema of the tables
+        :param unsorted_threshold: VACUUM FULL (sort and reclaim) a table with more unsorted rows, in percent
+        :param deleted_threshold: VACUUM DELETE ONLY a table with more deleted rows, in percent
+        :param stats_off_threshold: ANALYZE a table whose statistics are more stale, in percent
+        :param vacuum_to_percent: Sort threshold passed to VACUUM ... TO n PERCENT
+        :param capture_slowest: Record Redshift query ids and EXPLAIN plans of this many slowest statements
+        """
+
+        super(TableMaintenanceOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id    = redshift_conn_id
+        self.tables              = tables
+        self.schema              = schema
+        self.unsorted_threshold  = unsorted_threshold
+        self.deleted_threshold   = deleted_threshold
+        self.stats_off_threshold = stats_off_threshold
+        self.vacuum_to_percent   = vacuum_to_percent
+        self.capture_slowest     = capture_slowest
+        # An empty tuple would render the invalid "table" IN ()
+        if not self.tables:
+            raise ValueError("tables must name at least one table to maintain")
+
+    def execute(self, context):
+        from helpers.instrumentation import instrumented_hook
+
+        redshift = instrumented_hook(self.redshift_conn_id, self.task_id, self.capture_slowest, self.log)
+        try:
+            statements = self.maintenance_statements(redshift)
+            # VACUUM cannot run inside a transaction and the cluster runs one VACUUM at a time,
+            # so the statements go one by one in autocommit
+            for statement in statements:
+                started = time.monotonic()
+                redshift.run(statement, autocommit=True)
+                self.log.info(f"{statement} took {time.monotonic() - started:.2f}s")
+        finally:
+            redshift.emit(context)
+        if not statements:
+            self.log.info(f"{len(self.tables)} tables are within the thresholds, nothing to do")
+
+    def maintenance_statements(self, redshift):
+        """Read svv_table_info and return the VACUUM and ANALYZE statements the tables need."""
+        statements = []
+        records = redshift.get_records(TableMaintenanceOperator.table_info_sql,
+                                       parameters=(self.schema, tuple(self.tables)))
+        for table, unsorted, stats_off, tbl_rows, visible_rows in records:
+            qualified_name = "{}.{}".format(self.schema, table)
+            unsorted = float(unsorted or 0)
+            stats_off = float(stats_off or 0)
+            # tbl_rows still counts rows that are deleted but not vacuumed yet
+            deleted = 100.0 * (tbl_rows - visible_rows) / tbl_rows if tbl_rows and visible_rows is not None else 0.0
+            self.log.info(f"{qualified_name}: {tbl_rows} rows, {unsorted:.1f}% unsorted, "
+                          f"{deleted:.1f}% deleted, stats {stats_off:.1f}% off")
+            if unsorted > self.unsorted_threshold:
+                statements.append(TableMaintenanceOperator.vacuum_full_sql.format(qualified_name,
+                                                                                  self.vacuum_to_percent))
+            elif deleted > self.deleted_threshold:
+                statements.append(TableMaintenanceOperator.vacuum_delete_sql.format(qualified_name,
+                                                                                    self.vacuum_to_percent))
+            if stats_off > self.stats_off_threshold:
+                statements.append(TableMaintenanceOperator.analyze_sql.format(qualified_name))
+        return statements
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Airflow puts plugins/ on sys.path, the tests import helpers and operators the same way
+sys.path.insert(0, os.path.join(ROOT, "plugins"))
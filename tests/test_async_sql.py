@@ -0,0 +1,43 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+DSN = os.environ.get("SPARKIFY_TEST_DSN")
+
+pytestmark = pytest.mark.skipif(not DSN, reason="set SPARKIFY_TEST_DSN to a Postgres or Redshift DSN")
+
+
+def test_transactions_run_concurrently():
+    from helpers.async_sql import run_transactions
+
+    started = time.monotonic()
+    results = run_transactions(DSN, {f"sleep{index}": ["SELECT pg_sleep(1)"] for index in range(4)},
+                               max_concurrency=4)
+    elapsed = time.monotonic() - started
+
+    assert all(not isinstance(result, Exception) for result in results.values()), results
+    # Serially the four sleeps take 4s
+    assert elapsed < 2.5
+
+
+def test_max_concurrency_bounds_the_transactions():
+    from helpers.async_sql import run_transactions
+
+    started = time.monotonic()
+    run_transactions(DSN, {f"sleep{index}": ["SELECT pg_sleep(1)"] for index in range(4)}, max_concurrency=2)
+
+    assert time.monotonic() - started >= 2
+
+
+def test_timeout_cancels_the_running_statement():
+    from helpers.async_sql import run_transactions
+
+    started = time.monotonic()
+    results = run_transactions(DSN, {"slow": ["SELECT pg_sleep(30)"], "fast": ["SELECT 1"]}, timeout=1)
+
+    assert isinstance(results["slow"], TimeoutError)
+    assert results["fast"] == [1]
+    assert time.monotonic() - started < 10
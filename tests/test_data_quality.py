@@ -0,0 +1,73 @@
+import ast
+import os
+import re
+
+import pytest
+
+from conftest import ROOT
+from helpers.table_specs import TABLE_SPECS
+
+DAG_FILES = ["dags/udac_example_dag.py", "dags/sparkify_backfill_dag.py"]
+
+
+def dq_table_info(dag_file):
+    """The table_info_dict literal of the DAG file's DataQualityOperator, read without importing Airflow."""
+    with open(os.path.join(ROOT, dag_file)) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, "id", None) == "DataQualityOperator":
+            for keyword in node.keywords:
+                if keyword.arg == "table_info_dict":
+                    return ast.literal_eval(keyword.value)
+    raise AssertionError(f"{dag_file} has no DataQualityOperator")
+
+
+def column_names(table_name):
+    return {column.name.lower() for column in TABLE_SPECS[table_name].columns}
+
+
+@pytest.mark.parametrize("dag_file", DAG_FILES)
+def test_dq_columns_exist(dag_file):
+    for table_dict in dq_table_info(dag_file):
+        table_name = table_dict["table_name"]
+        not_null = table_dict.get("not_null") or []
+        columns = [not_null] if isinstance(not_null, str) else list(not_null)
+        columns += list(table_dict.get("profile") or [])
+        columns += list(table_dict.get("references") or {})
+        columns += [table_dict[key] for key in ("unique", "window_column") if table_dict.get(key)]
+        for column in columns:
+            assert column.lower() in column_names(table_name), f"{table_name} has no column {column}"
+        for reference in (table_dict.get("references") or {}).values():
+            table, key = reference.rsplit(".", 1)
+            assert key.lower() in column_names(table), f"{table} has no column {key}"
+
+
+@pytest.mark.parametrize("dag_file", DAG_FILES)
+def test_profile_sql_uses_table_columns(dag_file):
+    pytest.importorskip("airflow")
+    from operators.data_quality import DataQualityOperator
+
+    table_info = dq_table_info(dag_file)
+    operator = DataQualityOperator(task_id="dq", table_info_dict=table_info)
+    for table_dict in table_info:
+        if not (table_dict.get("profile") or table_dict.get("references")):
+            continue
+        sql, parameters = operator.profile_sql_for(table_dict, ("2018-11-01", "2018-12-01"))
+        for column in re.findall(r"\bs\.(\w+)", sql):
+            assert column.lower() in column_names(table_dict["table_name"])
+        for key, table in re.findall(r"SELECT DISTINCT (\w+) FROM (\w+)", sql):
+            assert key.lower() in column_names(table)
+        assert sql.count("%s") == len(parameters)
+
+
+def test_window_column_reference_reads_only_the_window():
+    pytest.importorskip("airflow")
+    from operators.data_quality import DataQualityOperator
+
+    table_dict = {"table_name": "songplays", "window_column": "start_time",
+                  "references": {"user_id": "users.userid", "start_time": "time.start_time"}}
+    operator = DataQualityOperator(task_id="dq", table_info_dict=[table_dict])
+    sql, parameters = operator.profile_sql_for(table_dict, ("2018-11-01", "2018-12-01"))
+    assert "SELECT DISTINCT userid FROM users)" in sql
+    assert "SELECT DISTINCT start_time FROM time WHERE start_time >= %s AND start_time < %s)" in sql
+    assert parameters == ("2018-11-01", "2018-12-01") * 2
@@ -0,0 +1,52 @@
+import glob
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+
+def event(page, ts, **fields):
+    record = {"artist": "Des'ree", "auth": "Logged In", "firstName": "Kaylee", "gender": "F", "itemInSession": 1,
+              "lastName": "Summers", "length": 246.3, "level": "free", "location": "Phoenix, AZ", "method": "PUT",
+              "page": page, "registration": 1540344794796.0, "sessionId": 139, "song": "You Gotta Be",
+              "status": 200, "ts": ts, "userAgent": "Mozilla/5.0", "userId": "8"}
+    record.update(fields)
+    return record
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    directory = tmp_path / "log_data"
+    directory.mkdir()
+    events = [
+        event("NextSong", 1541106106796),                # 2018-11-01
+        event("Home", 1541106132796),
+        event("NextSong", 1541192506796, sessionId=12),  # 2018-11-02
+        event("NextSong", None),
+        event("NextSong", "not a timestamp"),
+    ]
+    (directory / "2018-11-01-events.json").write_text("\n".join(json.dumps(e) for e in events) + "\n")
+    return directory
+
+
+def test_convert_events(log_dir, tmp_path):
+    import pyarrow.parquet as pq
+
+    from helpers.event_conversion import convert_events, staging_schema
+
+    output_dir = str(tmp_path / "parquet")
+    stats = convert_events(sorted(glob.glob(str(log_dir / "*.json"))), output_dir, workers=1, chunk_size=2)
+
+    assert stats["records_read"] == 5
+    assert stats["records_kept"] == 2
+    assert stats["records_without_ts"] == 2
+    assert sorted(os.listdir(output_dir)) == ["event_date=2018-11-01", "event_date=2018-11-02"]
+
+    table = pq.ParquetFile(os.path.join(output_dir, "event_date=2018-11-02", "part-0.parquet")).read()
+    # A Parquet COPY maps columns by position, the file must follow the table's order
+    assert table.schema.names == staging_schema().names
+    assert table.column("sessionId").to_pylist() == ["12"]
+    assert table.column("method").null_count == 1
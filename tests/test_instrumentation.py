@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("airflow")
+
+from helpers.instrumentation import Instrumentation
+
+
+def test_replace_partition_counts_each_row_once():
+    instrumentation = Instrumentation("load_songplays")
+    statements = [
+        ("CREATE TEMP TABLE songplays_partition_stage AS SELECT 1", 100),
+        ("DELETE FROM songplays WHERE start_time >= %s AND start_time < %s", 40),
+        ("INSERT INTO songplays (start_time) SELECT start_time FROM songplays_partition_stage", 100),
+        ("DROP TABLE songplays_partition_stage", -1),
+    ]
+    for sql, rows in statements:
+        instrumentation.record_statement(sql, 0.1, rows, len(sql))
+
+    summary = instrumentation.summary()
+    assert (summary["rows_written"], summary["rows_deleted"], summary["rows_updated"]) == (100, 40, 0)
+
+
+def test_stage_tables_are_not_counted():
+    instrumentation = Instrumentation("rollup")
+    for sql, rows in [("INSERT INTO songplays_partition_stage_20181101T000000 SELECT 1", 10),
+                      ("DELETE FROM users_upsert_stage USING public.users WHERE 1 = 1", 3),
+                      ('UPDATE public."songplays_daily_song" SET plays = 1', 7),
+                      ("COPY staging_events FROM 's3://udacity-dend/log_data' ACCESS_KEY_ID 'key'", 8056)]:
+        instrumentation.record_statement(sql, 0.1, rows, len(sql))
+
+    summary = instrumentation.summary()
+    assert (summary["rows_written"], summary["rows_deleted"], summary["rows_updated"]) == (8056, 0, 7)
+    assert "'key'" not in instrumentation.statements[-1].sql
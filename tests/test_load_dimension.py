@@ -0,0 +1,207 @@
+import os
+
+import pytest
+
+pytest.importorskip("airflow")
+
+from helpers.sql_queries import SqlQueries
+from operators.load_dimension import LoadDimensionOperator
+
+USERS_COLUMNS = ["userid", "first_name", "last_name", "gender", "level"]
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, sql, parameters=None):
+        self.conn.statements.append(" ".join(sql.split()))
+        if "information_schema.columns" in sql:
+            self.result = [(column,) for column in self.conn.columns]
+        elif sql.startswith("SELECT * FROM ("):
+            self.description = [(name,) for name in self.conn.source_columns]
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeConnection:
+
+    def __init__(self, columns, source_columns):
+        self.columns        = columns
+        self.source_columns = source_columns
+        self.statements     = []
+        self.committed      = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeHook:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get_conn(self):
+        return self.conn
+
+
+def users_operator(**kwargs):
+    return LoadDimensionOperator(task_id="load_users", table_name="users", sql=SqlQueries.user_table_upsert,
+                                 load_mode="upsert", primary_key="userid", **kwargs)
+
+
+def test_upsert_stages_one_row_per_key():
+    conn = FakeConnection(USERS_COLUMNS, ["userid", "firstname", "lastname", "gender", "level", "ts"])
+
+    users_operator(order_by="ts DESC").upsert(FakeHook(conn))
+
+    stage = next(statement for statement in conn.statements if statement.startswith("CREATE TEMP TABLE"))
+    assert 'SELECT "userid", "firstname", "lastname", "gender", "level" FROM (' in stage
+    assert 'ROW_NUMBER() OVER (PARTITION BY "userid" ORDER BY ts DESC) AS upsert_rank' in stage
+    assert stage.endswith("WHERE upsert_rank = 1;")
+    assert conn.committed
+
+
+def test_upsert_orders_by_every_column_by_default():
+    conn = FakeConnection(["artistid", "name"], ["artist_id", "artist_name"])
+
+    LoadDimensionOperator(task_id="load_artists", table_name="artists", sql=SqlQueries.artist_table_insert,
+                          load_mode="upsert", primary_key="artistid").upsert(FakeHook(conn))
+
+    stage = next(statement for statement in conn.statements if statement.startswith("CREATE TEMP TABLE"))
+    assert 'PARTITION BY "artist_id" ORDER BY "artist_id", "artist_name"' in stage
+
+
+def test_upsert_rejects_sql_with_fewer_columns_than_the_table():
+    conn = FakeConnection(USERS_COLUMNS, ["userid", "level"])
+
+    with pytest.raises(ValueError):
+        users_operator().upsert(FakeHook(conn))
+
+
+@pytest.mark.skipif(not os.environ.get("SPARKIFY_TEST_DSN"), reason="set SPARKIFY_TEST_DSN to a Postgres DSN")
+def test_upsert_keeps_the_latest_level_of_a_user():
+    psycopg2 = pytest.importorskip("psycopg2")
+
+    class PostgresHook:
+        def get_conn(self):
+            return psycopg2.connect(os.environ["SPARKIFY_TEST_DSN"])
+
+    setup = psycopg2.connect(os.environ["SPARKIFY_TEST_DSN"])
+    setup.autocommit = True
+    cursor = setup.cursor()
+    cursor.execute("CREATE TABLE upsert_test_users (userid int4 PRIMARY KEY, first_name varchar, "
+                   "last_name varchar, gender varchar, level varchar)")
+    cursor.execute("CREATE TABLE upsert_test_events (userid int4, firstname varchar, lastname varchar, "
+                   "gender varchar, level varchar, ts int8)")
+    try:
+        cursor.execute("INSERT INTO upsert_test_users VALUES (8, 'Kaylee', 'Summers', 'F', 'free')")
+        cursor.execute("INSERT INTO upsert_test_events VALUES (8, 'Kaylee', 'Summers', 'F', 'free', 1), "
+                       "(8, 'Kaylee', 'Summers', 'F', 'paid', 2), (9, 'Wyatt', 'Scott', 'M', 'free', 1)")
+
+        LoadDimensionOperator(task_id="load_users", table_name="upsert_test_users",
+                              sql="SELECT userid, firstname, lastname, gender, level, ts FROM upsert_test_events",
+                              load_mode="upsert", primary_key="userid", order_by="ts DESC").upsert(PostgresHook())
+
+        cursor.execute("SELECT userid, level FROM upsert_test_users ORDER BY userid")
+        assert cursor.fetchall() == [(8, "paid"), (9, "free")]
+    finally:
+        cursor.execute("DROP TABLE upsert_test_users")
+        cursor.execute("DROP TABLE upsert_test_events")
+        setup.close()
+
+
+class FingerprintHook:
+    """Serves the source fingerprint, load_fingerprint and the target's row count."""
+
+    def __init__(self, ledger=(100, 3, "2018-11-30 12:00:00", 4096), target_rows=50):
+        self.ledger      = ledger
+        self.target_rows = target_rows
+        self.stored      = None
+
+    def get_first(self, sql, parameters=None):
+        if "stage_load_ledger" in sql:
+            return self.ledger
+        if "load_fingerprint" in sql:
+            return self.stored
+        return (self.target_rows,)
+
+    def get_conn(self):
+        return FingerprintConnection(self)
+
+    def emit(self, context):
+        pass
+
+
+class FingerprintConnection:
+
+    def __init__(self, hook):
+        self.hook = hook
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, parameters=None):
+        if sql.strip().startswith("INSERT INTO public.load_fingerprint"):
+            self.hook.stored = (parameters[1], parameters[2])
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def songs_load(monkeypatch):
+    """Runs the songs load on a FingerprintHook and returns whether it loaded."""
+    hook = FingerprintHook()
+    monkeypatch.setattr("helpers.instrumentation.instrumented_hook", lambda *args, **kwargs: hook)
+
+    def run(sql=SqlQueries.song_table_insert):
+        loads = []
+        operator = LoadDimensionOperator(task_id="load_songs", table_name="songs", sql=sql, load_mode="upsert",
+                                         primary_key="songid", skip_unchanged=True, source_table="staging_songs")
+        operator.upsert = loads.append
+        operator.execute({"run_id": "scheduled__2018-11-01T00:00:00+00:00"})
+        return bool(loads)
+
+    run.hook = hook
+    return run
+
+
+def test_skip_unchanged_skips_an_unchanged_source(songs_load):
+    assert songs_load()
+    assert not songs_load()
+
+
+def test_skip_unchanged_reloads_after_a_ledger_change(songs_load):
+    assert songs_load()
+    songs_load.hook.ledger = (120, 4, "2018-12-01 12:00:00", 5120)
+    assert songs_load()
+    assert not songs_load()
+
+
+def test_skip_unchanged_reloads_when_the_table_changed(songs_load):
+    assert songs_load()
+    songs_load.hook.target_rows = 0
+    assert songs_load()
+
+
+def test_skip_unchanged_reloads_after_a_sql_change(songs_load):
+    assert songs_load()
+    assert songs_load(SqlQueries.song_table_insert + " WHERE year > 0")
@@ -0,0 +1,36 @@
+import glob
+import os
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+from conftest import ROOT
+
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+
+def test_run_local_pipeline(tmp_path):
+    """
+    The fixture has a song listed twice (the join matches both staging rows),
+    a song and a NextSong event without title / artist (never joined, SQL's =
+    does not match NULL), an event matching no song and a user who went from
+    free to paid.
+    """
+    import pandas as pd
+
+    from helpers.local_engine import run_local_pipeline
+
+    output_dir = str(tmp_path / "tables")
+    counts = run_local_pipeline(sorted(glob.glob(os.path.join(FIXTURES, "log_data", "*.json"))),
+                                sorted(glob.glob(os.path.join(FIXTURES, "song_data", "*.json"))),
+                                output_dir, workers=1, chunk_size=2, buckets=2)
+
+    assert counts == {"songplays": 3, "users": 3, "songs": 3, "artists": 3, "time": 2}
+
+    songplays = pd.read_parquet(os.path.join(output_dir, "songplays"))
+    assert sorted(songplays["song_id"]) == ["SO1", "SO1", "SO2"]
+    users = pd.read_parquet(os.path.join(output_dir, "users")).set_index("userid")
+    assert users.loc[10, "level"] == "paid"
+    assert list(users.columns) == ["first_name", "last_name", "gender", "level"]
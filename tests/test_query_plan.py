@@ -0,0 +1,83 @@
+import pytest
+
+from helpers.query_plan import PlanBudget, diff_plans, parse_plan, summarize_plan
+
+# EXPLAIN of songplay_table_insert on a cluster where staging_songs is not distributed on the join
+SONGPLAYS_PLAN = """\
+XN Hash Join DS_BCAST_INNER  (cost=112.50..2093411.34 rows=1825 width=1128)
+  Hash Cond: (("outer".song)::text = ("inner".title)::text)
+  ->  XN Seq Scan on staging_events events  (cost=0.00..100.00 rows=5 width=1160)
+        Filter: ((page)::text = 'NextSong'::text)
+  ->  XN Hash  (cost=90.00..90.00 rows=9000 width=92)
+        ->  XN Hash Join DS_DIST_BOTH  (cost=40.00..90.00 rows=9000 width=92)
+              Hash Cond: (("outer".artist_id)::text = ("inner".artistid)::text)
+              ->  XN Seq Scan on staging_songs songs  (cost=0.00..20.00 rows=9000 width=68)
+              ->  XN Hash  (cost=10.00..10.00 rows=1000 width=24)
+                    ->  XN Seq Scan on artists  (cost=0.00..10.00 rows=1000 width=24)
+  ->  XN Nested Loop DS_BCAST_INNER  (cost=0.00..50.00 rows=10 width=8)
+        ->  XN Seq Scan on time  (cost=0.00..1.00 rows=10 width=8)
+        ->  XN Seq Scan on users  (cost=0.00..1.00 rows=10 width=8)
+""".splitlines()
+
+
+def test_parse_plan_builds_the_tree():
+    root = parse_plan(SONGPLAYS_PLAN)
+
+    assert root.operation == "XN Hash Join DS_BCAST_INNER"
+    assert (root.startup_cost, root.total_cost, root.rows, root.width) == (112.50, 2093411.34, 1825, 1128)
+    assert root.details == ['Hash Cond: (("outer".song)::text = ("inner".title)::text)']
+    assert [child.operation for child in root.children] == ["XN Seq Scan on staging_events events", "XN Hash",
+                                                            "XN Nested Loop DS_BCAST_INNER"]
+    assert root.children[0].details == ["Filter: ((page)::text = 'NextSong'::text)"]
+    inner_join = root.children[1].children[0]
+    assert inner_join.distribution_step == "DS_DIST_BOTH"
+    assert [child.operation for child in inner_join.children] == ["XN Seq Scan on staging_songs songs", "XN Hash"]
+    assert inner_join.children[1].children[0].operation == "XN Seq Scan on artists"
+    assert len(list(root.walk())) == 10
+
+
+def test_summarize_plan_counts_steps_and_nested_loops():
+    summary = summarize_plan(parse_plan(SONGPLAYS_PLAN))
+
+    assert summary["distribution_steps"] == {"DS_BCAST_INNER": 2, "DS_DIST_BOTH": 1}
+    assert summary["nested_loops"] == 1
+    assert (summary["total_cost"], summary["rows"]) == (2093411.34, 1825)
+
+
+def test_budget_violations():
+    root = parse_plan(SONGPLAYS_PLAN)
+
+    assert PlanBudget().violations(root) == ["2 join(s) with DS_BCAST_INNER", "1 join(s) with DS_DIST_BOTH",
+                                             "1 nested loop join(s)"]
+    assert PlanBudget(max_cost=1000, max_rows=100, forbidden_steps=(), allow_nested_loops=True).violations(root) \
+        == ["estimated cost 2093411 exceeds 1000", "estimated rows 1825 exceed 100"]
+    assert PlanBudget(forbidden_steps=("DS_DIST_INNER",), allow_nested_loops=True).violations(root) == []
+
+
+def test_per_query_budget_overrides():
+    pytest.importorskip("airflow")
+    from operators.query_cost_guard import QueryCostGuardOperator
+
+    guard = QueryCostGuardOperator(task_id="check_query_plans", max_cost=10,
+                                   budgets={"songplays": {"max_cost": None, "forbidden_steps": ("DS_DIST_BOTH",),
+                                                          "allow_nested_loops": True}})
+    root = parse_plan(SONGPLAYS_PLAN)
+
+    assert guard.budget("songplays").violations(root) == ["1 join(s) with DS_DIST_BOTH"]
+    assert guard.budget("users").violations(root)[0] == "estimated cost 2093411 exceeds 10"
+
+
+def test_parse_plan_without_a_plan():
+    with pytest.raises(ValueError):
+        parse_plan(["ERROR:  relation \"songplays\" does not exist", ""])
+
+
+def test_diff_plans():
+    previous = "\n".join(SONGPLAYS_PLAN)
+    current = previous.replace("DS_DIST_BOTH", "DS_DIST_NONE")
+
+    assert diff_plans(previous, previous) == ""
+    diff = diff_plans(previous, current, "songplays")
+    assert diff.startswith("--- songplays (previous)\n+++ songplays (current)")
+    assert "-        ->  XN Hash Join DS_DIST_BOTH" in diff
+    assert "+        ->  XN Hash Join DS_DIST_NONE" in diff
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from helpers.rollups import ROLLUPS, Rollup
+
+
+def flat(sql):
+    return " ".join(sql.split())
+
+
+def test_period_range_widens_to_whole_days():
+    rollup = ROLLUPS["songplays_daily_song"]
+
+    assert rollup.period_range("2018-11-01 13:00:00", "2018-11-03 00:00:01") == \
+        (datetime(2018, 11, 1), datetime(2018, 11, 4))
+    assert rollup.period_range("2018-11-01 00:00:00", "2018-11-02 00:00:00") == \
+        (datetime(2018, 11, 1), datetime(2018, 11, 2))
+
+
+def test_period_range_widens_to_whole_months_across_a_year():
+    rollup = ROLLUPS["songplays_monthly_artist"]
+
+    # Rendered execution dates carry their UTC offset
+    assert rollup.period_range("2018-11-15 06:00:00+00:00", "2018-12-02 00:00:00+00:00") == \
+        (datetime(2018, 11, 1, tzinfo=timezone.utc), datetime(2019, 1, 1, tzinfo=timezone.utc))
+    assert rollup.period_range("2018-12-01 00:00:00", "2019-01-01 00:00:00") == \
+        (datetime(2018, 12, 1), datetime(2019, 1, 1))
+
+
+def test_matches_coalesces_only_nullable_keys():
+    rollup = Rollup("songplays_daily_session", "day", ["user_id", "session_id", "level"],
+                    [("plays", "int8", "COUNT(*)", "sum")])
+
+    assert rollup.matches("t", "s").split(" AND ") == [
+        "t.period_start = s.period_start",
+        "t.user_id = s.user_id",
+        "COALESCE(t.session_id, -1) = COALESCE(s.session_id, -1)",
+        "COALESCE(t.\"level\", '') = COALESCE(s.\"level\", '')",
+    ]
+
+
+def test_merge_statements():
+    update, insert = ROLLUPS["songplays_daily_user"].merge_statements("songplays_daily_user_stage")
+    target = "public.songplays_daily_user"
+
+    assert flat(update) == (
+        f"UPDATE {target} "
+        f"SET plays = {target}.plays + stage.plays, "
+        f"first_play = LEAST({target}.first_play, stage.first_play), "
+        f"last_play = GREATEST({target}.last_play, stage.last_play) "
+        f"FROM songplays_daily_user_stage stage "
+        f"WHERE {target}.period_start = stage.period_start AND {target}.user_id = stage.user_id "
+        f"AND COALESCE({target}.\"level\", '') = COALESCE(stage.\"level\", '')")
+    assert flat(insert) == (
+        f"INSERT INTO {target} (period_start, user_id, \"level\", plays, first_play, last_play) "
+        f"SELECT stage.period_start, stage.user_id, stage.\"level\", stage.plays, stage.first_play, "
+        f"stage.last_play "
+        f"FROM songplays_daily_user_stage stage "
+        f"LEFT JOIN {target} existing "
+        f"ON existing.period_start = stage.period_start AND existing.user_id = stage.user_id "
+        f"AND COALESCE(existing.\"level\", '') = COALESCE(stage.\"level\", '') "
+        f"WHERE existing.period_start IS NULL")
+
+
+def test_rebuild_statements_cover_whole_periods():
+    delete, insert = ROLLUPS["songplays_monthly_artist"].rebuild_statements()
+
+    assert flat(delete) == ("DELETE FROM public.songplays_monthly_artist "
+                            "WHERE period_start >= %s AND period_start < %s")
+    assert "SELECT DATE_TRUNC('month', start_time) AS period_start, artist_id, \"level\", COUNT(*) AS plays" \
+        in flat(insert)
+    assert flat(insert).endswith("WHERE start_time >= %s AND start_time < %s GROUP BY 1, 2, 3")
+
+
+def test_unknown_grain_and_merge():
+    with pytest.raises(ValueError):
+        Rollup("songplays_weekly", "week", ["user_id"], [("plays", "int8", "COUNT(*)", "sum")])
+    with pytest.raises(ValueError):
+        Rollup("songplays_daily", "day", ["user_id"], [("plays", "int8", "COUNT(*)", "avg")])
@@ -0,0 +1,79 @@
+import json
+
+from helpers.s3_manifest import S3Object, build_manifest, list_s3_objects, split_for_slices
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return iter(self.pages)
+
+
+class FakeS3Client:
+    """The part of a boto3 S3 client list_s3_objects uses."""
+
+    def __init__(self, pages):
+        self.paginator = FakePaginator(pages)
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self.paginator
+
+
+def objects(sizes):
+    return [S3Object("log_data/2018/11/{}.json".format(index), size, "etag{}".format(index))
+            for index, size in enumerate(sizes)]
+
+
+def test_list_s3_objects_reads_every_page_and_skips_folders():
+    client = FakeS3Client([
+        {"Contents": [{"Key": "log_data/", "Size": 0, "ETag": '"d41d"'},
+                      {"Key": "log_data/a.json", "Size": 10, "ETag": '"aaa"'}]},
+        {},
+        {"Contents": [{"Key": "log_data/b.json", "Size": 20, "ETag": '"bbb"'}]},
+    ])
+
+    found = list_s3_objects(client, "udacity-dend", "log_data/")
+
+    assert [(o.key, o.size, o.etag) for o in found] == [("log_data/a.json", 10, "aaa"),
+                                                         ("log_data/b.json", 20, "bbb")]
+    assert client.paginator.calls == [{"Bucket": "udacity-dend", "Prefix": "log_data/"}]
+
+
+def test_split_for_slices_keeps_whole_slice_multiples():
+    files = objects([1000] + [1] * 10)
+
+    groups = split_for_slices(files, num_slices=4, max_files_per_copy=10)
+
+    # 10 rounds down to 8 files per manifest, the last one holds the remaining 3
+    assert [len(group) for group in groups] == [8, 3]
+    assert sorted(o.key for group in groups for o in group) == sorted(o.key for o in files)
+
+
+def test_split_for_slices_spreads_bytes():
+    files = objects([100] * 4 + [1] * 12)
+
+    groups = split_for_slices(files, num_slices=2, max_files_per_copy=4)
+
+    assert [len(group) for group in groups] == [4, 4, 4, 4]
+    assert sorted(sum(o.size for o in group) for group in groups) == [103, 103, 103, 103]
+
+
+def test_split_for_slices_single_manifest():
+    files = objects([1, 2, 3])
+
+    assert split_for_slices(files, 4) == [files]
+    assert split_for_slices(files, 4, max_files_per_copy=3) == [files]
+    assert split_for_slices([], 4, 2) == []
+
+
+def test_build_manifest():
+    manifest = json.loads(build_manifest("udacity-dend", objects([7])))
+
+    assert manifest == {"entries": [{"url": "s3://udacity-dend/log_data/2018/11/0.json",
+                                     "mandatory": True, "meta": {"content_length": 7}}]}
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("airflow")
+
+from helpers.s3_manifest import S3Object
+from operators.stage_redshift import StageToRedshiftOperator
+
+
+class LedgerHook:
+
+    def __init__(self, records):
+        self.records = records
+
+    def get_records(self, sql, parameters=None):
+        return self.records
+
+
+def songs_operator():
+    return StageToRedshiftOperator(task_id="stage_songs", table_name="staging_songs", s3_bucket="udacity-dend",
+                                   s3_key="song_data/", use_manifest=True, manifest_bucket="manifests",
+                                   incremental=True)
+
+
+def test_unloaded_objects_skips_loaded_files():
+    hook = LedgerHook([("s3://udacity-dend/song_data/a.json", "aaa", 10)])
+    objects = [S3Object("song_data/a.json", 10, "aaa"), S3Object("song_data/b.json", 20, "bbb")]
+
+    assert [o.key for o in songs_operator().unloaded_objects(hook, objects)] == ["song_data/b.json"]
+
+
+def test_unloaded_objects_rejects_changed_files():
+    hook = LedgerHook([("s3://udacity-dend/song_data/a.json", "aaa", 10)])
+
+    with pytest.raises(ValueError, match="song_data/a.json"):
+        songs_operator().unloaded_objects(hook, [S3Object("song_data/a.json", 12, "abc")])
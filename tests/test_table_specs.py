@@ -0,0 +1,68 @@
+from helpers.table_specs import TABLE_SPECS, propose_spec_changes
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def execute(self, sql, parameters=None):
+        if not self.conn._autocommit:
+            self.conn.in_transaction = True
+        if sql.startswith("ANALYZE COMPRESSION"):
+            assert self.conn._autocommit, "ANALYZE COMPRESSION cannot run inside a transaction block"
+            self.result = self.conn.recommendations
+        else:
+            self.result = [self.conn.table_info]
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeConnection:
+    """Enforces psycopg2's rule that autocommit cannot change inside a transaction."""
+
+    def __init__(self, table_info, recommendations):
+        self.table_info      = table_info
+        self.recommendations = recommendations
+        self.in_transaction  = False
+        self._autocommit     = False
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if self.in_transaction:
+            raise RuntimeError("set_session cannot be used inside a transaction")
+        self._autocommit = value
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.in_transaction = False
+
+
+def test_propose_spec_changes_runs_analyze_compression_outside_the_transaction():
+    spec = TABLE_SPECS["songplays"]
+    conn = FakeConnection(("KEY(song_id)", 9.5, 35.0, 0.0, 1000),
+                          [("songplays", "location", "az64", "40.0"), ("songplays", "level", "zstd", "50.0")])
+    proposals = propose_spec_changes(conn, spec)
+    assert not conn.autocommit
+    assert any("skewed 9.5x" in proposal for proposal in proposals)
+    assert any("35% unsorted" in proposal for proposal in proposals)
+    assert any(proposal.startswith("songplays.location: ENCODE zstd -> az64") for proposal in proposals)
+    assert not any(proposal.startswith("songplays.level") for proposal in proposals)
+
+
+def test_ddl_renders_physical_design():
+    ddl = TABLE_SPECS["songplays"].ddl()
+    assert "DISTKEY (song_id)" in ddl
+    assert "COMPOUND SORTKEY (start_time)" in ddl
+    assert "ENCODE" not in TABLE_SPECS["songplays"].ddl(physical=False)
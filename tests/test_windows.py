@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+
+from helpers.windows import split_window
+
+
+def test_split_window_by_month_crosses_the_year():
+    assert split_window("2018-11-15 00:00:00", "2019-02-01 00:00:00", "month") == [
+        (datetime(2018, 11, 15), datetime(2018, 12, 1)),
+        (datetime(2018, 12, 1), datetime(2019, 1, 1)),
+        (datetime(2019, 1, 1), datetime(2019, 2, 1)),
+    ]
+
+
+def test_split_window_cuts_the_last_window_at_end():
+    assert split_window("2018-12-31 22:00:00", "2019-01-01 00:30:00", "hour") == [
+        (datetime(2018, 12, 31, 22), datetime(2018, 12, 31, 23)),
+        (datetime(2018, 12, 31, 23), datetime(2019, 1, 1)),
+        (datetime(2019, 1, 1), datetime(2019, 1, 1, 0, 30)),
+    ]
+
+
+def test_split_window_rejects_unknown_partitions():
+    with pytest.raises(ValueError):
+        split_window("2018-11-01", "2018-12-01", "week")
+
+
+def test_rendered_keys_cover_every_month_of_a_range_across_the_year():
+    pytest.importorskip("airflow")
+    from operators.stage_redshift import StageToRedshiftOperator
+
+    operator = StageToRedshiftOperator(task_id="stage", s3_key="log_data/{execution_date.year}/{execution_date.month}/",
+                                       key_range=("{dag_run.conf[start]}", "{dag_run.conf[end]}"),
+                                       use_manifest=True, manifest_bucket="manifests")
+
+    class DagRun:
+        conf = {"start": "2018-11-01", "end": "2019-02-01"}
+
+    assert operator.rendered_keys({"dag_run": DagRun(), "execution_date": datetime(2018, 11, 1)}) == [
+        "log_data/2018/11/", "log_data/2018/12/", "log_data/2019/1/"]